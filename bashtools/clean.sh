@@ -1,3 +1,4 @@
-rm  -rf  results  plots  __pycache__  peaks  .DS_Store  summary
+rm  -rf  results  plots  __pycache__  peaks  .DS_Store  summary  cubes  batch
 rm  -rf  images  param/__pycache__  src/__pycache__
+rm  -rf  kernel-cache  catalog-cache  hips-cache  traces  stores
 rm  -rf  dwarfs/dwarfs-* 
@@ -0,0 +1,26 @@
+#!/bin/bash
+#SBATCH  --export=NONE
+#SBATCH  --partition=long
+#SBATCH  --constraint=intel_e5_v4
+#SBATCH  --ntasks-per-node=16
+#SBATCH  --time=24:00:00
+#SBATCH  --job-name=dwarf-batch
+
+
+# use py3 on coma (don't need this if already using py3)
+source  activate  mypython3
+
+gc_size_pcs="10"
+# gc_size_pcs="5  10"
+
+# split list and job manifest with the predicted cost of each patch
+python  preprocess.py  --gc_size_pc  $gc_size_pcs
+
+# all patches on one node: a process pool packs the longest patches first
+# within the memory of the node. A resubmitted batch only runs the patches
+# whose inputs changed (stamps in results/, see src/incremental.py), e.g.
+# the new patches after adding dwarfs to dwarfs/ori-dwarfs.csv
+
+input="dwarfs/dwarfs-names-split-pm.txt"
+
+python  -W  ignore  batch.py  --names  $input  --gc_size_pc  $gc_size_pcs  --n_workers  16  --mem_gb  60
@@ -11,6 +11,7 @@
 source  activate  mypython3
 
 name_dwarf="$1"
-gc_size="$2"
+shift
+gc_sizes="$@"    # one or more gc sizes
 
-python  -W  ignore  main.py  --name_dwarf  $name_dwarf  --gc_size_pc  $gc_size
+python  -W  ignore  main.py  --name_dwarf  $name_dwarf  --gc_size_pc  $gc_sizes
@@ -14,8 +14,8 @@ gc_size_pcs="10"
 input="dwarfs/dwarfs-names-split-pm.txt"
 
 
+# all gc sizes share one job: the query, the cuts and the backgrounds are
+# computed once and the significance of each size is a slice of a cube
 while IFS= read -r name_dwarf;  do
-  for gc_size in $gc_size_pcs;  do
-    sbatch  bashtools/submit-slurm-single.sh  $name_dwarf  $gc_size
-  done  # for
+  sbatch  bashtools/submit-slurm-single.sh  $name_dwarf  $gc_size_pcs
 done < "$input"  # while
@@ -0,0 +1,286 @@
+import os
+import sys
+import json
+import time
+import argparse
+import traceback
+import numpy as np
+import pandas as pd
+import multiprocessing
+
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import redirect_stdout, redirect_stderr
+
+import main
+import src.param as param
+import src.plotting as plotting
+import src.classKDE_MWSatellite as classKDE_MWSatellite
+from src.tools import create_dir
+from src.cost import patch_cost, patch_memory
+from src.kernel_cache import KernelCache
+from src.catalog_cache import CatalogCache
+
+
+# modules reading the parameters of a patch from their globals when called:
+# values bound at import, e.g. default arguments or module constants derived
+# from them, would keep the parameters of the first patch of a worker
+PARAM_MODULES = [param, main, plotting, classKDE_MWSatellite]
+
+KERNEL_CACHE = None    # caches shared by all the patches of a worker
+CATALOG_CACHE = None
+
+
+
+def set_params(params: dict):
+    """ Set the parameters of a patch in every module using them """
+    for module in PARAM_MODULES:
+        module.__dict__.update(params)
+
+
+def init_worker(fft_workers: int = 1):
+    """ Create the caches of a worker once for all of its patches
+
+    : fft_workers : threads of each FFT, the cores of the node are shared
+                    by the workers
+    """
+    global KERNEL_CACHE, CATALOG_CACHE
+    set_params({'FFT_WORKERS': fft_workers})
+    KERNEL_CACHE = KernelCache(param.KERNEL_CACHE_DIR, param.KERNEL_CACHE_MEM_MB,
+                               param.KERNEL_CACHE_DISK_MB)
+    if param.CATALOG_CACHE_DIR is not None:
+        CATALOG_CACHE = CatalogCache(param.CATALOG_CACHE_DIR,
+                                     param.CATALOG_CACHE_DISK_MB)
+
+
+def read_checkpoint(path: str) -> set:
+    """ Jobs (name, gc_sizes) already completed by an earlier batch """
+    done = set()
+    try:
+        with open(path) as f:
+            for line in f:
+                try:
+                    job = json.loads(line)
+                except ValueError:    # line cut by an interruption
+                    continue
+                done.add((job['name'], tuple(job['gc_sizes'])))
+    except IOError:
+        pass
+    return  done
+
+
+def write_checkpoint(path: str, name: str, gc_sizes: list, wall: float):
+    """ Append a completed job to the checkpoint file """
+    with open(path, 'a') as f:
+        f.write(json.dumps({'name': name, 'gc_sizes': list(gc_sizes),
+                            'wall': wall}) + "\n")
+
+
+def run_job(dwarfs_dict: dict, log_dir: str, job: tuple) -> tuple:
+    """ Run main.run_patch for one job in a worker, with its output in a
+    log file. Errors are returned instead of stopping the batch.
+
+    : dwarfs_dict : the loaded dwarf list
+    : log_dir : directory of the log files
+    : job : (name of the patch, list of gc sizes)
+    : return : (name, gc_sizes, wall time, traceback or None)
+    """
+    name, gc_sizes = job
+    t0 = time.time()
+    try:
+        with open("{}/{}.log".format(log_dir, name), 'w') as f:
+            with redirect_stdout(f), redirect_stderr(f):
+                set_params(param.dwarf_params(name, gc_sizes, dwarfs_dict))
+                main.run_patch(KERNEL_CACHE, CATALOG_CACHE)
+        return  name, gc_sizes, time.time() - t0, None
+    except Exception:
+        return  name, gc_sizes, time.time() - t0, traceback.format_exc()
+
+
+def store_job(dwarfs_dict: dict, log_dir: str, name: str) -> tuple:
+    """ Build the star store of the dwarf of patch 'name' in a worker, see
+    main.build_dwarf_store. Errors are returned instead of stopping the batch.
+
+    : dwarfs_dict : the loaded dwarf list
+    : log_dir : directory of the log files
+    : name : name of a patch of the dwarf
+    : return : (name, wall time, traceback or None)
+    """
+    t0 = time.time()
+    try:
+        with open("{}/store-{}.log".format(log_dir, name), 'w') as f:
+            with redirect_stdout(f), redirect_stderr(f):
+                set_params(param.dwarf_params(name, param.GC_SIZES, dwarfs_dict))
+                main.build_dwarf_store(CATALOG_CACHE)
+        return  name, time.time() - t0, None
+    except Exception:
+        return  name, time.time() - t0, traceback.format_exc()
+
+
+def job_cost(dwarfs_dict: dict, job: tuple, n_star: float = 0.) -> tuple:
+    """ Estimated cost and memory (MB) of a job, for packing the longest
+    jobs first within the memory of the node
+
+    : n_star : expected number of stars, e.g. from the job manifest
+    """
+    params = param.dwarf_params(job[0], job[1], dwarfs_dict)
+    args = (params['WIDTH'], params['PIXEL_SIZE'], params['SIGMA1S'], params['SIGMA2'],
+            params['SIGMA3'], params['R_HALFLIGHT'], n_star)
+    sat_max_radius = param.APERTURE_SAT_MAX_RADIUS
+    return  (patch_cost(*args, sat_max_radius=sat_max_radius),
+             patch_memory(*args, sat_max_radius=sat_max_radius))
+
+
+def schedule(new_pool, run, jobs: list, costs: list, memorys: list,
+             n_workers: int, max_mem_mb: float = None):
+    """ Run the jobs on the pool, longest first, without exceeding
+    max_mem_mb of predicted memory at any time. When the next longest job
+    does not fit, a smaller one that fits is started instead; a job larger
+    than max_mem_mb runs alone. A worker killed e.g. by the OOM killer
+    breaks the pool: its jobs fail and the rest run on a new pool.
+
+    : new_pool : function returning a new ProcessPoolExecutor
+    : run : function of a job
+    : jobs : list of jobs
+    : costs : predicted cost of each job
+    : memorys : predicted memory of each job in MB
+    : n_workers : number of processes of the pool
+    : max_mem_mb : memory of the node in MB, None for no limit
+    : return : generator of (index of the job, result or None, traceback or
+               None), in order of completion
+    """
+    pending = list(np.argsort(costs)[::-1])
+    running = {}    # future: index of its job
+    mem_running = 0.
+    pool = new_pool()
+    is_broken = False
+    try:
+        while len(pending) > 0 or len(running) > 0:
+            while len(pending) > 0 and len(running) < n_workers and not is_broken:
+                fits = [i for i in pending if max_mem_mb is None or len(running) == 0
+                        or mem_running + memorys[i] <= max_mem_mb]
+                if len(fits) == 0:
+                    break
+                i = fits[0]
+                pending.remove(i)
+                mem_running += memorys[i]
+                running[pool.submit(run, jobs[i])] = i
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                i = running.pop(future)
+                mem_running -= memorys[i]
+                try:
+                    result, error = future.result(), None
+                except BrokenProcessPool:
+                    is_broken = True
+                    result, error = None, traceback.format_exc()
+                except Exception:
+                    result, error = None, traceback.format_exc()
+                yield  i, result, error
+            if is_broken and len(running) == 0:
+                # every job of the broken pool has failed, start a new one
+                pool.shutdown(wait=True)
+                pool = new_pool()
+                is_broken = False
+    finally:
+        pool.shutdown(wait=True)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run many patches on one node')
+    parser.add_argument('--names', type=str, default=None,
+                        help='File of patch names, default: the split list of src.param')
+    parser.add_argument('--gc_size_pc', type=int, nargs='+', default=[10],
+                        help='Sizes of globular clusters, shared by all patches')
+    parser.add_argument('--n_workers', type=int, default=multiprocessing.cpu_count())
+    parser.add_argument('--checkpoint', type=str, default='batch/checkpoint.jsonl')
+    parser.add_argument('--log_dir', type=str, default='batch/logs')
+    parser.add_argument('--manifest', type=str, default=None,
+                        help='Job manifest of preprocess.py, default: the one of the split list')
+    parser.add_argument('--mem_gb', type=float, default=None,
+                        help='Memory of the node shared by the workers')
+    parser.add_argument('--dwarf_store', action='store_true',
+                        help='Query and sort the stars of each dwarf once, its patches slice them')
+    args = parser.parse_args()
+
+    names_file = args.names
+    if names_file is None:
+        names_file = param.get_path_dwarfs().replace("joint", "names").replace(".npy", ".txt")
+    names = np.loadtxt(names_file, dtype=str, ndmin=1)
+
+    create_dir(args.log_dir)
+    create_dir(os.path.dirname(args.checkpoint) or '.')
+    dwarfs_dict = np.load(param.get_path_dwarfs(), allow_pickle=True).item()
+
+    if param.IS_INCREMENTAL:
+        # jobs whose stages all hold stamps of unchanged inputs, e.g. all
+        # but the new patches after adding dwarfs to the list
+        done = set()
+        for name in names:
+            set_params(param.dwarf_params(name, args.gc_size_pc, dwarfs_dict))
+            if main.is_patch_fresh():
+                done.add((name, tuple(args.gc_size_pc)))
+    else:
+        done = read_checkpoint(args.checkpoint)
+    jobs = [(name, list(args.gc_size_pc)) for name in names
+            if (name, tuple(args.gc_size_pc)) not in done]
+    print("%d jobs, %d already done" % (len(jobs), len(names) - len(jobs)))
+
+    fft_workers = max(1, multiprocessing.cpu_count() // args.n_workers)
+    new_pool = partial(ProcessPoolExecutor, args.n_workers, initializer=init_worker,
+                       initargs=(fft_workers,))
+
+    if args.dwarf_store:
+        # one store per dwarf with several patches to run, before the patches
+        patches = {}
+        for name, _ in jobs:
+            patches.setdefault(name.split("=")[0], []).append(name)
+        names_store = [names_dwarf[0] for names_dwarf in patches.values()
+                       if len(names_dwarf) > 1]
+        with new_pool() as pool:
+            for name, wall, error in pool.map(
+                    partial(store_job, dwarfs_dict, args.log_dir), names_store):
+                if error is None:
+                    print("store of %s done in %0.1fs" % (name.split("=")[0], wall))
+                else:
+                    print("store of %s failed, its patches query the database:\n%s" % (
+                        name.split("=")[0], error))
+        sys.stdout.flush()
+
+    # expected number of stars of each patch from the job manifest
+    manifest = args.manifest
+    if manifest is None:
+        manifest = param.get_path_dwarfs().replace("joint", "manifest").replace(".npy", ".csv")
+    n_stars = {}
+    if os.path.exists(manifest):
+        df = pd.read_csv(manifest)
+        n_stars = dict(zip(df['name'], df['n_star']))
+    else:
+        print("No job manifest %s: costs ignore the star counts" % manifest)
+
+    # longest jobs first so that the short ones fill the gaps at the end
+    costs, memorys = [], []
+    for job in jobs:
+        cost, memory = job_cost(dwarfs_dict, job, n_stars.get(job[0], 0.))
+        costs.append(cost)
+        memorys.append(memory)
+    max_mem_mb = None if args.mem_gb is None else 1024. * args.mem_gb
+
+    t0 = time.time()
+    n_fail = 0
+    run = partial(run_job, dwarfs_dict, args.log_dir)
+    for n, (i, result, error) in enumerate(schedule(
+            new_pool, run, jobs, costs, memorys, args.n_workers, max_mem_mb)):
+        name, gc_sizes = jobs[i]
+        if result is not None:
+            name, gc_sizes, wall, error = result
+        if error is None:
+            write_checkpoint(args.checkpoint, name, gc_sizes, wall)
+            print("[%d/%d] %s done in %0.1fs" % (n + 1, len(jobs), name, wall))
+        else:
+            n_fail += 1
+            print("[%d/%d] %s failed:\n%s" % (n + 1, len(jobs), name, error))
+        sys.stdout.flush()
+
+    print("Took %0.1fs for %d jobs, %d failed" % (time.time() - t0, len(jobs), n_fail))
@@ -0,0 +1,287 @@
+""" Benchmark of the KDE engines on synthetic star fields, without database.
+
+    python  -W  ignore  -m  benchmarks.bench_kde  --write-baseline
+    python  -W  ignore  -m  benchmarks.bench_kde    # compare to the baseline
+
+Each case is timed with every engine. The significance maps of the engines
+are checked against the reference engine (exact aperture counts and
+Poisson z-score, see ENGINES), and the timings are compared to a baseline
+written by --write-baseline in the output directory (not committed).
+"""
+import os
+import sys
+import json
+import argparse
+import tempfile
+import numpy as np
+
+from typing import Dict, List
+from contextlib import redirect_stdout
+from src import instrument
+from src.param import FILE_STAR, FILE_SIG_GAUSSIAN_CUBE, FILE_SIG_POISSON_CUBE
+from src.param_patch_candidate import s_above
+from src.classKDE_MWSatellite import KDE_MWSatellite
+from src.classPatchMWSatellite import PatchMWSatellite
+from src.kernel_cache import KernelCache
+from src.lazy_datas import LazyDatas
+from src.columnar import save_columns
+from src.peaks import peak_catalog
+from src.tools import create_dir, dist2
+from benchmarks.synthetic import synthetic_field, cluster_positions
+
+
+np.seterr(divide='ignore', invalid='ignore')
+
+REFERENCE = 'exact'    # exact aperture counts and z-score, the most accurate maps
+# engines: keyword arguments of KDE_MWSatellite and tolerances of the maps
+# against the reference, None: not compared. 'peaks': the pixels above
+# s_above must be the same. 'round_counts': the Poisson map is compared
+# after rounding the inner aperture counts, see rounded_sig_poisson_cube.
+ENGINES = {
+    'exact': ({'engine': 'spectrum', 'z_score': 'exact'},
+              {'gaussian': 0., 'poisson': 0., 'peaks': True}),
+    'fft': ({'engine': 'fft', 'z_score': 'exact'},
+            {'gaussian': 1e-6, 'poisson': 1e-6, 'peaks': True, 'round_counts': True}),
+    'table': ({'engine': 'spectrum', 'z_score': 'table'},
+              {'gaussian': 0., 'poisson': 1e-3, 'peaks': True}),
+    'threshold': ({'engine': 'spectrum', 'z_score': 'threshold'},
+                  {'gaussian': 0., 'poisson': 1e-6, 'peaks': True}),
+    'pyramid': ({'engine': 'spectrum', 'z_score': 'table', 'pyramid': True},
+                {'gaussian': 5e-2, 'poisson': 1e-3, 'peaks': False}),
+}
+STAGES = ['np_hist2d', 'compound_sig_gaussian', 'compound_sig_poisson',
+          'peak_catalog', 'save']
+
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Benchmark of the KDE engines')
+    parser.add_argument('--density', type=float, nargs='+', default=[5e3, 5e4],
+                        help='background stars per deg^2, one case each')
+    parser.add_argument('--gradient', type=float, default=0.,
+                        help='relative change of the background density across the patch')
+    parser.add_argument('--width', type=float, default=1.)
+    parser.add_argument('--pixel_size', type=float, default=0.002)
+    parser.add_argument('--sigma1', type=float, nargs='+', default=[0.004, 0.008])
+    parser.add_argument('--sigma2', type=float, default=0.05)
+    parser.add_argument('--sigma3', type=float, default=0.5)
+    parser.add_argument('--rh', type=float, default=0.1, help='half light radius of the dwarf')
+    parser.add_argument('--n_dwarf', type=int, default=2000)
+    parser.add_argument('--n_cluster', type=int, default=5)
+    parser.add_argument('--cluster_star', type=int, default=40,
+                        help='number of stars of each injected cluster')
+    parser.add_argument('--engines', nargs='+', default=list(ENGINES), choices=list(ENGINES))
+    parser.add_argument('--repeat', type=int, default=3, help='best of repeat runs')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--tracemalloc', action='store_true',
+                        help='peak python allocations of each stage, slower')
+    parser.add_argument('--output', default='benchmarks/output')
+    parser.add_argument('--write-baseline', action='store_true', dest='write_baseline')
+    parser.add_argument('--slack', type=float, default=0.2,
+                        help='slowdown relative to the baseline reported as a regression')
+    parser.add_argument('--strict', action='store_true', help='exit 1 on regressions')
+    return  parser.parse_args()
+
+
+def run_engine(datas: Dict[str, np.ndarray], args: argparse.Namespace, kwargs: dict,
+               trace_path: str, out_dir: str) -> KDE_MWSatellite:
+    """ KDE, peaks and save of a synthetic patch, traced into trace_path.
+    The kernel cache is empty, i.e. the timings are those of a first patch.
+    """
+    ra0, dec0 = 0.5 * args.width, 0.
+    kdepatch = KDE_MWSatellite(ra0, dec0, args.width, args.pixel_size, args.sigma1,
+                               args.sigma2, args.sigma3, args.rh,
+                               cache=KernelCache(None), s_above=s_above, **kwargs)
+    instrument.start(trace_path, os.path.basename(trace_path), args.tracemalloc)
+    try:
+        with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+            kdepatch.np_hist2d(datas['ra'], datas['dec'])
+            kdepatch.add_masks_on_pixels(ra0, dec0, args.rh)
+            kdepatch.compound_sig_gaussian()
+            kdepatch.compound_sig_poisson()
+
+            with instrument.trace('peak_catalog'):
+                for sig in kdepatch.sig_poisson_cube:
+                    peak_catalog(kdepatch.x_mesh, kdepatch.y_mesh, sig, s_above)
+
+            with instrument.trace('save') as record:    # as main.save_scale
+                patch = PatchMWSatellite('bench', ra0, dec0, 0., args.width, 'bench', 'ra, dec')
+                patch.datas = LazyDatas(datas)
+                patch.append_sig_to_data(kdepatch.x_mesh, kdepatch.y_mesh,
+                                         kdepatch.sig_gaussian, kdepatch.sig_poisson)
+                save_columns(out_dir, patch.datas, FILE_STAR)
+                np.save("{}/{}".format(out_dir, FILE_SIG_GAUSSIAN_CUBE), kdepatch.sig_gaussian_cube)
+                np.save("{}/{}".format(out_dir, FILE_SIG_POISSON_CUBE), kdepatch.sig_poisson_cube)
+                record['nbytes'] = instrument.nbytes(patch.datas)
+    finally:
+        instrument.stop()
+    return  kdepatch
+
+
+def stage_stats(trace_paths: List[str]) -> Dict[str, dict]:
+    """ Best wall and cpu time and worst memory of each stage over repeats """
+    df = instrument.read_trace(trace_paths)
+    stats = {}
+    for stage in STAGES:
+        rows = df.loc[(df['stage'] == stage) & (df['depth'] == 0)]
+        walls = rows.groupby('patch')['wall'].sum()
+        stats[stage] = {'wall': float(walls.min()),
+                        'cpu': float(rows.groupby('patch')['cpu'].sum().min()),
+                        'max_rss_mb': float(rows['max_rss_mb'].max()),
+                        'nbytes': int(rows['nbytes'].fillna(0).max()) if 'nbytes' in rows else 0}
+        if 'tracemalloc_peak_mb' in rows:
+            stats[stage]['tracemalloc_peak_mb'] = float(rows['tracemalloc_peak_mb'].max())
+    return  stats
+
+
+def rounded_sig_poisson_cube(kdepatch: KDE_MWSatellite) -> np.ndarray:
+    """ Poisson significance cube of kdepatch with the inner aperture counts
+    rounded to integers before the edge adjustment. The legacy fft engine
+    convolves the apertures, so that a count of 3 comes out as e.g.
+    2.9999999, which poisson.sf floors to 2: a quarter of its pixels differ
+    by up to ~1 sigma from the exact counts. This known difference of the
+    legacy results is removed by the rounding, the rest must match. """
+    sigs = []
+    for sigma1 in kdepatch.sigma1s:
+        n_inner, area_inner = kdepatch.poisson_inner_number_count(sigma1)
+        key = ('disk', int(round(sigma1 / kdepatch.pixel_size)))
+        edge_factor = area_inner / kdepatch.aperture_edge_area(n_inner.shape, key)
+        n_inner = np.rint(n_inner / edge_factor) * edge_factor
+        lambda_in, lambda_out = kdepatch.poisson_expected_background(sigma1, area_inner)
+        sigs.append(np.where(kdepatch.is_inside_dwarf,
+                             kdepatch.z_score_poisson(lambda_in, n_inner),
+                             kdepatch.z_score_poisson(lambda_out, n_inner)))
+    return  np.array(sigs)
+
+
+def compare_maps(ref: KDE_MWSatellite, kdepatch: KDE_MWSatellite, tol: dict) -> dict:
+    """ Max difference of the significance cubes on the pixels finite in
+    both, and number of pixels above s_above in only one of them
+
+    : ref : KDE_MWSatellite of the reference engine
+    : kdepatch : KDE_MWSatellite of the compared engine
+    : tol : tolerances of the engine, see ENGINES
+    """
+    check = {'is_ok': True}
+    for kernel in ['gaussian', 'poisson']:
+        if tol[kernel] is None:
+            continue
+        a = getattr(ref, 'sig_{}_cube'.format(kernel))
+        if kernel == 'poisson' and tol.get('round_counts', False):
+            b = rounded_sig_poisson_cube(kdepatch)
+        else:
+            b = getattr(kdepatch, 'sig_{}_cube'.format(kernel))
+        is_finite = np.isfinite(a) & np.isfinite(b)
+        diff = float(np.max(np.abs(a - b)[is_finite])) if np.any(is_finite) else 0.
+        n_flip = int(np.sum((a > s_above) != (b > s_above)))
+        check[kernel] = {'max_diff': diff, 'tol': tol[kernel], 'n_peak_mismatch': n_flip}
+        check['is_ok'] &= diff <= tol[kernel] and not (tol['peaks'] and n_flip > 0)
+    return  check
+
+
+def n_recovered(kdepatch: KDE_MWSatellite, positions: list) -> int:
+    """ Number of injected clusters with a Poisson peak above s_above within
+    2 sigma1 of their position at the smallest scale """
+    xx, yy = np.meshgrid(kdepatch.x_mesh[:-1], kdepatch.y_mesh[:-1])
+    sig = kdepatch.sig_poisson_cube[0]
+    n = 0
+    for ra, dec in positions:
+        near = dist2(xx, yy, ra, dec) < (2. * kdepatch.sigma1s[0]) ** 2
+        n += int(np.nanmax(np.where(near, sig, -np.inf)) > s_above)
+    return  n
+
+
+def compare_baseline(results: dict, baseline: dict, slack: float) -> List[str]:
+    """ Stages slower than (1 + slack) times the baseline """
+    regressions = []
+    for case, engines in results['cases'].items():
+        for engine, result in engines.items():
+            old = baseline['cases'].get(case, {}).get(engine)
+            if old is None:
+                continue
+            for stage, stats in result['stages'].items():
+                wall_old = old['stages'].get(stage, {}).get('wall')
+                if wall_old and stats['wall'] > (1. + slack) * wall_old:
+                    regressions.append('%s %s %s: %0.4fs, baseline %0.4fs' % (
+                        case, engine, stage, stats['wall'], wall_old))
+    return  regressions
+
+
+def main() -> int:
+    args = parse_args()
+    create_dir(args.output)
+    engines = [REFERENCE] + [e for e in args.engines if e != REFERENCE]
+    ra0, dec0 = 0.5 * args.width, 0.
+    positions = cluster_positions(args.n_cluster, ra0, dec0, args.width, args.seed)
+    clusters = [(ra, dec, args.cluster_star, min(args.sigma1)) for ra, dec in positions]
+    results = {'args': vars(args), 'cases': {}}
+    is_ok = True
+
+    for density in args.density:
+        case = "d%g-g%g-w%g-ps%g" % (density, args.gradient, args.width, args.pixel_size)
+        datas = synthetic_field(density, ra0, dec0, args.width, args.gradient,
+                                args.n_dwarf, args.rh, clusters, args.seed)
+        n_star = len(datas['ra'])
+        n_pixel = round(args.width / args.pixel_size) ** 2 * len(args.sigma1)
+        print('%s: %d stars, %d map pixels' % (case, n_star, n_pixel))
+        results['cases'][case] = {}
+
+        ref = None
+        for engine in engines:
+            kwargs, tol = ENGINES[engine]
+            paths = []
+            with tempfile.TemporaryDirectory() as out_dir:
+                for i in range(args.repeat):
+                    paths.append("{}/trace-{}-{}-{}.jsonl".format(args.output, case, engine, i))
+                    kdepatch = run_engine(datas, args, kwargs, paths[-1], out_dir)
+            stats = stage_stats(paths)
+            result = {'stages': stats, 'n_star': n_star, 'n_pixel': n_pixel,
+                      'star_per_s': n_star / stats['np_hist2d']['wall'],
+                      'pixel_per_s': n_pixel / (stats['compound_sig_gaussian']['wall']
+                                                + stats['compound_sig_poisson']['wall']),
+                      'n_recovered': n_recovered(kdepatch, positions)}
+            if ref is None:
+                ref = kdepatch
+            else:
+                result['check'] = compare_maps(ref, kdepatch, tol)
+                is_ok &= result['check']['is_ok']
+            results['cases'][case][engine] = result
+
+            _s = "  ".join("%s %0.4fs" % (stage, stats[stage]['wall']) for stage in STAGES)
+            print('    %-20s %s' % (engine, _s))
+            print('    %-20s %0.3g stars/s  %0.3g pixels/s  %d/%d clusters recovered' % (
+                '', result['star_per_s'], result['pixel_per_s'],
+                result['n_recovered'], len(positions)))
+            if 'check' in result:
+                _s = ", ".join("%s diff %0.2g (tol %g), %d mismatched peak pixels" % (
+                    kernel, check['max_diff'], check['tol'], check['n_peak_mismatch'])
+                    for kernel, check in result['check'].items() if kernel != 'is_ok')
+                print('    %-20s %s: %s' % (
+                    '', 'ok' if result['check']['is_ok'] else 'FAILED', _s))
+
+    baseline_path = "{}/baseline.json".format(args.output)
+    with open("{}/latest.json".format(args.output), 'w') as f:
+        json.dump(results, f, indent=1)
+    if args.write_baseline:
+        with open(baseline_path, 'w') as f:
+            json.dump(results, f, indent=1)
+        print('Wrote the baseline %s' % baseline_path)
+        regressions = []
+    elif os.path.exists(baseline_path):
+        with open(baseline_path) as f:
+            regressions = compare_baseline(results, json.load(f), args.slack)
+        print('%d regressions against %s' % (len(regressions), baseline_path))
+        for regression in regressions:
+            print('    %s' % regression)
+    else:
+        regressions = []
+        print('No baseline in %s, write one with --write-baseline' % args.output)
+
+    if not is_ok:
+        print('Significance maps differ from the reference engine %s' % REFERENCE)
+    return  0 if is_ok and not (args.strict and len(regressions) > 0) else 1
+
+
+
+if __name__ == '__main__':
+    sys.exit(main())
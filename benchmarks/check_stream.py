@@ -0,0 +1,124 @@
+""" Check of the streaming query (PatchMWSatellite.sql_stream) against a
+local SQLite stand-in of the catalog, without database access.
+
+    python  -W  ignore  -m  benchmarks.check_stream
+    python  -W  ignore  -m  benchmarks.check_stream  --n_star  1000000  --chunk_size  50000
+
+A synthetic Gaia-like table is written to SQLite and streamed chunk by
+chunk with the Gaia cuts. hist2d, the kept columns and the cut log must be
+identical to the cuts applied to the whole table at once (sql_get path).
+"""
+import sys
+import sqlite3
+import argparse
+import numpy as np
+
+from typing import Dict
+from src.classKDE_MWSatellite import KDE_MWSatellite
+from src.classPatchMWSatellite import PatchMWSatellite
+from src.lazy_datas import LazyDatas
+
+
+CATALOG_STR = """ ra, dec, pmra, pmdec, pmra_error, pmdec_error,
+                  bp_rp, phot_g_mean_mag, astrometric_excess_noise """
+KEEP_COLUMNS = ['ra', 'dec', 'pmra', 'pmdec', 'bp_rp', 'phot_g_mean_mag']
+PM_DWARF = (0.5, -0.5)    # pmra and pmdec of the dwarf in mas/yr
+
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Check of the streaming query on SQLite')
+    parser.add_argument('--n_star', type=int, default=200000, help='rows of the table')
+    parser.add_argument('--width', type=float, default=1., help='width of the patch in deg')
+    parser.add_argument('--pixel_size', type=float, default=0.004)
+    parser.add_argument('--chunk_size', type=int, nargs='+', default=[7000, 100000, 10000000],
+                        help='chunk sizes checked, one stream each')
+    parser.add_argument('--seed', type=int, default=0)
+    return  parser.parse_args()
+
+
+def gaia_table(n: int, ra0: float, dec0: float, width: float,
+               seed: int = 0) -> Dict[str, np.ndarray]:
+    """ Columns of a synthetic Gaia-like catalog around the box of a patch,
+    1.5 times wider so that the box of the query cuts it """
+    rng = np.random.default_rng(seed)
+    table = {'ra': ra0 + 1.5 * width * (rng.uniform(size=n) - 0.5),
+             'dec': dec0 + 1.5 * width * (rng.uniform(size=n) - 0.5),
+             'pmra': rng.normal(0., 3., size=n), 'pmdec': rng.normal(0., 3., size=n),
+             'pmra_error': rng.uniform(0.1, 2., size=n),
+             'pmdec_error': rng.uniform(0.1, 2., size=n),
+             'bp_rp': rng.normal(1., 0.5, size=n),
+             'phot_g_mean_mag': rng.uniform(15., 22., size=n),
+             'astrometric_excess_noise': rng.exponential(3., size=n)}
+    return  table
+
+
+def to_sqlite(table: Dict[str, np.ndarray], name: str = 'gaia_source') -> sqlite3.Connection:
+    """ In memory SQLite database with the table """
+    conn = sqlite3.connect(':memory:')
+    columns = list(table)
+    conn.execute("create table {} ({})".format(name, ", ".join(
+        "{} real".format(column) for column in columns)))
+    conn.executemany("insert into {} values ({})".format(name, ", ".join(["?"] * len(columns))),
+                     zip(*[table[column].tolist() for column in columns]))
+    return  conn
+
+
+def gaia_cuts(patch: PatchMWSatellite):
+    """ The Gaia cuts of main.apply_cuts """
+    patch.mask_cut("phot_g_mean_mag", 17, 21)
+    patch.mask_g_mag_astro_noise_cut()
+    patch.mask_pm_error(PM_DWARF[0], PM_DWARF[1], 3)
+
+
+def new_patch(args: argparse.Namespace) -> PatchMWSatellite:
+    patch = PatchMWSatellite('check', 10., 0., 1e5, args.width, 'gaia_source', CATALOG_STR)
+    patch.verbose = False
+    return  patch
+
+
+def new_kdepatch(args: argparse.Namespace) -> KDE_MWSatellite:
+    return  KDE_MWSatellite(10., 0., args.width, args.pixel_size, 0.016, 0.05, 0.2, 0.1)
+
+
+def main() -> int:
+    args = parse_args()
+    patch = new_patch(args)
+    ra_min, ra_max, dec_min, dec_max = patch.get_box()
+    table = gaia_table(args.n_star, patch.ra_sat, patch.dec_sat, args.width, args.seed)
+    conn = to_sqlite(table)
+
+    # reference: the box and the cuts applied to the whole table at once
+    is_box = ((ra_min < table['ra']) & (table['ra'] < ra_max)
+              & (dec_min < table['dec']) & (table['dec'] < dec_max))
+    patch.datas = LazyDatas({column: values[is_box] for column, values in table.items()})
+    gaia_cuts(patch)
+    ref = new_kdepatch(args)
+    ref.np_hist2d(patch.datas['ra'], patch.datas['dec'])
+    ref_datas = {column: patch.datas[column] for column in KEEP_COLUMNS}
+    ref_log = dict(patch.cut_log)
+    print('%d rows, %d in the box, %d after the cuts' % (
+        args.n_star, np.sum(is_box), patch.n_source()))
+
+    is_ok = True
+    for chunk_size in args.chunk_size:
+        patch = new_patch(args)
+        kdepatch = new_kdepatch(args)
+        patch.sql_stream(conn, gaia_cuts, kdepatch, KEEP_COLUMNS, chunk_size)
+        checks = {'hist2d': np.array_equal(kdepatch.hist2d, ref.hist2d),
+                  'columns': all(np.array_equal(patch.datas[column], ref_datas[column])
+                                 for column in KEEP_COLUMNS),
+                  'cut_log': dict(patch.cut_log) == ref_log}
+        print('    chunks of %d rows: %s' % (chunk_size, ", ".join(
+            "%s %s" % (name, 'ok' if check else 'FAILED') for name, check in checks.items())))
+        is_ok &= all(checks.values())
+    conn.close()
+
+    if not is_ok:
+        print('The streamed patch differs from the patch cut at once')
+    return  0 if is_ok else 1
+
+
+
+if __name__ == '__main__':
+    sys.exit(main())
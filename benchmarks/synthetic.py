@@ -0,0 +1,94 @@
+import numpy as np
+
+from typing import Dict, List, Tuple
+
+
+
+def uniform_stars(n: int, ra0: float, dec0: float, width: float,
+                  rng: np.random.Generator, gradient: float = 0.) -> Tuple[np.ndarray, np.ndarray]:
+    """ Background stars in the box of a patch, uniform or with a density
+    varying linearly along ra: 1 + gradient * (ra - ra0) / width
+
+    : n : number of stars
+    : ra0 : ra of the center of the patch in deg
+    : dec0 : dec of the center of the patch in deg
+    : width : width of the patch in deg
+    : rng : numpy random generator
+    : gradient : relative change of density across the patch, |gradient| < 2
+    """
+    u = rng.uniform(size=n)
+    if gradient == 0.:
+        x = u - 0.5
+    else:    # inverse of the cdf of p(x) = 1 + gradient * x on [-0.5, 0.5]
+        g = gradient
+        x = (-1. + np.sqrt((1. - 0.5 * g) ** 2 + 2. * g * u)) / g
+    ra = ra0 + width * x
+    dec = dec0 + width * (rng.uniform(size=n) - 0.5)
+    return  ra, dec
+
+
+def plummer_stars(n: int, ra0: float, dec0: float, rh: float,
+                  rng: np.random.Generator) -> Tuple[np.ndarray, np.ndarray]:
+    """ Stars of a dwarf with a projected Plummer profile, whose half light
+    radius is the Plummer radius rh: N(<R) = R^2 / (R^2 + rh^2)
+
+    : n : number of stars
+    : ra0 : ra of the dwarf in deg
+    : dec0 : dec of the dwarf in deg
+    : rh : half light radius in deg
+    : rng : numpy random generator
+    """
+    u = rng.uniform(0., 0.999, size=n)    # truncated at ~ 30 rh
+    r = rh * np.sqrt(u / (1. - u))
+    phi = rng.uniform(0., 2. * np.pi, size=n)
+    return  ra0 + r * np.cos(phi), dec0 + r * np.sin(phi)
+
+
+def cluster_stars(n: int, ra0: float, dec0: float, size: float,
+                  rng: np.random.Generator) -> Tuple[np.ndarray, np.ndarray]:
+    """ Stars of a compact cluster with a Gaussian profile of width size """
+    return  ra0 + size * rng.normal(size=n), dec0 + size * rng.normal(size=n)
+
+
+def synthetic_field(density: float, ra0: float, dec0: float, width: float,
+                    gradient: float = 0., n_dwarf: int = 0, rh: float = 0.1,
+                    clusters: List[Tuple[float, float, int, float]] = (),
+                    seed: int = 0) -> Dict[str, np.ndarray]:
+    """ Star field of a patch: background, a dwarf at the center of the
+    patch and injected compact clusters, cut to the box of the patch.
+
+    : density : background stars per deg^2
+    : ra0 : ra of the center of the patch in deg
+    : dec0 : dec of the center of the patch in deg
+    : width : width of the patch in deg
+    : gradient : relative change of the background density across the patch
+    : n_dwarf : number of stars of the dwarf
+    : rh : half light radius of the dwarf in deg
+    : clusters : list of (ra, dec, number of stars, size in deg)
+    : seed : seed of the random generator
+    : return : dict with 'ra' and 'dec'
+    """
+    rng = np.random.default_rng(seed)
+    ras, decs = [], []
+    n_background = rng.poisson(density * width ** 2)
+    for ra, dec in [uniform_stars(n_background, ra0, dec0, width, rng, gradient),
+                    plummer_stars(n_dwarf, ra0, dec0, rh, rng)]:
+        ras.append(ra)
+        decs.append(dec)
+    for ra_c, dec_c, n_c, size in clusters:
+        ra, dec = cluster_stars(n_c, ra_c, dec_c, size, rng)
+        ras.append(ra)
+        decs.append(dec)
+
+    ra, dec = np.concatenate(ras), np.concatenate(decs)
+    is_in = (np.abs(ra - ra0) < 0.5 * width) & (np.abs(dec - dec0) < 0.5 * width)
+    return  {'ra': ra[is_in], 'dec': dec[is_in]}
+
+
+def cluster_positions(n_cluster: int, ra0: float, dec0: float, width: float,
+                      seed: int = 0) -> List[Tuple[float, float]]:
+    """ Positions of injected clusters, spread over the patch away from the
+    edges, where the significance is not reduced by the boundary """
+    rng = np.random.default_rng(seed + 1)
+    offsets = 0.35 * width * rng.uniform(-1., 1., size=(n_cluster, 2))
+    return  [(ra0 + d_ra, dec0 + d_dec) for d_ra, d_dec in offsets]
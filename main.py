@@ -1,3 +1,7 @@
+import os
+import time
+import inspect
+import sqlutilpy
 import numpy as np
 
 from typing import Tuple
@@ -5,27 +9,47 @@ from wsdb import HOST, USER, PASSWORD
 
 from src.param import *
 from src.tools import create_dir, print_sep_line
+from src import aperture, convolution, zscore, peaks, plotting, render, instrument
+from src.columnar import save_columns, columnar_dir
+from src.incremental import Stage, code_hash
+from src.instrument import traced
+from src.results_index import write_run_manifest, FILE_MANIFEST
+from src.patch_result import PatchResult
 from src.classKDE_MWSatellite import KDE_MWSatellite
 from src.classPatchMWSatellite import PatchMWSatellite
-from src.plotting import visualize_2_panel, hist_2_panel
-from src.peaks import summarize_peaks_star_csv, summarize_peaks_pixel_csv
+from src.kernel_cache import KernelCache
+from src.star_store import StarStore
+from src.catalog_cache import CatalogCache
+from src.injection import InjectionRecovery, completeness
+from src.param_patch_candidate import s_above, match_fac
+from src.plotting import visualize_2_panel, hist_2_panel, sub_title
+from src.peaks import summarize_peaks_star_csv, summarize_peaks_candidate_csv
 
 
 np.seterr(divide='ignore', invalid='ignore')
 
+KERNELS = [POISSON_MAP]    # ['gaussian', POISSON_MAP] kernels of the plots and peaks
 
 
-def get_dir_name() -> str:
-    """ Get the name of results directory """
+
+def get_dir_name(gc_size: float, sigma1: float, root: str = "results") -> str:
+    """ Get the name of results directory of one scale """
     if DATABASE == 'gaia_dr2.gaia_source':
-        dir_name = "results/gaia_{}-G{}-{}".format(NAME, G_MAG_MIN, G_MAG_MAX)
+        dir_name = "{}/gaia_{}-G{}-{}".format(root, NAME, G_MAG_MIN, G_MAG_MAX)
     else:
-        dir_name = "results/{}_{}".format(DATABASE_SHORT, NAME)
+        dir_name = "{}/{}_{}".format(root, DATABASE_SHORT, NAME)
     dir_name = "{}-w{}-lp{}".format(dir_name, WIDTH, PIXEL_SIZE)
-    dir_name = "{}-gc{}s{}s{}s{}".format(dir_name, GC_SIZE, SIGMA1, SIGMA2, SIGMA3)
+    dir_name = "{}-gc{}s{}s{}s{}".format(dir_name, gc_size, sigma1, SIGMA2, SIGMA3)
     return  dir_name
 
 
+def get_cube_dir_name() -> str:
+    """ Get the name of the directory of the significance cubes of all
+    scales. It is kept out of results/ which holds one directory per scale. """
+    gc_sizes = "_".join(str(gc_size) for gc_size in GC_SIZES)
+    return  get_dir_name(gc_sizes, min(SIGMA1S), root="cubes")
+
+
 def gaia_patch_gmag_cut_astro_noise_cut(patch: PatchMWSatellite):
     """ Query data and then apply G band cut and astro noise cut.
     This function just calls a few methods from PatchMWSatellite
@@ -35,60 +59,386 @@ def gaia_patch_gmag_cut_astro_noise_cut(patch: PatchMWSatellite):
     patch.mask_g_mag_astro_noise_cut()    # astrometric_excess_noise cut
 
 
-def execute_kde_routine(patch: PatchMWSatellite, kdepatch: KDE_MWSatellite):
-    kdepatch.np_hist2d(patch.datas['ra'], patch.datas['dec'])
+@traced()
+def apply_cuts(patch: PatchMWSatellite):
+    """ Apply the cuts based on surveys and the proper motion cut """
+    if DATABASE == 'gaia_dr2.gaia_source':
+        gaia_patch_gmag_cut_astro_noise_cut(patch)
+    elif DATABASE == 'panstarrs_dr1.stackobjectthin':
+        patch.mask_panstarrs_stargalaxy_sep()
+
+    if IS_PM_ERROR_CUT:
+        patch.mask_pm_error(PMRA_DWARF, PMDEC_DWARF, N_ERRORBAR)
+
+
+def push_cuts(patch: PatchMWSatellite):
+    """ Push the cuts of apply_cuts down into the sql query. apply_cuts is
+    still run after the query as a fallback, then it keeps every row. """
+    if DATABASE == 'gaia_dr2.gaia_source':
+        patch.where_cut("phot_g_mean_mag", G_MAG_MIN, G_MAG_MAX)
+        patch.where_g_mag_astro_noise_cut()
+    elif DATABASE == 'panstarrs_dr1.stackobjectthin':
+        patch.where_panstarrs_stargalaxy_sep()
+
+    if IS_PM_ERROR_CUT:
+        patch.where_pm_error(PMRA_DWARF, PMDEC_DWARF, N_ERRORBAR)
+
+
+@traced()
+def execute_kde_routine(patch: PatchMWSatellite, kdepatch: KDE_MWSatellite,
+                        is_hist2d: bool = False):
+    """ KDE calculation of the patch
+    : is_hist2d : True if hist2d has already been built, e.g. while streaming
+    """
+    if not is_hist2d:
+        kdepatch.np_hist2d(patch.datas['ra'], patch.datas['dec'])
     kdepatch.add_masks_on_pixels(RA_DWARF, DEC_DWARF, R_HALFLIGHT)
     kdepatch.compound_sig_gaussian()
     kdepatch.compound_sig_poisson()
+
+
+@traced(info=lambda patch, kdepatch, dir_name: {'dir': dir_name})
+def save_scale(patch: PatchMWSatellite, kdepatch: KDE_MWSatellite,
+               dir_name: str):
+    """ Save datas, sigs and meshgrids of the current scale of kdepatch """
     patch.append_sig_to_data(kdepatch.x_mesh, kdepatch.y_mesh,
-                             kdepatch.sig_gaussian, kdepatch.sig_poisson)
+                             kdepatch.sig_gaussian, kdepatch.sig_poisson, POISSON_MAP)
+    save_columns(dir_name, patch.datas, FILE_STAR)
+    np.save("{}/{}".format(dir_name, FILE_SIG_GAUSSIAN), kdepatch.sig_gaussian)
+    np.save("{}/{}".format(dir_name, FILE_SIG_POISSON), kdepatch.sig_poisson)
+    _meshs = np.array([kdepatch.x_mesh, kdepatch.y_mesh])
+    np.save("{}/{}".format(dir_name, FILE_MESH), _meshs)
 
 
+@traced()
+def save_cubes(kdepatch: KDE_MWSatellite, dir_name: str):
+    """ Save the significance cubes of all scales, indexed by scale """
+    np.save("{}/{}".format(dir_name, FILE_SIG_GAUSSIAN_CUBE),
+            kdepatch.sig_gaussian_cube)
+    np.save("{}/{}".format(dir_name, FILE_SIG_POISSON_CUBE),
+            kdepatch.sig_poisson_cube)
+    np.save("{}/{}".format(dir_name, FILE_SCALES),
+            np.array([GC_SIZES, SIGMA1S], dtype=float))
+    _meshs = np.array([kdepatch.x_mesh, kdepatch.y_mesh])
+    np.save("{}/{}".format(dir_name, FILE_MESH), _meshs)
 
-if __name__ == '__main__':
-    # create result directory
-    dir_name = get_dir_name()
-    create_dir(dir_name)
 
 
+@traced(info=lambda kdepatch, scale, dir_name: {'dir': dir_name})
+def run_injection(kdepatch: KDE_MWSatellite, scale: int, dir_name: str):
+    """ Injection-recovery of fake clusters on the star field of one scale,
+    saved as a csv of one row per cluster in its results directory """
+    injection = InjectionRecovery(kdepatch, scale, match_fac=match_fac, s_above=s_above,
+                                  valid_width=peaks.valid_width)
+    print(injection.__str__())
+    df = injection.run(INJECTION_N_STARS, N_INJECTION, INJECTION_BATCH, INJECTION_SEED)
+    df.to_csv("{}/{}.csv".format(dir_name, FILE_INJECTION), index=False)
+    print('Completeness of the Poisson kernel by number of stars: \n')
+    print(completeness(df, 'poisson'))
+
+
+
+def run_manifest(patch: PatchMWSatellite, kdepatch: KDE_MWSatellite,
+                 gc_size: float, sigma1: float, timings: dict) -> dict:
+    """ Manifest of the current scale of kdepatch: parameters, number of
+    stars, number of pixels above MANIFEST_THRESHOLDS and timings in s """
+    n_peaks = {}
+    for kernel, sig in [('gaussian', kdepatch.sig_gaussian), ('poisson', kdepatch.sig_poisson)]:
+        thresholds = MANIFEST_THRESHOLDS
+        if kernel == 'poisson' and Z_SCORE_MODE == 'threshold':    # nan below s_above
+            thresholds = [t for t in thresholds if t >= s_above]
+        n_peaks[kernel] = {str(t): int(np.sum(sig > t)) for t in thresholds}
+    return  {'name': NAME, 'database': DATABASE, 'database_short': DATABASE_SHORT,
+             'gc_size': gc_size, 'sigma1': sigma1, 'sigma2': SIGMA2, 'sigma3': SIGMA3,
+             'ra': float(RA), 'dec': float(DEC), 'width': WIDTH, 'pixel_size': PIXEL_SIZE,
+             'ra_dwarf': float(RA_DWARF), 'dec_dwarf': float(DEC_DWARF),
+             'r_halflight': float(R_HALFLIGHT), 'distance': DISTANCE,
+             'n_star': int(patch.n_source()), 'peaks': n_peaks, 'timings': timings,
+             'time': time.time()}
+
+
+def kde_inputs(gc_size: float, sigma1: float) -> dict:
+    """ Inputs of the query and the KDE of one scale: the query box, the
+    cuts, the catalog snapshot, the kernels and the code version """
+    patch = PatchMWSatellite(NAME, RA, DEC, DISTANCE, WIDTH, DATABASE, CATALOG_STR)
+    push_cuts(patch)    # the sql form of the cuts of apply_cuts
+    code = [inspect.getmodule(KDE_MWSatellite), inspect.getmodule(PatchMWSatellite),
+            aperture, convolution, zscore, inspect.getmodule(StarStore),
+            inspect.getmodule(save_columns),
+            gaia_patch_gmag_cut_astro_noise_cut, apply_cuts, push_cuts,
+            execute_kde_routine, save_scale]
+    return  {'database': DATABASE, 'snapshot': CATALOG_SNAPSHOT,
+             'columns': KEEP_COLUMNS if IS_STREAM else patch.catalog_list,
+             'box': patch.get_box(), 'cuts': patch.where_clauses,
+             'dwarf': [RA_DWARF, DEC_DWARF, R_HALFLIGHT],
+             'pixel_size': PIXEL_SIZE, 'gc_size': gc_size,
+             'sigmas': [sigma1, SIGMA2, SIGMA3], 'engine': KDE_ENGINE,
+             'pyramid': PYRAMID_SIGMA_GRID if IS_PYRAMID else None,
+             'sat_max_radius': APERTURE_SAT_MAX_RADIUS,
+             'z_score': [Z_SCORE_MODE, s_above], 'code': code_hash(code)}
+
+
+def new_dwarf_patch() -> PatchMWSatellite:
+    """ Patch of the union footprint of all the patches of the dwarf, with
+    the same pushed down cuts as each patch """
+    dwarf = PatchMWSatellite(NAME, RA_DWARF, DEC_DWARF, DISTANCE, DWARF_WIDTH,
+                             DATABASE, CATALOG_STR)
+    if IS_PUSHDOWN:
+        push_cuts(dwarf)
+    return  dwarf
+
+
+def dwarf_store_stage() -> Stage:
+    """ Stage of the star store of the dwarf, stamped in DWARF_STORE """
+    dwarf = new_dwarf_patch()
+    code = [inspect.getmodule(StarStore), inspect.getmodule(save_columns), push_cuts]
+    inputs = {'database': DATABASE, 'snapshot': CATALOG_SNAPSHOT,
+              'columns': dwarf.catalog_list, 'box': dwarf.get_box(),
+              'cuts': dwarf.where_clauses, 'cell': STORE_CELL, 'code': code_hash(code)}
+    return  Stage(DWARF_STORE, 'store', inputs, [columnar_dir(DWARF_STORE, 'star-store')])
+
+
+def build_dwarf_store(catalog_cache: CatalogCache = None):
+    """ Query the union footprint of the dwarf once and save its stars
+    sorted by cell (see StarStore) in DWARF_STORE, for all its patches.
+    Nothing is done while the store is fresh.
+
+    : catalog_cache : cache of query results shared by the patches of a process
+    """
+    stage = dwarf_store_stage()
+    if stage.is_fresh():
+        print('Skipping the store of {}: inputs unchanged \n'.format(DWARF_STORE))
+        return
+    if catalog_cache is None and CATALOG_CACHE_DIR is not None:
+        catalog_cache = CatalogCache(CATALOG_CACHE_DIR, CATALOG_CACHE_DISK_MB)
+
+    dwarf = new_dwarf_patch()
+    dwarf.sql_get(HOST, USER, PASSWORD, cache=catalog_cache, is_count=IS_COUNT_PUSHDOWN)
+    store = StarStore(dwarf.datas, STORE_CELL)
+    del dwarf
+    print(store.__str__())
+    store.save(DWARF_STORE)
+    stage.done()
+
+
+def patch_stages() -> dict:
+    """ Stages of the patch with the hash of their inputs: 'kde' (query and
+    KDE), 'peaks', 'plots' and 'injection' (if IS_INJECTION) of each scale,
+    stamped in the results directory of the scale, and 'cube' stamped in the
+    cube directory. They depend on the hash of the KDE of their scale.
+
+    : return : dict of lists of Stage objects, one per scale, and the cube Stage
+    """
+    stages = {'kde': [], 'peaks': [], 'plots': [], 'injection': []}
+    for gc_size, sigma1 in zip(GC_SIZES, SIGMA1S):
+        dir_name = get_dir_name(gc_size, sigma1)
+        fig_name = dir_name.replace("results/", "")
+        outputs = [columnar_dir(dir_name, FILE_STAR), "{}/{}".format(dir_name, FILE_MANIFEST)]
+        outputs += ["{}/{}.npy".format(dir_name, name) for name in
+                    [FILE_SIG_GAUSSIAN, FILE_SIG_POISSON, FILE_MESH]]
+        kde = Stage(dir_name, 'kde', kde_inputs(gc_size, sigma1), outputs)
+        stages['kde'].append(kde)
+
+        inputs = {'kde': kde.key, 'kernels': KERNELS, 'patch': [RA, DEC, WIDTH],
+                  'valid_width': peaks.valid_width, 'code': code_hash([peaks])}
+        outputs = ["peaks/{}/{}-{}.csv".format(kind, fig_name, k)
+                   for kind in ['stars', 'pixels', 'candidates'] for k in KERNELS]
+        stages['peaks'].append(Stage(dir_name, 'peaks', inputs, outputs))
+
+        inputs = {'kde': kde.key, 'kernels': KERNELS,
+                  'title': sub_title(gc_size, sigma1), 'n_star_max': PLOT_N_STAR_MAX,
+                  'code': code_hash([plotting, render])}
+        outputs = ["plots/{}/{}-{}.png".format(kind, fig_name, k)
+                   for kind in ['visual', 'hist'] for k in KERNELS]
+        stages['plots'].append(Stage(dir_name, 'plots', inputs, outputs))
+
+        if IS_INJECTION:
+            inputs = {'kde': kde.key, 'n_stars': INJECTION_N_STARS, 'n': N_INJECTION,
+                      'batch': INJECTION_BATCH, 'seed': INJECTION_SEED,
+                      'match': [match_fac, s_above], 'valid_width': peaks.valid_width,
+                      'code': code_hash([inspect.getmodule(InjectionRecovery)])}
+            outputs = ["{}/{}.csv".format(dir_name, FILE_INJECTION)]
+            stages['injection'].append(Stage(dir_name, 'injection', inputs, outputs))
+
+    cube_dir = get_cube_dir_name()
+    inputs = {'scales': [kde.key for kde in stages['kde']]}
+    outputs = ["{}/{}.npy".format(cube_dir, name) for name in
+               [FILE_SIG_GAUSSIAN_CUBE, FILE_SIG_POISSON_CUBE, FILE_SCALES, FILE_MESH]]
+    stages['cube'] = Stage(cube_dir, 'kde', inputs, outputs)
+    return  stages
+
+
+def is_patch_fresh(stages: dict = None) -> bool:
+    """ True if no stage of the patch needs to be run again """
+    if stages is None:
+        stages = patch_stages()
+    return  stages['cube'].is_fresh() and all(
+        stage.is_fresh() for name in ['kde', 'peaks', 'plots', 'injection']
+        for stage in stages[name])
+
+
+def new_kdepatch(kernel_cache: KernelCache = None) -> KDE_MWSatellite:
+    """ KDE_MWSatellite object of the patch set by the module level parameters """
+    if kernel_cache is None:
+        kernel_cache = KernelCache(KERNEL_CACHE_DIR, KERNEL_CACHE_MEM_MB,
+                                   KERNEL_CACHE_DISK_MB)
+    return  KDE_MWSatellite(RA, DEC, WIDTH, PIXEL_SIZE, SIGMA1S, SIGMA2, SIGMA3,
+                            R_HALFLIGHT, engine=KDE_ENGINE, cache=kernel_cache,
+                            pyramid=IS_PYRAMID, pyramid_sigma_grid=PYRAMID_SIGMA_GRID,
+                            sat_max_radius=APERTURE_SAT_MAX_RADIUS,
+                            z_score=Z_SCORE_MODE, s_above=s_above,
+                            fft_workers=FFT_WORKERS)
+
+
+def kdepatch_from_result(result: PatchResult,
+                         kernel_cache: KernelCache = None) -> KDE_MWSatellite:
+    """ KDE_MWSatellite object with the hist2d and the masks of the stars
+    saved in a results directory, e.g. when the KDE stage is skipped """
+    KDEPatch = new_kdepatch(kernel_cache)
+    stars = result.columns(['ra', 'dec'])
+    KDEPatch.np_hist2d(stars['ra'], stars['dec'])
+    KDEPatch.add_masks_on_pixels(RA_DWARF, DEC_DWARF, R_HALFLIGHT)
+    return  KDEPatch
+
+
+def run_kde(kernel_cache: KernelCache = None, catalog_cache: CatalogCache = None,
+            timings: dict = None) -> Tuple[PatchMWSatellite, KDE_MWSatellite]:
+    """ Query, cuts and KDE of the patch set by the module level parameters
+
+    : kernel_cache : cache of kernels shared by the patches of a process
+    : catalog_cache : cache of query results shared by the patches of a process
+    : timings : dict filled with the wall time of 'query' (with the cuts) and 'kde'
+    : return : the Patch and KDEPatch objects with the cubes of all scales
+    """
+    if timings is None:
+        timings = {}
+    t0 = time.time()
     print('Creating a Patch object for main KDE calcuation: \n')
     Patch = PatchMWSatellite(NAME, RA, DEC, DISTANCE, WIDTH, DATABASE, CATALOG_STR)
     print(Patch.__str__())
 
-    Patch.sql_get(HOST, USER, PASSWORD)    # query data
+    print('Creating a KDEPatch object for the KDE calcuation: \n')
+    KDEPatch = new_kdepatch(kernel_cache)
+    print(KDEPatch.__str__())
 
-    # cuts based on surveys
-    if DATABASE == 'gaia_dr2.gaia_source':
-        gaia_patch_gmag_cut_astro_noise_cut(Patch)
-    elif DATABASE == 'panstarrs_dr1.stackobjectthin':
-        Patch.mask_panstarrs_stargalaxy_sep()
+    if IS_PUSHDOWN:
+        push_cuts(Patch)
+
+    if IS_STREAM:
+        # cuts and hist2d chunk by chunk, only keep the columns used later
+        conn = sqlutilpy.getConnection(host=HOST, user=USER, password=PASSWORD,
+                                       driver='psycopg2')
+        Patch.sql_stream(conn, apply_cuts, KDEPatch, KEEP_COLUMNS, STREAM_CHUNK_SIZE)
+        conn.close()
+    else:
+        if catalog_cache is None and CATALOG_CACHE_DIR is not None:
+            catalog_cache = CatalogCache(CATALOG_CACHE_DIR, CATALOG_CACHE_DISK_MB)
+
+        if IS_DWARF_QUERY and dwarf_store_stage().is_fresh():
+            # stars of the dwarf sorted once by batch.py --dwarf_store, memory
+            # mapped: only the cells of the patch are read
+            store = StarStore.load(DWARF_STORE)
+            print(store.__str__())
+            Patch.store_get(store)    # slice data
+            del store
+        else:
+            if IS_DWARF_QUERY:
+                print('The store of {} is stale: querying the patch \n'.format(DWARF_STORE))
+            Patch.sql_get(HOST, USER, PASSWORD, cache=catalog_cache,
+                          is_count=IS_COUNT_PUSHDOWN)    # query data
+        if catalog_cache is not None:
+            print(catalog_cache.__str__())
+
+        apply_cuts(Patch)
+    Patch.print_cut_log()
+    timings['query'] = time.time() - t0
 
     Patch.append_is_inside(RA_DWARF, DEC_DWARF, R_HALFLIGHT)    # TODO add a factor here
 
     print_sep_line()
 
-    if IS_PM_ERROR_CUT:
-        Patch.mask_pm_error(PMRA_DWARF, PMDEC_DWARF, N_ERRORBAR)
+    print('Start the KDE calcuation: \n')
+    t0 = time.time()
+    execute_kde_routine(Patch, KDEPatch, is_hist2d=IS_STREAM)
+    timings['kde'] = time.time() - t0
 
-    print('Creating a KDEPatch object and start the KDE calcuation: \n')
-    KDEPatch = KDE_MWSatellite(RA, DEC, WIDTH, PIXEL_SIZE, SIGMA1, SIGMA2, SIGMA3, R_HALFLIGHT)
-    print(KDEPatch.__str__())
+    return  Patch, KDEPatch
 
-    execute_kde_routine(Patch, KDEPatch)
 
-    print('Saving datas, sigs, meshgrids ...')
-    np.save('{}/{}'.format(dir_name, FILE_STAR), Patch.datas)
-    np.save("{}/{}".format(dir_name, FILE_SIG_GAUSSIAN), KDEPatch.sig_gaussian)
-    np.save("{}/{}".format(dir_name, FILE_SIG_POISSON), KDEPatch.sig_poisson)
-    _meshs = np.array([KDEPatch.x_mesh, KDEPatch.y_mesh])
-    np.save("{}/{}".format(dir_name, FILE_MESH), _meshs)
-    print('Done =) \n')
-    print('Finished KDE calculation. \n')
-    print_sep_line()
-    print('Generating plots and tables ... \n')
+def run_patch(kernel_cache: KernelCache = None,
+              catalog_cache: CatalogCache = None):
+    """ Run the stages of the patch (see run_patch_stages), traced into
+    TRACE_DIR: one JSON line per stage with its time and memory.
 
-    # visualize searching results
-    fig_name = dir_name.replace("results/", "")
+    : kernel_cache : cache of kernels shared by the patches of a process
+    : catalog_cache : cache of query results shared by the patches of a process
+    """
+    if TRACE_DIR is None:
+        return  run_patch_stages(kernel_cache, catalog_cache)
+
+    trace_path = "{}/{}.jsonl".format(TRACE_DIR, os.path.basename(get_cube_dir_name()))
+    tracer = instrument.start(trace_path, NAME, IS_TRACEMALLOC, IS_PROFILE)
+    try:
+        with instrument.trace('run_patch'):
+            run_patch_stages(kernel_cache, catalog_cache)
+    finally:
+        print(tracer.__str__())
+        instrument.stop()
+
+
+def run_patch_stages(kernel_cache: KernelCache = None,
+                     catalog_cache: CatalogCache = None):
+    """ Query, KDE, plots and peaks of the patch set by the module level
+    parameters (see src.param.dwarf_params). With IS_INCREMENTAL, the stages
+    whose inputs are unchanged since the last run are skipped.
+
+    : kernel_cache : cache of kernels shared by the patches of a process
+    : catalog_cache : cache of query results shared by the patches of a process
+    """
+    stages = patch_stages()
+    kde_stages = [stages['cube']] + stages['kde']
+
+    if IS_INCREMENTAL and all(stage.is_fresh() for stage in kde_stages):
+        print('Skipping the query and the KDE calculation: inputs unchanged \n')
+        dir_names = [stage.dir_name for stage in stages['kde']]
+        results = [PatchResult.from_dir(dir_name) for dir_name in dir_names]
+        KDEPatch = None
+    else:
+        if IS_INCREMENTAL:
+            for stage in kde_stages:
+                changed = stage.changed()
+                changed = "no completed run" if changed is None else ", ".join(changed)
+                print('{} stage of {}: {}'.format(stage.name, stage.dir_name, changed))
+        timings = {}
+        Patch, KDEPatch = run_kde(kernel_cache, catalog_cache, timings)
+
+        print('Saving datas, sigs, meshgrids ...')
+        cube_dir = get_cube_dir_name()
+        create_dir("cubes")
+        create_dir(cube_dir)
+        save_cubes(KDEPatch, cube_dir)
+        stages['cube'].done()
+
+        dir_names, results = [], []
+        for scale, (gc_size, sigma1) in enumerate(zip(GC_SIZES, SIGMA1S)):
+            dir_name = get_dir_name(gc_size, sigma1)    # one directory per scale
+            create_dir(dir_name)
+            KDEPatch.select_scale(scale)
+            t0 = time.time()
+            save_scale(Patch, KDEPatch, dir_name)
+            write_run_manifest(dir_name, run_manifest(
+                Patch, KDEPatch, gc_size, sigma1, dict(timings, save=time.time() - t0)))
+            stages['kde'][scale].done()
+            dir_names.append(dir_name)
+            if IS_RELOAD_RESULTS:    # read the saved files back
+                results.append(PatchResult.from_dir(dir_name))
+            else:    # hand the live objects over
+                results.append(PatchResult.from_objects(Patch, KDEPatch, dir_name,
+                                                        POISSON_MAP))
+        print('Done =) \n')
+        print('Finished KDE calculation. \n')
+        print_sep_line()
+    print('Generating plots and tables ... \n')
 
     plot_dir = "plots"
     peaks_dir = "peaks"
@@ -102,19 +452,52 @@ if __name__ == '__main__':
 
     star_dir = "{}/stars".format(peaks_dir)
     pixel_dir = "{}/pixels".format(peaks_dir)
+    candidate_dir = "{}/candidates".format(peaks_dir)
     create_dir(star_dir)
     create_dir(pixel_dir)
+    create_dir(candidate_dir)
+
+    for scale, (gc_size, sigma1) in enumerate(zip(GC_SIZES, SIGMA1S)):
+        dir_name, result = dir_names[scale], results[scale]
+        fig_name = dir_name.replace("results/", "")
+        title = sub_title(gc_size, sigma1)
+
+        # visualize searching results
+        if IS_INCREMENTAL and stages['plots'][scale].is_fresh():
+            print('Skipping the plots of %s: inputs unchanged' % fig_name)
+        else:
+            for k in KERNELS:
+                visualize_2_panel(result, "{}/{}".format(visual_dir, fig_name), k,
+                                  title=title)
+                hist_2_panel(result, "{}/{}".format(hist_dir, fig_name), k,
+                             title=title)
+            stages['plots'][scale].done()
+
+        if IS_INCREMENTAL and stages['peaks'][scale].is_fresh():
+            print('Skipping the peaks of %s: inputs unchanged' % fig_name)
+        else:
+            _name_star = "{}/{}".format(star_dir, fig_name)
+            _name_pixel = "{}/{}".format(pixel_dir, fig_name)
+            _name_candidate = "{}/{}".format(candidate_dir, fig_name)
+            for k in KERNELS:
+                summarize_peaks_star_csv(result, _name_star, k)
+                summarize_peaks_candidate_csv(result, _name_candidate, k,
+                                              pixel_outfile=_name_pixel)
+            stages['peaks'][scale].done()
+
+        if IS_INJECTION:
+            if IS_INCREMENTAL and stages['injection'][scale].is_fresh():
+                print('Skipping the injections of %s: inputs unchanged' % fig_name)
+            else:
+                if KDEPatch is None:
+                    KDEPatch = kdepatch_from_result(result, kernel_cache)
+                run_injection(KDEPatch, scale, dir_name)
+                stages['injection'][scale].done()
 
-    _kernels = ['poisson']    # ['gaussian', 'poisson']
+    print("Done. \n")
+    print("We are finished :) \n")
 
-    for k in _kernels:
-        visualize_2_panel(dir_name, "{}/{}".format(visual_dir, fig_name), k)
-        hist_2_panel(dir_name, "{}/{}".format(hist_dir, fig_name), k)
 
-    _name_star = "{}/{}".format(star_dir, fig_name)
-    _name_pixel = "{}/{}".format(pixel_dir, fig_name)
-    summarize_peaks_star_csv(dir_name, _name_star, 'poisson')
-    summarize_peaks_pixel_csv(dir_name, _name_pixel, 'poisson', RA, DEC, WIDTH)
 
-    print("Done. \n")
-    print("We are finished :) \n")
+if __name__ == '__main__':
+    run_patch()
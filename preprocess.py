@@ -1,9 +1,15 @@
+import os
+import argparse
 import numpy as np
 import pandas as pd
 
-from typing import Dict
+from typing import Dict, List
 from src.tools import get_dic_list_npy, dist2
 from src.param_patch_candidate import PATCH_DIST, N_PATCH_MAX
+from src.param import (DATABASE, CATALOG_STR, CATALOG_CACHE_DIR, GC_SIZES,
+                       APERTURE_SAT_MAX_RADIUS, get_path_dwarfs, dwarf_params)
+from src.cost import patch_cost, patch_memory, expected_stars, num_grid
+from src.catalog_cache import CatalogCache
 
 
 
@@ -111,10 +117,60 @@ def expand_joint_dict(df: pd.DataFrame, is_pm: bool = False):
 
 
 
+def write_manifest(path_dwarfs: str, gc_sizes: List[int], outfile: str):
+    """ Job manifest of the patches of a dwarf list with their predicted
+    cost and memory, for longest-job-first and memory-aware scheduling.
+    The expected number of stars comes from the counts of the catalog
+    cache where a query covers the patch, else from a density model.
+
+    : path_dwarfs : path of the dwarf list used by main.py
+    : gc_sizes : sizes of globular clusters run for every patch
+    : outfile : path of the csv manifest
+    """
+    dwarfs_dict = np.load(path_dwarfs, allow_pickle=True).item()
+    cache = None
+    if CATALOG_CACHE_DIR is not None and os.path.exists(CATALOG_CACHE_DIR):
+        cache = CatalogCache(CATALOG_CACHE_DIR)
+    n_column = len(CATALOG_STR.split(","))
+
+    rows = []
+    for name in dwarfs_dict["GalaxyName"]:
+        params = dwarf_params(name, gc_sizes, dwarfs_dict)
+        width, pixel_size = params['WIDTH'], params['PIXEL_SIZE']
+        sigma3 = params['SIGMA3']
+        n_star, source = expected_stars(params['RA'], params['DEC'], width,
+                                        DATABASE, cache)
+        args = (width, pixel_size, params['SIGMA1S'], params['SIGMA2'], sigma3,
+                params['R_HALFLIGHT'], n_star)
+        rows.append({
+            'name': name, 'ra': params['RA'], 'dec': params['DEC'],
+            'gc_sizes': " ".join(str(gc_size) for gc_size in gc_sizes),
+            'width': width, 'pixel_size': pixel_size,
+            'sigma1_min': min(params['SIGMA1S']), 'sigma3': sigma3,
+            'num_grid': num_grid(width, pixel_size),
+            'n_star': n_star, 'n_star_source': source,
+            'cost': patch_cost(*args, sat_max_radius=APERTURE_SAT_MAX_RADIUS),
+            'memory_mb': patch_memory(*args, n_column=n_column,
+                                      sat_max_radius=APERTURE_SAT_MAX_RADIUS)})
+
+    df = pd.DataFrame(rows).sort_values('cost', ascending=False)
+    df.to_csv(outfile, index=False)
+    print("Wrote the manifest of %d patches: %s" % (len(df), outfile))
+
+
+
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Split the dwarfs into patches')
+    parser.add_argument('--gc_size_pc', type=int, nargs='+', default=GC_SIZES,
+                        help='Sizes of globular clusters for the job manifest')
+    args, _ = parser.parse_known_args()
 
     df_ori = pd.read_csv('dwarfs/ori-dwarfs.csv').drop(['Unnamed: 0'], axis=1)
     df_ori_pm = pd.read_csv('dwarfs/ori-dwarfs-pms.csv')
 
     expand_joint_dict(df_ori)
     expand_joint_dict(df_ori_pm, is_pm=True)
+
+    path_dwarfs = get_path_dwarfs()
+    write_manifest(path_dwarfs, args.gc_size_pc,
+                   path_dwarfs.replace("joint", "manifest").replace(".npy", ".csv"))
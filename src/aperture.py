@@ -0,0 +1,91 @@
+import numpy as np
+
+from typing import List, Tuple
+
+
+
+def disk_runs(radius: int) -> List[Tuple[int, int, int]]:
+    """ Decompose the circular kernel x**2 + y**2 <= radius**2 into row
+    spans, merging consecutive rows with the same half width into one
+    rectangle.
+
+    : radius : radius of the disk in pixels
+    : return : list of (dy_min, dy_max, half width) of each rectangle
+    """
+    dys = np.arange(-radius, radius + 1)
+    half_widths = np.floor(np.sqrt(radius**2 - dys**2)).astype(int)
+    # make floor(sqrt()) exact for perfect squares hit by rounding
+    half_widths[(half_widths + 1)**2 <= radius**2 - dys**2] += 1
+    half_widths[half_widths**2 > radius**2 - dys**2] -= 1
+
+    runs = []
+    start = 0
+    for k in range(1, len(dys) + 1):
+        if k == len(dys) or half_widths[k] != half_widths[start]:
+            runs.append((int(dys[start]), int(dys[k - 1]), int(half_widths[start])))
+            start = k
+    return  runs
+
+
+class ApertureSum(object):
+    def __init__(self, maps: np.ndarray, radius_max: int = 0):
+        """ Exact sums of a map of integer counts (e.g. hist2d) over circular
+        apertures centered on every pixel, using a summed-area table. The
+        table is padded by replicating its edges, so a rectangle partly
+        outside the map is clipped to it for free and every rectangle is a
+        sum of 4 shifted slices: O(pixels x radius) per disk, no FFT, no
+        padding to FFT sizes and no rounding noise.
+
+        : maps : maps of integer counts, e.g. hist2d
+        : radius_max : the largest radius expected, to pad only once
+        """
+        self.maps = maps
+        self.shape = maps.shape
+        self.pad = -1
+        self.grow(radius_max)
+
+    def grow(self, radius: int):
+        """ Pad the summed-area table for apertures up to 'radius' """
+        if radius <= self.pad:
+            return
+        counts = np.rint(self.maps)
+        dtype = np.int32 if np.sum(counts) < 2**31 - 1 else np.int64
+        sat = np.zeros((self.shape[0] + 1, self.shape[1] + 1), dtype=dtype)
+        sat[1:, 1:] = np.cumsum(np.cumsum(counts.astype(dtype), axis=0), axis=1)
+        self.pad = radius
+        self.sat = np.pad(sat, radius, mode='edge')
+
+    def columns(self, w: int) -> np.ndarray:
+        """ Row sums of the table over the columns [j - w, j + w] for every
+        padded row and every column j of the map """
+        nx = self.shape[1]
+        x0, x1 = self.pad - w, self.pad + w + 1
+        return  self.sat[:, x1:x1 + nx] - self.sat[:, x0:x0 + nx]
+
+    def disk(self, radius: int) -> np.ndarray:
+        """ Number count within the circular kernel of 'radius' pixels around
+        every pixel, identical to convolving with circular_kernel(radius).
+        The runs above and below the center share their half width, so
+        each half width costs one column difference and a few row slices.
+
+        : radius : radius of the disk in pixels
+        : return : integer maps of the number count
+        """
+        self.grow(radius)
+        ny, p = self.shape[0], self.pad
+        count = np.zeros(self.shape, dtype=self.sat.dtype)
+        for dy_min, dy_max, w in disk_runs(radius):
+            if dy_max < 0:    # the mirrored run below is added together
+                continue
+            cols = self.columns(w)
+            count += cols[p + dy_max + 1:p + dy_max + 1 + ny]
+            count -= cols[p + dy_min:p + dy_min + ny]
+            if dy_min > 0:    # mirrored run [-dy_max, -dy_min]
+                count += cols[p - dy_min + 1:p - dy_min + 1 + ny]
+                count -= cols[p - dy_max:p - dy_max + ny]
+        return  count
+
+    def annulus(self, radius_in: int, radius_out: int) -> np.ndarray:
+        """ Number count within the annulus radius_in < r <= radius_out,
+        identical to the annulus kernel of KDE_MWSatellite """
+        return  self.disk(radius_out) - self.disk(radius_in)
@@ -0,0 +1,192 @@
+import os
+import glob
+import json
+import shutil
+import hashlib
+import tempfile
+import numpy as np
+
+from typing import Dict, List, Tuple
+from src.tools import create_dir
+
+
+
+class CatalogCache(object):
+    def __init__(self, cache_dir: str = 'catalog-cache',
+                 max_disk_mb: float = 51200.):
+        """ Local cache of query results in front of the remote database.
+        Each query is stored in a directory named after the hash of
+        (database, columns, box, sql cuts), with one .npy file per column,
+        memory mapped when read, and a small meta.json. A box inside a
+        cached superset box with the same database, columns and cuts is cut
+        out of it without a new query. The least recently used entries are removed
+        beyond 'max_disk_mb'.
+
+        : cache_dir : directory of the cache
+        : max_disk_mb : size bound of the cache in MB
+        """
+        self.cache_dir = cache_dir
+        self.max_disk_bytes = int(max_disk_mb * 1024**2)
+        self.counts = {'hit': 0, 'superset': 0, 'miss': 0}
+        create_dir(self.cache_dir)
+
+    def __str__(self):
+        stats = self.stats()
+        s1 = "This is a CatalogCache object: \n"
+        s2 = "    cache dir = {}\n".format(self.cache_dir)
+        s3 = "    %d queries, %0.1f MB on disk\n" % (stats['n_entries'],
+                                                    stats['disk_mb'])
+        s4 = "    hits: %d exact, %d superset, %d missed" % (
+            self.counts['hit'], self.counts['superset'], self.counts['miss'])
+        return  "{}{}{}{}".format(s1, s2, s3, s4)
+
+    @staticmethod
+    def make_meta(database: str, columns: List[str],
+                  box: Tuple[float, float, float, float],
+                  where: List[str] = None) -> dict:
+        """ Description of a query: the columns of 'database' with
+        ra_min < ra < ra_max and dec_min < dec < dec_max and the pushed
+        down cuts of 'where' """
+        return  {'database': database, 'columns': list(columns),
+                 'box': [float(b) for b in box], 'where': list(where or [])}
+
+    def path(self, meta: dict) -> str:
+        """ Directory of a query in the cache, addressed by its content """
+        key = (meta['database'], tuple(meta['columns']), tuple(meta['box']))
+        if len(meta['where']) > 0:    # keep the address of queries without cuts
+            key = key + (tuple(meta['where']),)
+        name = hashlib.sha1(repr(key).encode()).hexdigest()
+        return  "{}/{}".format(self.cache_dir, name)
+
+    def entries(self) -> List[Tuple[str, dict]]:
+        """ Directory and meta of every cached query """
+        entries = []
+        for meta_file in glob.glob("{}/*/meta.json".format(self.cache_dir)):
+            try:
+                with open(meta_file) as f:
+                    entries.append((os.path.dirname(meta_file), json.load(f)))
+            except (IOError, ValueError):    # removed or being written
+                continue
+        return  entries
+
+    @staticmethod
+    def is_superset(meta: dict, query: dict) -> bool:
+        """ Check if a cached query holds every row and column of 'query' """
+        b, q = meta['box'], query['box']
+        return  (meta['database'] == query['database']
+                 and meta.get('where', []) == query['where']
+                 and set(query['columns']) <= set(meta['columns'])
+                 and {'ra', 'dec'} <= set(meta['columns'])
+                 and b[0] <= q[0] and q[1] <= b[1]
+                 and b[2] <= q[2] and q[3] <= b[3])
+
+    def load(self, entry_dir: str, columns: List[str]) -> Dict[str, np.ndarray]:
+        """ Memory map the columns of a cached query """
+        datas = {}
+        for column in columns:
+            datas[column] = np.load("{}/{}.npy".format(entry_dir, column),
+                                    mmap_mode='r')
+        os.utime("{}/meta.json".format(entry_dir), None)    # recently used
+        return  datas
+
+    def get(self, database: str, columns: List[str],
+            box: Tuple[float, float, float, float],
+            where: List[str] = None) -> Dict[str, np.ndarray]:
+        """ Get the result of a box query from the cache.
+
+        : database : database queried
+        : columns : names of the queried columns
+        : box : (ra_min, ra_max, dec_min, dec_max) in deg
+        : where : sql cuts of the query, a superset must have the same cuts
+        : return : dict of columns, None if no cached query covers it
+        """
+        query = self.make_meta(database, columns, box, where)
+        entry_dir = self.path(query)
+        try:
+            datas = self.load(entry_dir, columns)
+            self.counts['hit'] += 1
+            return  datas
+        except (IOError, ValueError):
+            pass
+
+        ra_min, ra_max, dec_min, dec_max = query['box']
+        for entry_dir, meta in self.entries():
+            if not self.is_superset(meta, query):
+                continue
+            try:
+                datas = self.load(entry_dir, set(columns) | {'ra', 'dec'})
+            except (IOError, ValueError):    # evicted by another job
+                continue
+            ra, dec = datas['ra'], datas['dec']
+            mask = (ra_min < ra) & (ra < ra_max) & (dec_min < dec) & (dec < dec_max)
+            self.counts['superset'] += 1
+            return  {column: datas[column][mask] for column in columns}
+
+        self.counts['miss'] += 1
+        return  None
+
+    def put(self, database: str, columns: List[str],
+            box: Tuple[float, float, float, float], datas: Dict[str, np.ndarray],
+            where: List[str] = None):
+        """ Store the result of a box query. The entry is written to a
+        temporary directory and renamed, so concurrent jobs never read a
+        partial entry.
+
+        : database : database queried
+        : columns : names of the queried columns
+        : box : (ra_min, ra_max, dec_min, dec_max) in deg
+        : datas : dict of the queried columns
+        : where : sql cuts of the query
+        """
+        meta = self.make_meta(database, columns, box, where)
+        meta['n_rows'] = len(datas[columns[0]])
+        entry_dir = self.path(meta)
+        if os.path.exists(entry_dir):
+            return
+
+        tmp = tempfile.mkdtemp(dir=self.cache_dir, suffix='.tmp')
+        for column in columns:
+            np.save("{}/{}.npy".format(tmp, column), np.asarray(datas[column]))
+        with open("{}/meta.json".format(tmp), 'w') as f:
+            json.dump(meta, f)
+        try:
+            os.rename(tmp, entry_dir)
+        except OSError:    # written by another job in the meantime
+            shutil.rmtree(tmp, ignore_errors=True)
+        self.evict()
+
+    @staticmethod
+    def entry_size(entry_dir: str) -> int:
+        """ Size of a cached query in bytes """
+        size = 0
+        for path in glob.glob("{}/*".format(entry_dir)):
+            try:
+                size += os.stat(path).st_size
+            except OSError:
+                pass
+        return  size
+
+    def evict(self):
+        """ Remove the least recently used queries beyond max_disk_bytes """
+        entries = []
+        for entry_dir, _ in self.entries():
+            try:
+                mtime = os.stat("{}/meta.json".format(entry_dir)).st_mtime
+            except OSError:    # removed by another job
+                continue
+            entries.append((mtime, self.entry_size(entry_dir), entry_dir))
+
+        total = sum(e[1] for e in entries)
+        for _, size, entry_dir in sorted(entries):
+            if total <= self.max_disk_bytes:
+                break
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            total -= size
+
+    def stats(self) -> Dict[str, float]:
+        """ Hit counts and size of the cache """
+        stats = dict(self.counts)
+        sizes = [self.entry_size(entry_dir) for entry_dir, _ in self.entries()]
+        stats['n_entries'] = len(sizes)
+        stats['disk_mb'] = sum(sizes) / 1024**2
+        return  stats
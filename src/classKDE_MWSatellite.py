@@ -1,9 +1,15 @@
-import time
 import numpy as np
 
 from typing import Tuple
 from src.param import *
 from src.tools import dist2
+from src.convolution import SharedSpectrumConvolver, edge_normalization, fast_shape
+from src.convolution import support_box, embed_full
+from src.convolution import block_sum, block_count, linear_upsample, same_shift
+from src.kernel_cache import KernelCache, DEFAULT_KERNEL_CACHE
+from src.aperture import ApertureSum
+from src.zscore import PoissonZScore, DEFAULT_POISSON_Z_SCORE
+from src.instrument import traced
 from scipy.stats import poisson
 from scipy.special import erfcinv
 from scipy.signal import fftconvolve, gaussian
@@ -11,7 +17,12 @@ from scipy.signal import fftconvolve, gaussian
 
 class KDE_MWSatellite(object):
     def __init__(self, ra_center: float, dec_center: float, width: float,
-            ps: float, sigma1: float, sigma2: float, sigma3: float, rh: float):
+            ps: float, sigma1, sigma2: float, sigma3: float, rh: float,
+            engine: str = 'spectrum', cache: KernelCache = None,
+            pyramid: bool = False, pyramid_sigma_grid: float = 8.,
+            sat_max_radius: int = 16, z_score: str = 'exact',
+            s_above: float = 5., z_table: PoissonZScore = None,
+            fft_workers: int = 1):
         """ Kernel Density Estimation on a PatchMWSatellite object. This class
         contains 2 kernels: Gaussian and Poisson.
 
@@ -19,29 +30,62 @@ class KDE_MWSatellite(object):
         : dec_center : dec of the center of the patch in deg
         : width : width of the patch in deg
         : ps : size of pixel in deg
-        : sigma1 : target kernel size in deg: GCs
+        : sigma1 : target kernel size in deg: GCs, or a list of them to get
+                   a significance cube indexed by scale in one run
         : sigma2 : background kernel size inside the satellite in deg
         : sigma3 : background kernel size outside the satellite in deg
         : rh : half-light radius in deg
+        : engine : 'spectrum' to transform each map once and share it among
+                   all kernels, or 'fft' for one fftconvolve per kernel
+        : cache : KernelCache for kernels, kernel spectra and edge
+                  normalizations, default: the cache shared by the process
+        : pyramid : convolve wide Gaussian kernels on a binned grid
+        : pyramid_sigma_grid : min kernel size in pixels of the binned grid
+        : sat_max_radius : max aperture radius in pixels counted with the
+                           summed-area table, larger ones use the FFT
+        : z_score : Poisson z-score evaluation: 'exact', 'table' (tabulated
+                    and interpolated) or 'threshold' (exact only for pixels
+                    which can reach s_above, nan elsewhere)
+        : s_above : significance threshold used by 'table' and 'threshold'
+        : z_table : PoissonZScore table, default: the one shared by the process
+        : fft_workers : threads of each FFT of the 'spectrum' engine, -1 for
+                        all the cores
         """
         self.ra_center = ra_center
         self.dec_center = dec_center
         self.width = width
         self.pixel_size = ps
-        self.sigma1 = sigma1
+        self.sigma1s = [float(s) for s in np.atleast_1d(sigma1)]
+        self.scale = 0    # index of the current scale in sigma1s
+        self.sigma1 = self.sigma1s[self.scale]
         self.sigma2 = sigma2
         self.sigma3 = sigma3
         self.rh = rh
+        self.engine = engine
+        self.cache = DEFAULT_KERNEL_CACHE if cache is None else cache
+        self.pyramid = pyramid
+        self.pyramid_sigma_grid = pyramid_sigma_grid
+        self.sat_max_radius = sat_max_radius
+        self.z_score = z_score
+        self.s_above = s_above
+        self.z_table = DEFAULT_POISSON_Z_SCORE if z_table is None else z_table
+        self.fft_workers = fft_workers
 
         self.num_grid = round(self.width / self.pixel_size)
         self.x_mesh = self.grid_coord(self.ra_center)
         self.y_mesh = self.grid_coord(self.dec_center)
 
+        self.truncate = 5    # TODO: parameterize it later
+        self.convolvers = {}    # forward FFTs of the maps of this patch by padded shape
+        self.apertures = {}    # summed-area tables of the maps of this patch
+        self.disk_counts = {}    # large aperture counts shared by all scales
+
     def __str__(self):
         s1 = "This is a KDE_MWSatellite object: \n"
         s2 = "    pixel size = %0.8f\n" % self.pixel_size
         s3 = "    number of grids = %d\n" % self.num_grid
-        s4 = "    sigma1 = %0.8f deg\n" % self.sigma1
+        s4 = "    sigma1 = %s deg\n" % ", ".join(
+            "%0.8f" % sigma1 for sigma1 in self.sigma1s)
         s5 = "    sigma2 inside the satellite = %0.8f deg\n" % self.sigma2
         s6 = "    sigma2 outside the satellite = %0.8f deg\n" % self.sigma3
         s7 = "    rh = %0.8f deg" % self.rh
@@ -57,6 +101,7 @@ class KDE_MWSatellite(object):
         _max = center + 0.5 * self.width
         return np.linspace(_min, _max, num=self.num_grid, endpoint=True)
 
+    @traced(attr='hist2d')
     def np_hist2d(self, ra: np.ndarray, dec: np.ndarray):
         """ Get histogram 2d for the star distribution on the mesh
         : ra : PatchMWSatellite.datas['ra']
@@ -64,8 +109,33 @@ class KDE_MWSatellite(object):
         """
         self.hist2d, _, _ = np.histogram2d(
             dec, ra, bins=(self.y_mesh, self.x_mesh))
+        self.convolvers = {}
+        self.apertures = {}
+        self.disk_counts = {}
         print('Added hist2d according to the sources on the patch.')
 
+    def np_hist2d_reset(self):
+        """ Start an empty hist2d to be filled chunk by chunk """
+        self.hist2d = np.zeros((len(self.y_mesh) - 1, len(self.x_mesh) - 1))
+        self.convolvers = {}
+        self.apertures = {}
+        self.disk_counts = {}
+
+    @traced(attr='hist2d')
+    def np_hist2d_add(self, ra: np.ndarray, dec: np.ndarray):
+        """ Add a chunk of sources to hist2d, e.g. while streaming a query.
+        The sum over chunks is identical to np_hist2d of all the sources.
+        : ra : ra of the chunk
+        : dec : dec of the chunk
+        """
+        if not hasattr(self, 'hist2d'):
+            self.np_hist2d_reset()
+        hist2d, _, _ = np.histogram2d(dec, ra, bins=(self.y_mesh, self.x_mesh))
+        self.hist2d += hist2d
+        self.convolvers = {}
+        self.apertures = {}
+        self.disk_counts = {}
+
     def add_masks_on_pixels(self, ra_df: float, dec_df: float, radius: float):
         """ Get histogram 2d for the star distribution on the mesh
 
@@ -79,11 +149,18 @@ class KDE_MWSatellite(object):
         y2d = 0.5 * (y2d[1:, 1:] + y2d[:-1, :-1])
         _dist2 = dist2(x2d, y2d, ra_df, dec_df)
         self.is_inside_dwarf = _dist2 < radius**2
+        for name in ['hist2d_inside', 'is_inside_dwarf']:    # maps using the mask
+            self.apertures.pop(name, None)
+        self.convolvers = {k: v for k, v in self.convolvers.items()
+                           if k[0] not in ['hist2d_inside', 'is_inside_dwarf']}
+        self.disk_counts = {k: v for k, v in self.disk_counts.items()
+                            if k[0] == 'hist2d'}
         print('Added a mask array telling if pixels are inside the dwarf. \n')
         self.is_overlap = _dist2 < (radius + self.sigma3)**2
         self.is_overlap = self.is_overlap & (~self.is_inside_dwarf)
         print('Added a mask array telling if pixels overlap the dwarf and the outer aperture. \n')
 
+    @traced()
     def fftconvolve_boundary_adjust(
             self, maps_ori: np.ndarray, kernel: np.ndarray) -> np.ndarray:
         """ Use scipy signal fftconvolve to calculate the convolved map.
@@ -103,14 +180,132 @@ class KDE_MWSatellite(object):
         conv[conv < 1e-15] = 0.    # rounding the noise < 1e-15
         return conv
 
+    def kernel(self, key: tuple) -> np.ndarray:
+        """ Get a kernel from its key through the kernel cache """
+        return  self.cache.get(('kernel',) + key, lambda: self.build_kernel(key))
+
+    def kernel_shape(self, key: tuple) -> Tuple[int, int]:
+        """ Shape of the kernel of 'key' without building it """
+        if key[0] == 'gaussian':
+            n = int(key[2] * key[1])
+        else:
+            n = 2 * key[-1] + 1
+        return  n, n
+
+    def build_kernel(self, key: tuple) -> np.ndarray:
+        """ Build a kernel from its key:
+        ('gaussian', s_grid, truncate), ('disk', radius) or
+        ('annulus', radius_in, radius_out), all in units of pixels.
+        """
+        if key[0] == 'gaussian':
+            _, s_grid, truncate = key
+            kernel_grid = int(truncate * s_grid)
+            _gaussian = gaussian(kernel_grid, s_grid)
+            return  np.outer(_gaussian, _gaussian) / 2. * np.pi * s_grid**2
+        if key[0] == 'disk':
+            return  self.circular_kernel(key[1])
+        if key[0] == 'annulus':
+            _, s_grid_in, s_grid_out = key
+            kernel_out = self.circular_kernel(s_grid_out)
+            ds_pad = s_grid_out - s_grid_in
+            kernel_in_pad = np.pad(self.circular_kernel(s_grid_in),
+                                   ds_pad, 'constant', constant_values=0)
+            return  kernel_out - kernel_in_pad
+        raise ValueError('Wrong kernel key: %s' % str(key))
+
+    def spectrum_convolver(self, name: str, maps: np.ndarray,
+                           kernel_shape: Tuple[int, int]) -> SharedSpectrumConvolver:
+        """ Forward FFT of 'maps' padded for a kernel of 'kernel_shape'. 'name'
+        identifies the map, e.g. 'hist2d'. The transform is computed once per
+        patch and padded shape, so kernels whose padded shapes coincide share
+        it while small kernels are not padded for the largest one. """
+        fshape = fast_shape(maps.shape, kernel_shape)
+        if (name, fshape) not in self.convolvers:
+            self.convolvers[(name, fshape)] = SharedSpectrumConvolver(
+                maps, fshape, self.fft_workers)
+        return  self.convolvers[(name, fshape)]
+
+    @traced(info=lambda self, name, maps, key: {'map': name, 'kernel': key})
+    def convolve_boundary_adjust(self, name: str, maps: np.ndarray,
+                                 key: tuple) -> np.ndarray:
+        """ Same as fftconvolve_boundary_adjust but the forward FFT of the
+        map is shared among kernels, while the kernel spectrum and the
+        analytic edge normalization come from the kernel cache.
+
+        : name : name of the map, e.g. 'hist2d'
+        : maps : original maps matrix
+        : key : kernel key, see self.kernel()
+        : return : convolved maps with non negative values
+        """
+        if self.engine == 'fft':
+            return  self.fftconvolve_boundary_adjust(maps, self.kernel(key))
+
+        kernel_shape = self.kernel_shape(key)
+        convolver = self.spectrum_convolver(name, maps, kernel_shape)
+        spectrum = self.cache.get(
+            ('spectrum', maps.shape, convolver.fshape) + key,
+            lambda: convolver.kernel_spectrum(self.kernel(key)))
+        norm = self.cache.get(
+            ('edge_norm', maps.shape) + key,
+            lambda: edge_normalization(maps.shape, self.kernel(key)))
+
+        conv = convolver.convolve(spectrum, kernel_shape)
+        conv /= norm
+        conv[conv < 1e-15] = 0.    # rounding the noise < 1e-15
+        return conv
+
+    def pyramid_factor(self, s_grid: float) -> int:
+        """ Binning factor for a Gaussian kernel of s_grid pixels such that
+        the kernel is still pyramid_sigma_grid pixels on the binned grid.
+        1 means full resolution. """
+        if not self.pyramid:
+            return  1
+        return  max(1, int(s_grid // self.pyramid_sigma_grid))
+
+    def overdensity_pyramid(self, s_grid: float, factor: int) -> np.ndarray:
+        """ Overdensity with a wide Gaussian kernel computed on hist2d binned
+        down by 'factor', then interpolated back to the fine grid.
+
+        Error bound, with h = factor / s_grid <= 1 / pyramid_sigma_grid:
+        binning convolves the map with a box of factor pixels, which widens
+        the kernel by a relative (h**2 / 12) / 2, and bilinear interpolation
+        of a map smoothed on s_grid deviates by at most h**2 / 8 of its
+        local peak. With the default pyramid_sigma_grid = 8 the sum stays
+        below 0.3% of the local density.
+
+        : s_grid : kernel size in pixels of the fine grid
+        : factor : binning factor
+        : return : convolved maps on the fine grid
+        """
+        key = ('gaussian', s_grid / factor, self.truncate)
+        name = 'hist2d_bin%d' % factor
+        hist_c = block_sum(self.hist2d, factor)
+        conv = self.convolve_boundary_adjust(name, hist_c, key)
+
+        count_y = block_count(self.hist2d.shape[0], factor)
+        count_x = block_count(self.hist2d.shape[1], factor)
+        if np.all(count_y == factor) and np.all(count_x == factor):
+            conv /= factor**2    # every block is full: mean per fine pixel
+        else:    # partial blocks at the edges
+            area = self.convolve_boundary_adjust(
+                'ones_bin%d' % factor, np.outer(count_y, count_x), key)
+            conv = np.divide(conv, area, out=np.zeros_like(conv),
+                             where=area != 0)
+        # reproduce the half pixel offset of even sized kernels on the fine grid
+        key_fine = ('gaussian', s_grid, self.truncate)
+        shift = same_shift(self.kernel_shape(key_fine)[0])
+        shift -= factor * same_shift(self.kernel_shape(key)[0])
+        return  linear_upsample(conv, factor, self.hist2d.shape, shift)
+
+    @traced(info=lambda self, sigma: {'sigma': sigma})
     def overdensity(self, sigma: float) -> np.ndarray:
         """ Convolved overdensity maps with a Gaussian kernel size sigma """
         s_grid = sigma / self.pixel_size
-        truncate = 5    # TODO: parameterize it later
-        kernel_grid = int(truncate * s_grid)
-        _gaussian = gaussian(kernel_grid, s_grid)
-        kernel = np.outer(_gaussian, _gaussian) / 2. * np.pi * s_grid**2
-        return self.fftconvolve_boundary_adjust(self.hist2d, kernel)
+        factor = self.pyramid_factor(s_grid)
+        if factor > 1:
+            return  self.overdensity_pyramid(s_grid, factor)
+        key = ('gaussian', s_grid, self.truncate)
+        return self.convolve_boundary_adjust('hist2d', self.hist2d, key)
 
     def get_sig_gaussian(self, od_1: np.ndarray, od_2: np.ndarray,
                          sigma1: float, sigma2: float) -> np.ndarray:
@@ -126,29 +321,51 @@ class KDE_MWSatellite(object):
         return np.divide(sig, np.sqrt(od_2),
                          out=np.zeros_like(sig), where=od_2 != 0)  # force 0/0 = 0
 
+    def select_scale(self, scale: int):
+        """ Point sigma1, sig_gaussian and sig_poisson to one scale of the
+        significance cubes.
+        : scale : index in sigma1s
+        """
+        self.scale = scale
+        self.sigma1 = self.sigma1s[scale]
+        if hasattr(self, 'sig_gaussian_cube'):
+            self.sig_gaussian = self.sig_gaussian_cube[scale]
+        if hasattr(self, 'sig_poisson_cube'):
+            self.sig_poisson = self.sig_poisson_cube[scale]
+
+    @traced(attr='sig_gaussian_cube')
     def compound_sig_gaussian(self):
         """ Compound the Gaussian significance map: s12 inside (s23 > sigma_th)
-        and s13 outside (s23 < sigma_th) """
-        t0 = time.time()
-
-        od_1 = self.overdensity(self.sigma1)
+        and s13 outside (s23 < sigma_th). The background maps are shared by
+        all the scales in sigma1s. """
         od_2 = self.overdensity(self.sigma2)
         od_3 = self.overdensity(self.sigma3)
-        s12 = self.get_sig_gaussian(od_1, od_2, self.sigma1, self.sigma2)
-        s13 = self.get_sig_gaussian(od_1, od_3, self.sigma1, self.sigma3)
 
-        self.sig_gaussian = s12 * self.is_inside_dwarf + s13 * (~self.is_inside_dwarf)
-        print("Took %0.4fs to calculate Gaussian sig." % (time.time() - t0))
+        sigs = []
+        for sigma1 in self.sigma1s:
+            od_1 = self.overdensity(sigma1)
+            s12 = self.get_sig_gaussian(od_1, od_2, sigma1, self.sigma2)
+            s13 = self.get_sig_gaussian(od_1, od_3, sigma1, self.sigma3)
+            sigs.append(s12 * self.is_inside_dwarf + s13 * (~self.is_inside_dwarf))
+
+        self.sig_gaussian_cube = np.array(sigs)
+        self.sig_gaussian = self.sig_gaussian_cube[self.scale]
         print('Added sig_gaussian to the KDE_MWSatellite object. \n')
 
+    @traced()
     def z_score_poisson(self, lamb: np.ndarray, x: np.ndarray) -> np.ndarray:
         """ Calculate the z-score of the tail probability of poisson via N(0, 1)
         according to z = sqrt(2) * erfinv(1 - 2 * sf(x, lambda)), where sf
-        (survival function) = 1 - CDF.
+        (survival function) = 1 - CDF. See self.z_score for the evaluation
+        modes.
         : lamb : expected background number count from outer aperture (lambda)
         : x : number count of observed stars in the inner aperture
         : return : z-score of poisson map
         """
+        if self.z_score == 'table':
+            return  self.z_table(lamb, x, s_exact=self.s_above)
+        if self.z_score == 'threshold':
+            return  self.z_table.threshold(lamb, x, self.s_above)
         return np.sqrt(2.) * erfcinv(2. * poisson.sf(x, lamb))
 
     def circular_kernel(self, radius: int) -> np.ndarray:
@@ -161,19 +378,102 @@ class KDE_MWSatellite(object):
         kernel[mask] = 1
         return kernel
 
+    @traced(info=lambda self, name, *args, **kwargs: {'map': name})
+    def aperture_count(self, name: str, maps: np.ndarray,
+                       key: tuple) -> np.ndarray:
+        """ Exact number count of 'maps' within the disk or annulus aperture
+        of 'key' around every pixel. An annulus is the difference of two
+        disks. Small disks are summed with a summed-area table, large ones
+        are convolved through the shared spectrum and rounded, which is
+        exact because the FFT noise is far below 0.5 count. Large disks are
+        kept for the patch since they do not depend on sigma1.
+
+        : name : name of the map, e.g. 'hist2d'
+        : maps : maps of integer counts
+        : key : ('disk', radius) or ('annulus', radius_in, radius_out)
+        : return : maps of integer number counts
+        """
+        if key[0] == 'annulus':
+            return  (self.aperture_count(name, maps, ('disk', key[2]))
+                     - self.aperture_count(name, maps, ('disk', key[1])))
+
+        radius = key[1]
+        if radius <= self.sat_max_radius:
+            if name not in self.apertures:
+                self.apertures[name] = ApertureSum(maps, self.sat_max_radius)
+            return  self.apertures[name].disk(radius).astype(float)
+
+        if (name, radius) not in self.disk_counts:
+            self.disk_counts[(name, radius)] = np.rint(
+                self.disk_convolve(name, maps, key))
+        return  self.disk_counts[(name, radius)]
+
+    def disk_convolve(self, name: str, maps: np.ndarray,
+                      key: tuple) -> np.ndarray:
+        """ Convolve 'maps' with a large disk through a forward FFT padded
+        for this disk only. A map which is zero outside of a small box, e.g.
+        the stars inside the dwarf, is cut to the box before the FFT. """
+        kernel_shape = self.kernel_shape(key)
+        box = support_box(maps)
+        if box is None:
+            return  np.zeros(maps.shape)
+        crop = maps[box]
+        if np.prod(fast_shape(crop.shape, kernel_shape)) >= np.prod(
+                fast_shape(maps.shape, kernel_shape)):
+            convolver = self.spectrum_convolver(name, maps, kernel_shape)
+            spectrum = self.cache.get(
+                ('spectrum', maps.shape, convolver.fshape) + key,
+                lambda: convolver.kernel_spectrum(self.kernel(key)))
+            return  convolver.convolve(spectrum, kernel_shape)
+
+        convolver = self.spectrum_convolver(name, crop, kernel_shape)
+        spectrum = self.cache.get(
+            ('spectrum', crop.shape, convolver.fshape) + key,
+            lambda: convolver.kernel_spectrum(self.kernel(key)))
+        full = convolver.convolve_full(spectrum, kernel_shape)
+        return  embed_full(full, box, kernel_shape, maps.shape)
+
+    def aperture_area(self, key: tuple) -> float:
+        """ Number of pixels of a disk or annulus aperture """
+        if key[0] == 'annulus':
+            return  (self.aperture_area(('disk', key[2]))
+                     - self.aperture_area(('disk', key[1])))
+        return  np.sum(self.kernel(key))
+
+    def aperture_edge_area(self, shape: Tuple[int, int],
+                           key: tuple) -> np.ndarray:
+        """ Number of pixels of a disk or annulus aperture inside the patch """
+        if key[0] == 'annulus':
+            return  (self.aperture_edge_area(shape, ('disk', key[2]))
+                     - self.aperture_edge_area(shape, ('disk', key[1])))
+        return  self.cache.get(
+            ('edge_norm', shape) + key,
+            lambda: edge_normalization(shape, self.kernel(key)))
+
+    def edge_adjust_count(self, count: np.ndarray, key: tuple,
+                          norm_kernel: float) -> np.ndarray:
+        """ Scale the number count of apertures crossing the edge of the
+        patch to the full aperture area, as fftconvolve_boundary_adjust
+        does. Away from the edges the count is left untouched. """
+        area = self.aperture_edge_area(count.shape, key)
+        return  count * (norm_kernel / area)
+
     def poisson_inner_number_count(self,
                                    sigma: float) -> Tuple[np.ndarray, float]:
         """ Calculate inner number count of stars within the area of radius
-        of sigma, using convolution.
+        of sigma, using exact aperture counts (convolution if engine='fft').
         : return : convolved maps (number count of the inner aperture)
         : return : number of pixels of the inner aperture
         """
         s_grid = sigma / self.pixel_size
-        kernel = self.circular_kernel(round(s_grid))
-        norm_kernel = np.sum(kernel)
-        conv = self.fftconvolve_boundary_adjust(self.hist2d,
-                                                (kernel / norm_kernel))
-        return conv * norm_kernel, norm_kernel
+        key = ('disk', int(round(s_grid)))
+        norm_kernel = self.aperture_area(key)
+        if self.engine == 'fft':
+            conv = self.convolve_boundary_adjust('hist2d', self.hist2d, key)
+            return conv * norm_kernel, norm_kernel
+
+        count = self.aperture_count('hist2d', self.hist2d, key)
+        return self.edge_adjust_count(count, key, norm_kernel), norm_kernel
 
     def poisson_outer_expected_background(self, sigma_in: float,
             sigma_out: float, is_overlap: bool = False) -> Tuple[np.ndarray, float]:
@@ -187,24 +487,35 @@ class KDE_MWSatellite(object):
         """
         s_grid_in = int(round(sigma_in / self.pixel_size))
         s_grid_out = int(round(sigma_out / self.pixel_size))
-        kernel_out = self.circular_kernel(s_grid_out)
-        ds_pad = s_grid_out - s_grid_in
-        kernel_in_pad = np.pad(self.circular_kernel(s_grid_in),
-                               ds_pad, 'constant', constant_values=0)
-        kernel = kernel_out - kernel_in_pad
-        norm_kernel = np.sum(kernel)
+        key = ('annulus', s_grid_in, s_grid_out)
+        norm_kernel = self.aperture_area(key)
 
-        if is_overlap:
-            conv = self.fftconvolve_boundary_adjust(
-                (self.hist2d * (~self.is_inside_dwarf)), (kernel / norm_kernel))
-            area_overlap = self.fftconvolve_boundary_adjust(
-                self.is_inside_dwarf, (kernel / norm_kernel))
-            area_overlap = norm_kernel * area_overlap
-            return conv * norm_kernel, norm_kernel - area_overlap
+        if self.engine == 'fft':
+            if is_overlap:
+                conv = self.convolve_boundary_adjust(
+                    'hist2d_outside', (self.hist2d * (~self.is_inside_dwarf)), key)
+                area_overlap = self.convolve_boundary_adjust(
+                    'is_inside_dwarf', self.is_inside_dwarf.astype(float), key)
+                area_overlap = norm_kernel * area_overlap
+                return conv * norm_kernel, norm_kernel - area_overlap
+
+            conv = self.convolve_boundary_adjust('hist2d', self.hist2d, key)
+            return conv * norm_kernel, norm_kernel
 
-        conv = self.fftconvolve_boundary_adjust(
-            self.hist2d, (kernel / norm_kernel))
-        return conv * norm_kernel, norm_kernel
+        if is_overlap:
+            # stars outside of the dwarf: all of them but the few inside,
+            # whose map is counted on its bounding box only
+            count = (self.aperture_count('hist2d', self.hist2d, key)
+                     - self.aperture_count(
+                         'hist2d_inside', self.hist2d * self.is_inside_dwarf, key))
+            area_overlap = self.aperture_count(
+                'is_inside_dwarf', self.is_inside_dwarf.astype(float), key)
+            area_overlap = self.edge_adjust_count(area_overlap, key, norm_kernel)
+            return (self.edge_adjust_count(count, key, norm_kernel),
+                    norm_kernel - area_overlap)
+
+        count = self.aperture_count('hist2d', self.hist2d, key)
+        return self.edge_adjust_count(count, key, norm_kernel), norm_kernel
 
     def get_lambda_poisson(self, n_o: np.ndarray, area_o: np.ndarray,
                            area_i: np.ndarray) -> np.ndarray:
@@ -216,21 +527,21 @@ class KDE_MWSatellite(object):
         """
         return n_o * area_i / area_o
 
-    def compound_sig_poisson(self):
-        """ Compound the Poisson significance map: s12 inside (s23 > sigma_th)
-        and s13 outside (s23 < sigma_th)
+    def poisson_expected_background(self, sigma1: float,
+                                    area_inner: float) -> Tuple[np.ndarray, np.ndarray]:
+        """ Expected background number count in the inner aperture of sigma1
+        from the outer apertures: lambda_in with sigma2 inside the dwarf and
+        lambda_out with sigma3 outside of it
+        : sigma1 : target kernel size in deg
+        : area_inner : number of pixels of the inner aperture
+        : return : lambda_in and lambda_out maps
         """
-        t0 = time.time()
-
         # factors using for outer aperture
         f_in2out = 2.    # r_i = f_in2out * s1
-        rh_th = 10. * self.sigma1    # threshold of min half-light radius in deg
-
-        # inner aperture
-        n_inner, area_inner = self.poisson_inner_number_count(self.sigma1)
+        rh_th = 10. * sigma1    # threshold of min half-light radius in deg
 
         # outer aperture outside of the dwarf
-        r_i = f_in2out * self.sigma1
+        r_i = f_in2out * sigma1
         r_o = self.sigma3
         n_outer, area_outer = self.poisson_outer_expected_background(r_i, r_o)
 
@@ -251,12 +562,31 @@ class KDE_MWSatellite(object):
                 r_i, r_o)
             lambda_in = self.get_lambda_poisson(
                 n_outer, area_outer, area_inner)
+        return  lambda_in, lambda_out
+
+    @traced(info=lambda self, sigma1: {'sigma1': sigma1})
+    def sig_poisson_scale(self, sigma1: float) -> np.ndarray:
+        """ Compound the Poisson significance map of one scale: s12 inside
+        (s23 > sigma_th) and s13 outside (s23 < sigma_th)
+        : sigma1 : target kernel size in deg
+        : return : Poisson significance map
+        """
+        n_inner, area_inner = self.poisson_inner_number_count(sigma1)
+        lambda_in, lambda_out = self.poisson_expected_background(sigma1, area_inner)
 
         s12 = self.z_score_poisson(lambda_in, n_inner)
         s13 = self.z_score_poisson(lambda_out, n_inner)
 
-        self.sig_poisson = s12 * self.is_inside_dwarf + s13 * (~self.is_inside_dwarf)
-        print("Took %0.4fs to calculate Poisson sig." % (time.time() - t0))
+        # where, not a weighted sum: nan or inf of the unused map must not leak
+        return  np.where(self.is_inside_dwarf, s12, s13)
+
+    @traced(attr='sig_poisson_cube')
+    def compound_sig_poisson(self):
+        """ Compound the Poisson significance maps of all the scales in
+        sigma1s. The large outer apertures are counted once and shared. """
+        sigs = [self.sig_poisson_scale(sigma1) for sigma1 in self.sigma1s]
+        self.sig_poisson_cube = np.array(sigs)
+        self.sig_poisson = self.sig_poisson_cube[self.scale]
         print('Added sig_poisson to the KDE_MWSatellite object. \n')
 
     #     self.bg_estimate = lambda_in * self.is_inside_dwarf + \
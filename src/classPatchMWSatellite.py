@@ -1,7 +1,13 @@
 import numpy as np
 import sqlutilpy
 
+from typing import Callable, List, Tuple
+from collections import OrderedDict
 from src.tools import dist2
+from src.star_store import StarStore
+from src.lazy_datas import LazyDatas
+from src.catalog_cache import CatalogCache
+from src.instrument import traced
 
 
 
@@ -26,7 +32,10 @@ class PatchMWSatellite(object):
         self.database = database
         self.catalog_str = catalog_str
         self.catalog_list = catalog_str.replace("\n", "").replace(" ", "").split(",")
-        self.datas = {}
+        self.datas = LazyDatas({})
+        self.cut_log = OrderedDict()    # number of survivors of each cut
+        self.verbose = True    # print the number of sources after each cut
+        self.where_clauses = []    # cuts pushed down into the sql query
 
     def __str__(self):
         str1 = "This is a PatchMWSatellite object:\n"
@@ -38,55 +47,196 @@ class PatchMWSatellite(object):
 
     def n_source(self) -> int:
         """ Calculate the number of stars in the patch """
-        return  len(self.datas[self.catalog_list[0]])
+        return  self.datas.n_rows()
 
-    def sql_get(self, host: str, user: str, password: str):
-        """ Query 'catalog_str' from 'database' using sqlutilpy.get() """
+    def get_box(self) -> Tuple[float, float, float, float]:
+        """ Box of the patch: (ra_min, ra_max, dec_min, dec_max) in deg """
         ra_min = self.ra_sat - 0.5 * self.width
         ra_max = self.ra_sat + 0.5 * self.width
         dec_min = self.dec_sat - 0.5 * self.width
         dec_max = self.dec_sat + 0.5 * self.width
+        return  ra_min, ra_max, dec_min, dec_max
 
-        query_str = """
-                    select {} from {}
-                    where {} < ra and ra < {} and {} < dec and dec < {}
-                    """.format(self.catalog_str, self.database,
-                               ra_min, ra_max, dec_min, dec_max)
+    def get_query_str(self, columns: str = None) -> str:
+        """ SQL query of the patch: the box and the pushed down cuts
+
+        : columns : selected columns, default catalog_str
+        """
+        ra_min, ra_max, dec_min, dec_max = self.get_box()
+        if columns is None:
+            columns = self.catalog_str
+        where = "{} < ra and ra < {} and {} < dec and dec < {}".format(
+            ra_min, ra_max, dec_min, dec_max)
+        for clause in self.where_clauses:
+            where = "{} and {}".format(where, clause)
+        return  """
+                select {} from {}
+                where {}
+                """.format(columns, self.database, where)
+
+    def sql_count(self, host: str, user: str, password: str,
+                  is_pushdown: bool = True) -> int:
+        """ Count the rows of the query on the server, without transfer
+
+        : is_pushdown : False to count the box without the pushed down cuts
+        """
+        where_clauses = self.where_clauses
+        if not is_pushdown:
+            self.where_clauses = []
+        query_str = self.get_query_str("count(*)")
+        self.where_clauses = where_clauses
+        count, = sqlutilpy.get(query_str, host=host, user=user, password=password)
+        return  int(count[0])
+
+    @traced(attr='datas')
+    def sql_get(self, host: str, user: str, password: str,
+                cache: CatalogCache = None, is_count: bool = False):
+        """ Query 'catalog_str' from 'database' using sqlutilpy.get()
+
+        : cache : local cache of query results, None to always query
+        : is_count : report the number of rows without the pushed down cuts
+        """
+        box = self.get_box()
+
+        if cache is not None:
+            datas = cache.get(self.database, self.catalog_list, box,
+                              self.where_clauses)
+            if datas is not None:
+                self.datas = LazyDatas(datas)
+                print("Loaded data in the patch from the catalog cache:")
+                print("    %d sources are loaded \n"  %self.n_source())
+                return
+
+        if is_count and len(self.where_clauses) > 0:
+            n_box = self.sql_count(host, user, password, is_pushdown=False)
+            print("    %d rows in the patch before pushdown" % n_box)
 
         print("Querying data in the patch using sqlutilpy.get():")
-        datas = sqlutilpy.get(query_str,
+        datas = sqlutilpy.get(self.get_query_str(),
                               host=host, user=user, password=password)
 
         # update 'datas' dic to store queried data
-        for i, catalog in enumerate(self.catalog_list):
-            self.datas[catalog] = datas[i]
+        self.datas = LazyDatas({catalog: datas[i]
+                                for i, catalog in enumerate(self.catalog_list)})
         print("    %d sources are queried \n"  %self.n_source())
 
-    def cut_datas(self, mask: np.ndarray):
-        """ Cut datas based on the mask. """
-        for key, column in self.datas.items():
-            self.datas[key] = column[mask]
+        if cache is not None:
+            cache.put(self.database, self.catalog_list, box, self.datas,
+                      self.where_clauses)
 
+    @traced(attr='datas')
+    def store_get(self, store: StarStore):
+        """ Slice the patch out of the stars queried once for the whole
+        dwarf, instead of querying the database again.
+
+        : store : StarStore of a box containing the patch
+        """
+        self.datas = LazyDatas(store.query_box(self.get_box()))
+        print("Sliced data in the patch from the dwarf StarStore:")
+        print("    %d sources are sliced \n"  %self.n_source())
+
+    @traced(attr='datas')
+    def sql_stream(self, conn, cuts: Callable = None, kdepatch=None,
+                   keep_columns: List[str] = None, chunk_size: int = 1000000):
+        """ Query 'catalog_str' from 'database' through a server-side cursor
+        and process the rows chunk by chunk: the cuts are applied to each
+        chunk, the survivors are added to the histogram of 'kdepatch' and
+        only 'keep_columns' are kept. Peak memory is bounded by chunk_size
+        and the survivors, instead of every queried star.
+
+        : conn : database connection, e.g. sqlutilpy.getConnection() or sqlite3
+        : cuts : function applying the mask methods to a patch, e.g.
+                 lambda patch: patch.mask_panstarrs_stargalaxy_sep()
+        : kdepatch : KDE_MWSatellite object whose hist2d is built on the fly
+        : keep_columns : columns kept after the cuts, None to keep all
+        : chunk_size : number of rows fetched at a time
+        """
+        query_str = self.get_query_str()
+
+        try:
+            cursor = conn.cursor(name='patch_stream')    # server-side cursor
+            cursor.itersize = chunk_size
+        except TypeError:    # e.g. sqlite3 has no named cursors
+            cursor = conn.cursor()
+        cursor.execute(query_str)
+
+        if keep_columns is None:
+            keep_columns = self.catalog_list
+        if kdepatch is not None:
+            kdepatch.np_hist2d_reset()
+
+        print("Streaming data in the patch by chunks of %d rows:" % chunk_size)
+        kept = {column: [] for column in keep_columns}
+        n_query, verbose = 0, self.verbose
+        self.verbose = False
+        try:
+            while True:
+                rows = cursor.fetchmany(chunk_size)
+                if len(rows) == 0:
+                    break
+                n_query += len(rows)
+                columns = zip(*rows)
+                self.datas = LazyDatas({catalog: np.array(column, dtype=float)
+                                        for catalog, column in zip(self.catalog_list, columns)})
+                if cuts is not None:
+                    cuts(self)
+                if kdepatch is not None:
+                    kdepatch.np_hist2d_add(self.datas['ra'], self.datas['dec'])
+                for column in keep_columns:
+                    kept[column].append(self.datas[column])
+        finally:
+            self.verbose = verbose
+            cursor.close()
+
+        self.datas = LazyDatas({column: np.concatenate(chunks) if len(chunks) > 0
+                                else np.zeros(0) for column, chunks in kept.items()})
+        print("    %d sources are queried" % n_query)
+        print("    %d sources are left after the cuts \n" % self.n_source())
+
+    def cut_datas(self, mask: np.ndarray, name: str = 'cut'):
+        """ Cut datas based on the mask. The cut is only composed into the
+        selection of self.datas, no column is copied here.
+
+        : mask : boolean mask of the surviving sources
+        : name : name of the cut in cut_log
+        """
+        self.datas.select(mask)
+        self.cut_log[name] = self.cut_log.get(name, 0) + self.n_source()
+
+    def print_cut_log(self):
+        """ Print the number of survivors of each cut, summed over chunks """
+        print("Number of sources surviving each cut:")
+        for name, n_survivor in self.cut_log.items():
+            print("    %s: %d" % (name, n_survivor))
+        print("")
+
+    @traced(info=lambda self, catalog, *args: {'catalog': catalog}, attr='datas')
     def mask_cut(self, catalog: str, min_val: float, max_val: float):
         """ Cut the data with a min and a max value """
-        print("Applying a cut: {} < {} < {}:".format(min_val, catalog, max_val))
+        if self.verbose:
+            print("Applying a cut: {} < {} < {}:".format(min_val, catalog, max_val))
         maskleft = min_val < self.datas[catalog]
         maskright = self.datas[catalog] < max_val
         mask = maskleft & maskright
-        self.cut_datas(mask)
-        print("    %d sources left \n"  %self.n_source())
+        self.cut_datas(mask, catalog)
+        if self.verbose:
+            print("    %d sources left \n"  %self.n_source())
 
+    @traced(attr='datas')
     def mask_g_mag_astro_noise_cut(self):
         """ Hard code the astrometric_excess_noise and phot_g_mean_mag cut """
-        print("Applying astrometric_excess_noise and phot_g_mean_mag cut.")
+        if self.verbose:
+            print("Applying astrometric_excess_noise and phot_g_mean_mag cut.")
         noise = self.datas["astrometric_excess_noise"]
         g_mag = self.datas["phot_g_mean_mag"]
         maskleft = (g_mag <= 18.) & (noise < np.exp(1.5))
         maskright = (18. < g_mag) & (noise < np.exp(1.5 + 0.3 * (g_mag - 18.)))
         mask = maskleft | maskright
-        self.cut_datas(mask)
-        print("    %d sources left \n"  %self.n_source())
+        self.cut_datas(mask, "astrometric_excess_noise")
+        if self.verbose:
+            print("    %d sources left \n"  %self.n_source())
 
+    @traced(attr='datas')
     def mask_pm_error(self, pmra0: float, pmdec0: float, n_error: int):
         """ Hard code the pm cut: dist(pm, pm_dwarf) < n_error * pm_error
 
@@ -94,23 +244,51 @@ class PatchMWSatellite(object):
         : pmdec0 : pmdec of the dwarf
         : n_error : select sources withing n_error errorbar
         """
-        print("Applying proper motion cut with %d" % n_error)
+        if self.verbose:
+            print("Applying proper motion cut with %d" % n_error)
         pmdist = dist2(self.datas['pmra'], self.datas['pmdec'], pmra0, pmdec0)
         pmdist = np.sqrt(pmdist)
         pmerror = dist2(self.datas['pmra_error'], self.datas['pmdec_error'], 0, 0)
         pmerror = np.sqrt(pmerror)
         mask = pmdist <= n_error * pmerror
-        self.cut_datas(mask)
-        print("    %d sources left \n"  %self.n_source())
+        self.cut_datas(mask, "pm_error")
+        if self.verbose:
+            print("    %d sources left \n"  %self.n_source())
 
+    @traced(attr='datas')
     def mask_panstarrs_stargalaxy_sep(self):
         """ Hard code the star galaxy separation """
-        print("Applying star galaxy separation: (rpsfmag - rkronmag) < 0.05")
+        if self.verbose:
+            print("Applying star galaxy separation: (rpsfmag - rkronmag) < 0.05")
         rpsfmag = self.datas["rpsfmag"]
         rkronmag = self.datas["rkronmag"]
         mask = (rpsfmag - rkronmag) < 0.05
-        self.cut_datas(mask)
-        print("    %d sources left \n"  %self.n_source())
+        self.cut_datas(mask, "stargalaxy_sep")
+        if self.verbose:
+            print("    %d sources left \n"  %self.n_source())
+
+    def where_cut(self, catalog: str, min_val: float, max_val: float):
+        """ Push mask_cut down into the sql query """
+        self.where_clauses.append("{!r} < {} and {} < {!r}".format(
+            float(min_val), catalog, catalog, float(max_val)))
+
+    def where_g_mag_astro_noise_cut(self):
+        """ Push mask_g_mag_astro_noise_cut down into the sql query """
+        self.where_clauses.append(
+            "((phot_g_mean_mag <= 18. and astrometric_excess_noise < {!r}) or "
+            "(18. < phot_g_mean_mag and astrometric_excess_noise < "
+            "exp(1.5 + 0.3 * (phot_g_mean_mag - 18.))))".format(float(np.exp(1.5))))
+
+    def where_pm_error(self, pmra0: float, pmdec0: float, n_error: int):
+        """ Push mask_pm_error down into the sql query """
+        self.where_clauses.append(
+            "sqrt((pmra - ({!r}))^2 + (pmdec - ({!r}))^2) <= "
+            "{!r} * sqrt(pmra_error^2 + pmdec_error^2)".format(
+                float(pmra0), float(pmdec0), float(n_error)))
+
+    def where_panstarrs_stargalaxy_sep(self):
+        """ Push mask_panstarrs_stargalaxy_sep down into the sql query """
+        self.where_clauses.append("rpsfmag - rkronmag < 0.05")
 
     def append_is_inside(self, ra_df: float, dec_df: float, radius: float):
         """ Assign a boolean value to specify if a source is in the area
@@ -124,8 +302,11 @@ class PatchMWSatellite(object):
         self.datas['is_inside'] = np.array(_dist2 < radius ** 2)
         print('Appended a boolean array telling is_inside. \n')
 
-    def append_sig_to_data(self, x_mesh, y_mesh, sig_gaussian, sig_poisson):
-        """ Append significance of each star to the datas """
+    def append_sig_to_data(self, x_mesh, y_mesh, sig_gaussian, sig_poisson,
+                           poisson_name: str = 'poisson'):
+        """ Append significance of each star to the datas
+        : poisson_name : the column is 'sig_{poisson_name}', e.g. 'poisson_threshold'
+        """
         pixel_size_x = np.max(np.diff(x_mesh))
         pixel_size_y = np.max(np.diff(y_mesh))
         id_xs = (self.datas["ra"] - x_mesh[0]) / pixel_size_x
@@ -142,4 +323,4 @@ class PatchMWSatellite(object):
 
         # self.datas["is_inside"] = np.array(is_insides)
         self.datas["sig_gaussian"] = np.array(sig_gaussian_stars)
-        self.datas["sig_poisson"] = np.array(sig_poisson_stars)
+        self.datas["sig_{}".format(poisson_name)] = np.array(sig_poisson_stars)
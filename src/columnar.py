@@ -0,0 +1,71 @@
+import os
+import json
+import numpy as np
+
+from typing import Dict, List
+
+
+
+def columnar_dir(path: str, name: str = 'queried-data') -> str:
+    """ Directory of the columnar table 'name' in a results directory """
+    return  "{}/{}".format(path, name)
+
+
+def save_columns(path: str, datas: Dict[str, np.ndarray],
+                 name: str = 'queried-data'):
+    """ Save a table as one raw .npy file per column plus a small
+    header.json, instead of one pickled dict. Readers memory map only the
+    columns they need.
+
+    : path : results directory
+    : datas : dict of columns
+    : name : name of the table
+    """
+    table_dir = columnar_dir(path, name)
+    os.makedirs(table_dir, exist_ok=True)
+    header = {'n_rows': 0, 'columns': {}}
+    for key, column in datas.items():
+        column = np.asarray(column)
+        np.save("{}/{}.npy".format(table_dir, key), column)
+        header['n_rows'] = len(column)
+        header['columns'][key] = column.dtype.str
+    with open("{}/header.json".format(table_dir), 'w') as f:
+        json.dump(header, f)
+
+
+def load_header(path: str, name: str = 'queried-data') -> dict:
+    """ Header of a table: number of rows and dtype of each column. Old
+    results with a pickled '{name}.npy' are read as a fallback. """
+    table_dir = columnar_dir(path, name)
+    if os.path.exists("{}/header.json".format(table_dir)):
+        with open("{}/header.json".format(table_dir)) as f:
+            return  json.load(f)
+    datas = np.load("{}/{}.npy".format(path, name), allow_pickle=True).item()
+    n_rows = len(next(iter(datas.values()))) if len(datas) > 0 else 0
+    return  {'n_rows': n_rows,
+             'columns': {key: np.asarray(column).dtype.str
+                         for key, column in datas.items()}}
+
+
+def load_columns(path: str, columns: List[str] = None,
+                 name: str = 'queried-data') -> Dict[str, np.ndarray]:
+    """ Load the columns of a table, memory mapped so only the bytes read
+    are loaded. Old results with a pickled '{name}.npy' are read as a
+    fallback.
+
+    : path : results directory
+    : columns : names of the needed columns, None for all
+    : name : name of the table
+    : return : dict of columns
+    """
+    table_dir = columnar_dir(path, name)
+    if not os.path.exists("{}/header.json".format(table_dir)):
+        datas = np.load("{}/{}.npy".format(path, name), allow_pickle=True).item()
+        if columns is None:
+            return  datas
+        return  {key: datas[key] for key in columns}
+
+    if columns is None:
+        columns = list(load_header(path, name)['columns'])
+    return  {key: np.load("{}/{}.npy".format(table_dir, key), mmap_mode='r')
+             for key in columns}
@@ -0,0 +1,200 @@
+import numpy as np
+
+from typing import Tuple
+from scipy import fft
+
+
+
+def fast_shape(shape: Tuple[int, int],
+               kernel_shape: Tuple[int, int]) -> Tuple[int, int]:
+    """ Get the padded FFT shape which holds the full linear convolution of
+    a map of 'shape' with any kernel not larger than 'kernel_shape'.
+
+    : shape : shape of the map
+    : kernel_shape : shape of the largest kernel
+    : return : FFT friendly padded shape
+    """
+    return  tuple(fft.next_fast_len(int(n + k - 1), real=True)
+                  for n, k in zip(shape, kernel_shape))
+
+
+def same_slices(shape: Tuple[int, int],
+                kernel_shape: Tuple[int, int]) -> Tuple[slice, slice]:
+    """ Slices cutting the 'same' part out of a full convolution, exactly
+    as scipy.signal.fftconvolve(mode='same') does.
+
+    : shape : shape of the map
+    : kernel_shape : shape of the kernel
+    : return : slices along y and x
+    """
+    return  tuple(slice((k - 1) // 2, (k - 1) // 2 + n)
+                  for n, k in zip(shape, kernel_shape))
+
+
+def support_box(maps: np.ndarray) -> Tuple[slice, slice]:
+    """ Bounding box of the nonzero pixels of a map, None if all are zero """
+    rows = np.flatnonzero(maps.any(axis=1))
+    cols = np.flatnonzero(maps.any(axis=0))
+    if len(rows) == 0:
+        return  None
+    return  slice(rows[0], rows[-1] + 1), slice(cols[0], cols[-1] + 1)
+
+
+def embed_full(full: np.ndarray, box: Tuple[slice, slice],
+               kernel_shape: Tuple[int, int],
+               shape: Tuple[int, int]) -> np.ndarray:
+    """ 'same' convolution of a map which is zero outside of 'box', given
+    the full convolution of the map cut to the box.
+
+    : full : full convolution of maps[box] with the kernel
+    : box : slices of the map holding all its nonzero pixels
+    : kernel_shape : shape of the kernel
+    : shape : shape of the map
+    : return : convolved map, same as fftconvolve(maps, kernel, mode='same')
+    """
+    conv = np.zeros(shape)
+    dst, src = [], []
+    for sl, k, n, f in zip(box, kernel_shape, shape, full.shape):
+        lo = sl.start - (k - 1) // 2    # pixel of the map at full[0]
+        a, b = max(lo, 0), min(lo + f, n)
+        dst.append(slice(a, b))
+        src.append(slice(a - lo, b - lo))
+    conv[tuple(dst)] = full[tuple(src)]
+    return  conv
+
+
+def _edge_ranges(n: int, k: int) -> Tuple[np.ndarray, np.ndarray]:
+    """ Range [lo, hi) of kernel elements landing inside a grid of n pixels
+    for each output pixel of a 'same' convolution with a kernel of size k.
+    """
+    off = (k - 1) // 2
+    i = np.arange(n)
+    lo = np.clip(i + off - n + 1, 0, k)
+    hi = np.clip(i + off + 1, 0, k)
+    return  lo, hi
+
+
+def edge_normalization(shape: Tuple[int, int], kernel: np.ndarray) -> np.ndarray:
+    """ Analytic version of fftconvolve(np.ones(shape), kernel, mode='same').
+    Each output pixel is the sum of the kernel elements falling inside the
+    grid, which is a rectangle of the kernel. It is read off from the
+    summed-area table of the kernel, so no FFT is needed and there is no
+    rounding noise.
+
+    : shape : shape of the map
+    : kernel : kernel matrix
+    : return : normalization map of the edge effect
+    """
+    sat = np.zeros((kernel.shape[0] + 1, kernel.shape[1] + 1))
+    sat[1:, 1:] = np.cumsum(np.cumsum(kernel, axis=0), axis=1)
+    lo_y, hi_y = _edge_ranges(shape[0], kernel.shape[0])
+    lo_x, hi_x = _edge_ranges(shape[1], kernel.shape[1])
+    return  (sat[np.ix_(hi_y, hi_x)] - sat[np.ix_(lo_y, hi_x)]
+             - sat[np.ix_(hi_y, lo_x)] + sat[np.ix_(lo_y, lo_x)])
+
+
+def block_sum(maps: np.ndarray, factor: int) -> np.ndarray:
+    """ Bin a map down by summing blocks of factor x factor pixels. The map
+    is padded with zeros when its shape is not a multiple of factor.
+
+    : maps : original maps matrix
+    : factor : binning factor
+    : return : binned maps
+    """
+    ny, nx = maps.shape
+    nyc, nxc = -(-ny // factor), -(-nx // factor)
+    padded = np.zeros((nyc * factor, nxc * factor))
+    padded[:ny, :nx] = maps
+    return  padded.reshape(nyc, factor, nxc, factor).sum(axis=(1, 3))
+
+
+def block_count(n: int, factor: int) -> np.ndarray:
+    """ Number of valid pixels in each block of size factor along an axis """
+    nc = -(-n // factor)
+    return  np.minimum(factor, n - factor * np.arange(nc)).astype(float)
+
+
+def _linear_weights(n: int, factor: int,
+                    shift: float) -> Tuple[np.ndarray, np.ndarray]:
+    """ Index of the lower neighbour and linear weight of the upper neighbour
+    on the binned grid for each of the n pixels of the fine grid. Binned
+    pixel k sits at the center of its (possibly padded) block, moved by
+    'shift' fine pixels. Values beyond the first and last binned pixels are
+    extrapolated linearly.
+    """
+    nc = -(-n // factor)
+    if nc == 1:
+        return  np.zeros(n, dtype=int), np.zeros(n)
+    t = (np.arange(n) - shift - 0.5 * (factor - 1)) / factor
+    i0 = np.clip(np.floor(t).astype(int), 0, nc - 2)
+    return  i0, t - i0
+
+
+def same_shift(kernel_size: int) -> float:
+    """ Offset in pixels of a 'same' convolution: an even sized kernel has
+    its center between pixels, so output pixel i holds the smoothed map
+    at position i - 0.5. """
+    return  0.5 * ((kernel_size + 1) % 2)
+
+
+def linear_upsample(coarse: np.ndarray, factor: int, shape: Tuple[int, int],
+                    shift: float = 0.) -> np.ndarray:
+    """ Interpolate a binned map back to the fine grid, bilinearly and one
+    axis at a time so that no full size coordinate arrays are needed.
+
+    : coarse : binned maps
+    : factor : binning factor used by block_sum
+    : shape : shape of the fine grid
+    : shift : offset of the binned pixels in fine pixels, e.g. to match the
+              same_shift of the kernels used on both grids
+    : return : maps on the fine grid
+    """
+    iy, wy = _linear_weights(shape[0], factor, shift)
+    ix, wx = _linear_weights(shape[1], factor, shift)
+    rows = coarse[np.minimum(iy, coarse.shape[0] - 1)] * (1. - wy)[:, None]
+    rows += coarse[np.minimum(iy + 1, coarse.shape[0] - 1)] * wy[:, None]
+    fine = rows[:, np.minimum(ix, coarse.shape[1] - 1)] * (1. - wx)
+    fine += rows[:, np.minimum(ix + 1, coarse.shape[1] - 1)] * wx
+    return  fine
+
+
+class SharedSpectrumConvolver(object):
+    def __init__(self, maps: np.ndarray, fshape: Tuple[int, int],
+                 workers: int = 1):
+        """ Forward FFT of a map on the padded shape 'fshape', computed once
+        and reused for the convolution with every kernel which fits in it,
+        see fast_shape.
+
+        : maps : the map to be convolved, e.g. hist2d
+        : fshape : padded shape of the FFT
+        : workers : threads of scipy.fft, -1 for all the cores
+        """
+        self.shape = maps.shape
+        self.fshape = fshape
+        self.workers = workers
+        self.spectrum = fft.rfftn(maps, self.fshape, workers=self.workers)
+
+    def kernel_spectrum(self, kernel: np.ndarray) -> np.ndarray:
+        """ Forward FFT of the kernel on the padded shape """
+        return  fft.rfftn(kernel, self.fshape, workers=self.workers)
+
+    def convolve(self, kernel_spectrum: np.ndarray,
+                 kernel_shape: Tuple[int, int]) -> np.ndarray:
+        """ Convolve the map with a kernel given its spectrum.
+
+        : kernel_spectrum : forward FFT of the kernel on self.fshape
+        : kernel_shape : shape of the kernel in real space
+        : return : convolved map, same as fftconvolve(mode='same')
+        """
+        conv = fft.irfftn(self.spectrum * kernel_spectrum, self.fshape,
+                          workers=self.workers)
+        return  conv[same_slices(self.shape, kernel_shape)].copy()
+
+    def convolve_full(self, kernel_spectrum: np.ndarray,
+                      kernel_shape: Tuple[int, int]) -> np.ndarray:
+        """ Same as convolve but the full linear convolution is returned,
+        as fftconvolve(mode='full') """
+        conv = fft.irfftn(self.spectrum * kernel_spectrum, self.fshape,
+                          workers=self.workers)
+        return  conv[tuple(slice(0, n + k - 1) for n, k
+                           in zip(self.shape, kernel_shape))].copy()
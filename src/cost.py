@@ -0,0 +1,182 @@
+import numpy as np
+
+from typing import Dict, List, Tuple
+from scipy.fft import next_fast_len
+from src.aperture import disk_runs
+
+
+COST_PER_STAR = 50.    # relative cost of a queried star vs a pixel of an FFT
+
+# stars per deg^2 towards the galactic poles after the survey cuts, scaled
+# as 1 / sin|b| (plane parallel disk) down to B_MIN_DEG
+DENSITY_POLE = {'gaia_dr2.gaia_source': 4000.,
+                'panstarrs_dr1.stackobjectthin': 15000.}
+B_MIN_DEG = 3.
+
+N_MAPS = 20    # float maps of the grid alive at once in KDE_MWSatellite
+N_SPECTRA = 3    # complex spectra of the largest padded grid besides the kept map spectra
+WORKER_MB = 165.    # resident memory of a worker after import main, before any patch
+
+
+
+def num_grid(width: float, pixel_size: float) -> int:
+    """ Number of grid points per side, as in KDE_MWSatellite """
+    return  round(width / pixel_size)
+
+
+def padded_size(n: int, kernel: int) -> int:
+    """ FFT size per side of a map of n pixels padded for a kernel of
+    'kernel' pixels, as src.convolution.fast_shape """
+    return  next_fast_len(int(n + kernel - 1), real=True)
+
+
+def fft_cost(n_pad: int) -> float:
+    """ Cost of one FFT of n_pad x n_pad pixels, in units of one FFT pixel """
+    return  n_pad**2 * np.log2(n_pad**2)
+
+
+def patch_ffts(width: float, pixel_size: float, sigma1s: List[float],
+               sigma2: float, sigma3: float, rh: float, truncate: int = 5,
+               sat_max_radius: int = 16) -> Tuple[Dict[tuple, int], List[tuple]]:
+    """ FFTs of a patch with the 'spectrum' engine of KDE_MWSatellite. Each
+    kernel is padded to its own size and the forward FFT of a map is shared
+    by the kernels of the same padded size. Gaussian kernels of sigma1s,
+    sigma2 and sigma3 and the disks larger than sat_max_radius are FFTs of
+    hist2d. The disks of sigma3 and of the inner edges (2 sigma1) of the
+    outer apertures are also FFTs of the two maps of the dwarf (stars and
+    pixels inside rh), cut to the box of the dwarf. Smaller disks are
+    counted with summed-area tables.
+
+    : sigma1s : target kernel sizes in deg
+    : rh : half-light radius of the dwarf in deg
+    : sat_max_radius : max radius in pixels counted with summed-area tables
+    : return : number of inverse FFTs by (map, padded size), one forward FFT
+               each, and the (map, radius) counted with summed-area tables
+    """
+    n = num_grid(width, pixel_size)
+    n_dwarf = min(n, int(2. * rh / pixel_size) + 1)
+    radii_inner = [int(round(2. * sigma1 / pixel_size)) for sigma1 in sigma1s]
+    radii = {'hist2d': sorted(set([int(round(s / pixel_size)) for s in sigma1s]
+                                  + radii_inner + [int(round(sigma2 / pixel_size)),
+                                                   int(round(sigma3 / pixel_size))])),
+             'dwarf': sorted(set(radii_inner + [int(round(sigma3 / pixel_size))]))}
+
+    ffts, sats = {}, []
+    for sigma in list(sigma1s) + [sigma2, sigma3]:
+        key = ('hist2d', padded_size(n, int(truncate * sigma / pixel_size)))
+        ffts[key] = ffts.get(key, 0) + 1
+    for name, n_map in [('hist2d', n), ('dwarf', n_dwarf)]:
+        for radius in radii[name]:
+            if radius <= sat_max_radius:
+                sats.append((name, radius))
+            else:
+                key = (name, padded_size(n_map, 2 * radius + 1))
+                ffts[key] = ffts.get(key, 0) + 1
+    return  ffts, sats
+
+
+def patch_cost(width: float, pixel_size: float, sigma1s: List[float],
+               sigma2: float, sigma3: float, rh: float, n_star: float = 0.,
+               truncate: int = 5, sat_max_radius: int = 16) -> float:
+    """ Relative cost of the KDE of a patch: the FFTs of patch_ffts, one
+    forward and the inverse ones of each padded size (kernel spectra come
+    from the kernel cache), and the summed-area disks of 4 slices of the
+    map per rectangle of the disk. The query and the cuts grow with the
+    number of stars on top of it.
+
+    : width : width of the patch in deg
+    : pixel_size : size of pixel in deg
+    : sigma1s : target kernel sizes in deg
+    : sigma2 : background kernel size inside the satellite in deg
+    : sigma3 : background kernel size outside the satellite in deg
+    : rh : half-light radius of the dwarf in deg
+    : n_star : expected number of queried stars
+    : truncate : kernels are truncated at truncate * sigma
+    : sat_max_radius : max radius in pixels counted with summed-area tables
+    : return : cost in units of one FFT pixel
+    """
+    n = num_grid(width, pixel_size)
+    ffts, sats = patch_ffts(width, pixel_size, sigma1s, sigma2, sigma3, rh,
+                            truncate, sat_max_radius)
+    cost_fft = sum((1 + n_inverse) * fft_cost(n_pad)
+                   for (_, n_pad), n_inverse in ffts.items())
+    n_dwarf = min(n, int(2. * rh / pixel_size) + 1)
+    cost_sat = sum(4. * len(disk_runs(radius)) * (n if name == 'hist2d' else n_dwarf)**2
+                   for name, radius in sats)
+    return  cost_fft + cost_sat + COST_PER_STAR * n_star
+
+
+def patch_memory(width: float, pixel_size: float, sigma1s: List[float],
+                 sigma2: float, sigma3: float, rh: float, n_star: float = 0.,
+                 n_column: int = 9, truncate: int = 5,
+                 sat_max_radius: int = 16) -> float:
+    """ Peak memory of a patch in MB: the worker itself (WORKER_MB), the
+    maps and cubes of the grid, the forward spectra of the maps kept for
+    the patch (see patch_ffts), the spectra in flight at the largest padded
+    size and twice the queried columns.
+
+    : n_column : number of queried columns
+    : return : memory in MB
+    """
+    n = num_grid(width, pixel_size)
+    ffts, _ = patch_ffts(width, pixel_size, sigma1s, sigma2, sigma3, rh,
+                         truncate, sat_max_radius)
+    n_pads = [n_pad for _, n_pad in ffts]
+    maps = (N_MAPS + 2 * len(sigma1s)) * n**2 * 8.
+    spectra = sum(n_pad * (n_pad // 2 + 1) * 16. for n_pad in n_pads)
+    spectra += N_SPECTRA * max(n_pads) * (max(n_pads) // 2 + 1) * 16.
+    stars = 2. * n_star * n_column * 8.
+    return  WORKER_MB + (maps + spectra + stars) / 1024**2
+
+
+def galactic_latitude(ra: np.ndarray, dec: np.ndarray) -> np.ndarray:
+    """ Galactic latitude in deg of icrs coordinates in deg """
+    from astropy import units as u
+    from astropy.coordinates import SkyCoord
+    coord = SkyCoord(ra=np.asarray(ra) * u.deg, dec=np.asarray(dec) * u.deg, frame='icrs')
+    return  coord.galactic.b.deg
+
+
+def model_density(ra: np.ndarray, dec: np.ndarray,
+                  database: str = 'gaia_dr2.gaia_source') -> np.ndarray:
+    """ Cheap star density model in stars per deg^2 from the galactic
+    latitude only. It ignores the bulge and the Magellanic clouds, which
+    cached counts (cached_density) correct once a field has been queried.
+    """
+    b = np.abs(galactic_latitude(ra, dec))
+    sin_b = np.sin(np.radians(np.maximum(b, B_MIN_DEG)))
+    return  DENSITY_POLE[database] / sin_b
+
+
+def cached_density(cache, database: str, ra: float, dec: float) -> float:
+    """ Star density in stars per deg^2 of the smallest cached query of a
+    CatalogCache containing (ra, dec), None if there is none.
+
+    : cache : CatalogCache object
+    """
+    best = None
+    for _, meta in cache.entries():
+        ra_min, ra_max, dec_min, dec_max = meta['box']
+        if meta['database'] != database or 'n_rows' not in meta:
+            continue
+        if not (ra_min < ra < ra_max and dec_min < dec < dec_max):
+            continue
+        area = (ra_max - ra_min) * (dec_max - dec_min) * np.cos(np.radians(dec))
+        if best is None or area < best[0]:
+            best = (area, meta['n_rows'] / area)
+    return  None if best is None else best[1]
+
+
+def expected_stars(ra: float, dec: float, width: float, database: str,
+                   cache=None) -> Tuple[float, str]:
+    """ Expected number of queried stars in a patch, from cached counts if
+    available and from model_density otherwise.
+
+    : return : number of stars and the source of the estimate
+    """
+    area = width**2 * np.cos(np.radians(dec))
+    if cache is not None:
+        density = cached_density(cache, database, ra, dec)
+        if density is not None:
+            return  density * area, 'cache'
+    return  float(model_density(ra, dec, database)) * area, 'model'
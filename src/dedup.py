@@ -0,0 +1,78 @@
+import numpy as np
+import pandas as pd
+
+from scipy.spatial import cKDTree
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+from src.results_index import results_dir
+
+
+
+def unit_vectors(ra: np.ndarray, dec: np.ndarray) -> np.ndarray:
+    """ Unit vectors of sky coordinates in deg, shape (n, 3) """
+    ra, dec = np.radians(ra), np.radians(dec)
+    return  np.array([np.cos(dec) * np.cos(ra), np.cos(dec) * np.sin(ra),
+                      np.sin(dec)]).T
+
+
+def match_groups(ra: np.ndarray, dec: np.ndarray, radius: np.ndarray) -> np.ndarray:
+    """ Group the positions closer than the larger matching radius of the
+    pair, transitively (friends of friends), with a KD-tree of the unit
+    vectors so that only near pairs are compared.
+
+    : ra : ra in deg
+    : dec : dec in deg
+    : radius : matching radius of each position in deg
+    : return : group index of each position
+    """
+    n = len(ra)
+    if n == 0:
+        return  np.zeros(0, dtype=int)
+    xyz = unit_vectors(ra, dec)
+    chord = 2. * np.sin(0.5 * np.radians(np.max(radius)))
+    pairs = cKDTree(xyz).query_pairs(chord, output_type='ndarray')
+
+    i, j = pairs[:, 0], pairs[:, 1]
+    cos_sep = np.clip(np.sum(xyz[i] * xyz[j], axis=1), -1., 1.)
+    keep = np.degrees(np.arccos(cos_sep)) <= np.maximum(radius[i], radius[j])
+    graph = coo_matrix((np.ones(np.sum(keep)), (i[keep], j[keep])), shape=(n, n))
+    _, groups = connected_components(graph, directed=False)
+    return  groups
+
+
+def merge_candidates(df: pd.DataFrame, scales: pd.DataFrame,
+                     match_fac: float = 2.) -> pd.DataFrame:
+    """ Merge the candidates of overlapping patches. Candidates of the same
+    gc size and kernel within match_fac * sigma1 of each other are one
+    candidate, represented by its most significant detection, which
+    records all its source patches.
+
+    : df : candidate catalogs of peaks/candidates
+    : scales : gc_size and sigma1 by results directory 'dir', e.g.
+               ResultsIndex.scales(). Candidates of other directories are dropped.
+    : match_fac : matching radius in units of sigma1
+    : return : unique candidates with n_source, sources and source_labels
+    """
+    df = df.reset_index(drop=True)
+    df['dir'] = [results_dir(name) for name in df['name']]
+    df = df.merge(scales[['dir', 'gc_size', 'sigma1']], on='dir').drop(columns='dir')
+    df['kernel'] = [name.split("-")[-1] for name in df['name']]
+
+    uniques = []
+    for _, df_scale in df.groupby(['gc_size', 'kernel']):
+        groups = match_groups(df_scale['ra'].values, df_scale['dec'].values,
+                              match_fac * df_scale['sigma1'].values)
+        df_scale = df_scale.assign(group=groups)
+        df_scale = df_scale.sort_values(['group', 'sig_peak'], ascending=[True, False])
+
+        unique = df_scale.drop_duplicates('group').set_index('group')
+        grouped = df_scale.groupby('group')
+        unique['n_source'] = grouped.size()
+        unique['sources'] = grouped['name'].agg(";".join)
+        unique['source_labels'] = grouped['label'].agg(lambda x: ";".join(map(str, x)))
+        uniques.append(unique.reset_index(drop=True))
+
+    if len(uniques) == 0:
+        return  df.assign(n_source=[], sources=[], source_labels=[])
+    return  pd.concat(uniques, ignore_index=True).sort_values(
+        'sig_peak', ascending=False).reset_index(drop=True)
@@ -0,0 +1,221 @@
+import os
+import tempfile
+import urllib.request
+import concurrent.futures
+
+from typing import Dict, List
+from hips import HipsSurveyProperties, HipsTile, HipsTileMeta, WCSGeometry
+from hips.draw.paint import HipsPainter
+from hips.draw.ui import HipsDrawResult
+from src.tools import create_dir
+
+
+
+class HipsTileCache(object):
+    def __init__(self, cache_dir: str = 'hips-cache', fetch: bool = True,
+                 n_parallel: int = 5, timeout: float = 10.):
+        """ Cache of HiPS tiles and survey properties on disk. Each survey
+        has a directory with the layout of a HiPS server (properties,
+        Norder*/Dir*/Npix*.jpg), so a copy of a HiPS directory works as
+        a stand-in offline (fetch=False).
+
+        : cache_dir : directory of the cache
+        : fetch : download missing tiles, False: only read the cache
+        : n_parallel : number of tiles downloaded at once
+        : timeout : timeout of a download in s
+        """
+        self.cache_dir = cache_dir
+        self.fetch = fetch
+        self.n_parallel = n_parallel
+        self.timeout = timeout
+        self.surveys = {}    # HipsSurveyProperties by survey name
+        self.counts = {'hit': 0, 'miss': 0, 'fetch': 0, 'fail': 0}
+        self.errors = {}    # last error by survey name
+        create_dir(self.cache_dir)
+
+    def __str__(self):
+        s1 = "This is a HipsTileCache object: \n"
+        s2 = "    cache dir = {}\n".format(self.cache_dir)
+        s3 = "    tiles: %d hits, %d missed, %d fetched, %d failed" % (
+            self.counts['hit'], self.counts['miss'], self.counts['fetch'],
+            self.counts['fail'])
+        s4 = "".join("\n    {}: {}".format(name, error) for name, error in self.errors.items())
+        return  "{}{}{}{}".format(s1, s2, s3, s4)
+
+    def survey_dir(self, name: str) -> str:
+        """ Directory of a survey, e.g. CDS/P/DSS2/color """
+        return  "{}/{}".format(self.cache_dir, name.replace(":", "_"))
+
+    def survey(self, name: str) -> HipsSurveyProperties:
+        """ Properties of a survey, read from the cache or fetched once
+        (HipsSurveyProperties.from_name fetches the list of all surveys) """
+        if name not in self.surveys:
+            path = "{}/properties".format(self.survey_dir(name))
+            if os.path.exists(path):
+                self.surveys[name] = HipsSurveyProperties.read(path)
+            elif not self.fetch:
+                raise IOError("No properties of %s in %s" % (name, self.cache_dir))
+            else:
+                survey = HipsSurveyProperties.from_name(name)
+                text = "".join("{} = {}\n".format(key, val) for key, val in survey.data.items())
+                self.write(path, text.encode())
+                self.surveys[name] = survey
+        return  self.surveys[name]
+
+    def tile_path(self, name: str, meta: HipsTileMeta) -> str:
+        """ Path of a tile of the survey 'name' in the cache """
+        return  "{}/{}".format(self.survey_dir(name), meta.tile_default_url)
+
+    def write(self, path: str, raw_data: bytes):
+        """ Write a file of the cache, renamed into place so that workers
+        never read a partial tile """
+        create_dir(os.path.dirname(path))
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(raw_data)
+        os.replace(tmp, path)
+
+    def has_tiles(self, name: str, metas: List[HipsTileMeta]) -> bool:
+        """ True if all the tiles are in the cache """
+        return  all(os.path.exists(self.tile_path(name, meta)) for meta in metas)
+
+    def fetch_tiles(self, name: str, metas: List[HipsTileMeta]) -> int:
+        """ Download the tiles missing from the cache, each only once.
+        Failures (e.g. outside of the footprint of the survey) are counted
+        and the last one is kept in self.errors.
+
+        : return : number of tiles which could not be fetched
+        """
+        missing = {}
+        for meta in metas:
+            path = self.tile_path(name, meta)
+            if not os.path.exists(path):
+                missing[path] = meta
+        if len(missing) == 0 or not self.fetch:
+            return  len(missing)
+
+        survey = self.survey(name)
+        n_fail = 0
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.n_parallel) as executor:
+            futures = {executor.submit(self.fetch_one, survey.tile_url(meta)): path
+                       for path, meta in missing.items()}
+            for future in concurrent.futures.as_completed(futures):
+                try:
+                    self.write(futures[future], future.result())
+                    self.counts['fetch'] += 1
+                except Exception as e:
+                    n_fail += 1
+                    self.counts['fail'] += 1
+                    self.errors[name] = "{}: {}".format(type(e).__name__, e)
+        return  n_fail
+
+    def fetch_one(self, url: str) -> bytes:
+        """ Raw data of a tile from the server """
+        with urllib.request.urlopen(url, timeout=self.timeout) as response:
+            return  response.read()
+
+    def get_tiles(self, name: str, metas: List[HipsTileMeta]) -> List[HipsTile]:
+        """ Tiles of a survey in the order of 'metas', fetching the missing
+        ones if allowed
+
+        : name : name of the survey
+        : metas : list of HipsTileMeta
+        : return : list of HipsTile, IOError if a tile is not available
+        """
+        n_miss = sum(not os.path.exists(self.tile_path(name, meta)) for meta in metas)
+        self.counts['hit'] += len(metas) - n_miss
+        self.counts['miss'] += n_miss
+        if n_miss > 0:
+            self.fetch_tiles(name, metas)
+        tiles = []
+        for meta in metas:
+            path = self.tile_path(name, meta)
+            if not os.path.exists(path):
+                raise IOError("Tile %s of %s is not available: %s" % (
+                    meta.tile_default_url, name, self.errors.get(name, 'not in the cache')))
+            tiles.append(HipsTile.read(meta, path))
+        return  tiles
+
+    def plan(self, name: str, geometries: List[WCSGeometry],
+             tile_format: str = 'jpg') -> List[List[HipsTileMeta]]:
+        """ Tiles needed to draw each geometry with the survey 'name' """
+        self.survey(name)    # IOError if the properties are not available
+        return  [CachedHipsPainter(geometry, name, tile_format, self).tile_metas()
+                 for geometry in geometries]
+
+    def prefetch(self, names: List[str], geometries: List[WCSGeometry],
+                 tile_format: str = 'jpg', n_image: int = 3) -> Dict[str, List[bool]]:
+        """ Download, before drawing, the tiles of the first n_image surveys
+        of 'names' which cover each geometry. The surveys are planned in
+        order: the tiles of all geometries still missing images are
+        gathered and every distinct tile is downloaded once, then the
+        geometries without all their tiles fall back to the next survey.
+
+        : names : surveys in order of preference
+        : geometries : geometries of the images, e.g. of all candidates
+        : tile_format : format of the tiles
+        : n_image : number of survey images of each geometry
+        : return : for each survey, whether each geometry can be drawn from the cache
+        """
+        n_done = [0] * len(geometries)
+        available = {}
+        for name in names:
+            todo = [i for i in range(len(geometries)) if n_done[i] < n_image]
+            available[name] = [False] * len(geometries)
+            if len(todo) == 0:
+                break
+            try:
+                plans = self.plan(name, [geometries[i] for i in todo], tile_format)
+            except Exception as e:
+                self.errors[name] = "{}: {}".format(type(e).__name__, e)
+                continue
+            unique = {}
+            for metas in plans:
+                for meta in metas:
+                    unique[self.tile_path(name, meta)] = meta
+            self.fetch_tiles(name, list(unique.values()))
+            for i, metas in zip(todo, plans):
+                if self.has_tiles(name, metas):
+                    available[name][i] = True
+                    n_done[i] += 1
+        return  available
+
+
+
+class CachedHipsPainter(HipsPainter):
+    def __init__(self, geometry: WCSGeometry, name: str, tile_format: str,
+                 cache: HipsTileCache, precise: bool = False):
+        """ HipsPainter drawing from the tiles of a HipsTileCache instead
+        of fetching them
+
+        : geometry : geometry of the image
+        : name : name of the survey
+        : tile_format : format of the tiles
+        : cache : HipsTileCache object
+        : precise : use the precise drawing algorithm of hips
+        """
+        super().__init__(geometry, cache.survey(name), tile_format, precise,
+                         progress_bar=False)
+        self.name = name
+        self.cache = cache
+
+    def tile_metas(self) -> List[HipsTileMeta]:
+        """ Tiles covering the geometry, as in HipsPainter.tiles """
+        return  [HipsTileMeta(order=self.draw_hips_order, ipix=ipix,
+                              frame=self.hips_survey.astropy_frame,
+                              file_format=self.tile_format)
+                 for ipix in self.tile_indices]
+
+    @property
+    def tiles(self) -> List[HipsTile]:
+        if self._tiles is None:
+            self._tiles = self.cache.get_tiles(self.name, self.tile_metas())
+        return  self._tiles
+
+
+def make_cached_sky_image(geometry: WCSGeometry, name: str, tile_format: str,
+                          cache: HipsTileCache) -> HipsDrawResult:
+    """ hips.make_sky_image drawing from a HipsTileCache """
+    painter = CachedHipsPainter(geometry, name, tile_format, cache)
+    painter.run()
+    return  HipsDrawResult.from_painter(painter)
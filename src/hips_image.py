@@ -5,17 +5,72 @@ import numpy as np
 import seaborn as sns
 import matplotlib.pyplot as plt
 
+from collections import OrderedDict
 from typing import List
 from src.tools import dist2
+from src.columnar import load_columns, columnar_dir
+from src.star_store import StarStore
+from src.render import plot_points, data_extent
+from src.incremental import Stage, code_hash, read_stamp
+from src.results_index import results_dir
 from astropy.coordinates import SkyCoord
 from hips import WCSGeometry, make_sky_image
-from src.param_patch_candidate import NSTAR_MIN, WIDTH_FAC
+from src.hips_cache import HipsTileCache, make_cached_sky_image
+from src.param_patch_candidate import (NSTAR_MIN, NSTAR_SCATTER_MAX, WIDTH_FAC,
+                                       CUTOUT_CELL, N_STAR_STORE)
+
+
+HIPS_CACHE = None    # tile cache of a worker, read only
+STAR_STORES = OrderedDict()    # star stores of a worker, least recently used first
+IMAGE_COLUMNS = ['ra', 'dec', 'pmra', 'pmdec', 'bp_rp', 'phot_g_mean_mag']
+
+
+
+def star_store_stage(path: str) -> Stage:
+    """ Stage of the star store of a results directory: rebuilt when the
+    results, the cell size or the store code change """
+    kde = read_stamp(path, 'kde')
+    inputs = {'kde': None if kde is None else kde['hash'], 'columns': IMAGE_COLUMNS,
+              'cell': CUTOUT_CELL, 'code': code_hash([StarStore])}
+    return  Stage(path, 'star-store', inputs, [columnar_dir(path, 'star-store')])
+
+
+def build_star_store(path: str):
+    """ Save the stars of a results directory sorted by cell (see
+    StarStore), once for all the candidates of the run
+
+    : path : results directory
+    """
+    stage = star_store_stage(path)
+    if stage.is_fresh():
+        return
+    StarStore(load_columns(path, IMAGE_COLUMNS), CUTOUT_CELL).save(path)
+    stage.done()
+
+
+def get_star_store(path: str) -> StarStore:
+    """ Star store of a results directory, opened once per worker and kept
+    in an LRU of N_STAR_STORE stores. The columns are memory mapped, so a
+    cutout only reads the cells of its box. None if it was not built.
+
+    : path : results directory
+    """
+    if path in STAR_STORES:
+        STAR_STORES.move_to_end(path)
+        return  STAR_STORES[path]
+    if not star_store_stage(path).is_fresh():
+        return  None
+    STAR_STORES[path] = StarStore.load(path, columns=IMAGE_COLUMNS)
+    if len(STAR_STORES) > N_STAR_STORE:
+        STAR_STORES.popitem(last=False)
+    return  STAR_STORES[path]
 
 
 
 def multiprocessing_plot_hips_sky_image(
         name_df: List, label_df: List, hips_df: List, ra_df: List, dec_df: List,
-        sigma1_df: List, sig_p_df: List, path: str, res: int, id_: int):
+        sigma1_df: List, sig_p_df: List, path: str, res: int, cache_dir: str,
+        id_: int) -> bool:
     """ Re-arange the order of arguments such that the only iterable 'id_'
     is at the last one. With this arangement, we can use multiprocessing
     under the help of partial from the functools.
@@ -29,14 +84,43 @@ def multiprocessing_plot_hips_sky_image(
     : sig_p_df : list of sig_poisson of pixels
     : path : output dir path
     : res : resolution of the image (number of pixels for the image)
+    : cache_dir : directory of the prefetched tiles, None: fetch the tiles
     : id_ : iterable of all the target clusters
+    : return : True if the image is complete, see plot_hips_sky_image
+    """
+    global HIPS_CACHE
+    if cache_dir is not None and HIPS_CACHE is None:
+        HIPS_CACHE = HipsTileCache(cache_dir, fetch=False)
+    store = get_star_store(results_dir(name_df[id_]))
+    return  plot_hips_sky_image(ra_df[id_], dec_df[id_], sig_p_df[id_], sigma1_df[id_],
+                                hips_df, path, name_df[id_], label_df[id_], res,
+                                HIPS_CACHE, store)
+
+
+def candidate_geometry(ra: float, dec: float, sigma1: float, res: int) -> WCSGeometry:
+    """ Geometry of the sky image of a candidate, width_fac * sigma1 wide
+
+    : ra : ra of the pixel
+    : dec : dec of the pixel
+    : sigma1 : sigma1 of the map
+    : res : resolution of the image (number of pixels for the image)
     """
-    plot_hips_sky_image(ra_df[id_], dec_df[id_], sig_p_df[id_], sigma1_df[id_],
-                        hips_df, path, name_df[id_], label_df[id_], res)
+    return  WCSGeometry.create(
+        skydir=SkyCoord(ra, dec, unit='deg', frame='icrs'), width=res,
+        height=res, fov="%f deg" % (WIDTH_FAC * sigma1), coordsys='icrs', projection='AIT')
+
+
+def sky_image(geometry: WCSGeometry, hips_survey: str, cache: HipsTileCache = None):
+    """ hips sky image of a survey, drawn from the tile cache if given """
+    if cache is None:
+        return  make_sky_image(geometry=geometry, hips_survey=hips_survey,
+                               tile_format='jpg', progress_bar=False)
+    return  make_cached_sky_image(geometry, hips_survey, 'jpg', cache)
 
 
 def plot_hips_sky_image(ra: float, dec: float, sig_p: float, sigma1: float,
-        hips_surveys: List, outpath: str, name: str, label: int, res: int):
+        hips_surveys: List, outpath: str, name: str, label: int, res: int,
+        cache: HipsTileCache = None, store: StarStore = None) -> bool:
     """ Plot sky image using hips
 
     : ra : ra of the pixel
@@ -48,37 +132,36 @@ def plot_hips_sky_image(ra: float, dec: float, sig_p: float, sigma1: float,
     : name : name of the system (dwarf and more info)
     : label : label of a cluster pixels
     : res : resolution of the image (number of pixels for the image)
+    : cache : HipsTileCache of the prefetched tiles, None: fetch the tiles
+    : store : StarStore of the results directory, None: mask all the stars
+    : return : True if every hips survey tried has been rendered (or the
+               candidate has too few stars for an image), False otherwise
     """
     width = WIDTH_FAC * sigma1
 
     # Compute the sky image
-    geometry = WCSGeometry.create(
-        skydir=SkyCoord(ra, dec, unit='deg', frame='icrs'), width=res,
-        height=res, fov="%f deg" %width, coordsys='icrs', projection='AIT')
+    geometry = candidate_geometry(ra, dec, sigma1, res)
 
     name_split = name.split('-')
     short_name = name_split[0]
-    data = np.load('results/{}'.format(name.replace(
-        '-poisson' or '-gaussian', '/queried-data.npy'))).item()
-
-    ra_data, dec_data = data['ra'], data['dec']
-    pmra_data, pmdec_data = data['pmra'], data['pmdec']
-    bp_rp_data, g_mag_data = data['bp_rp'], data['phot_g_mean_mag']
-
-    data = None    # free memory
-
     ra_min = ra - 0.5 * width
     ra_max = ra + 0.5 * width
     dec_min = dec - 0.5 * width
     dec_max = dec + 0.5 * width
 
-    mask1 = (ra_min < ra_data) & (ra_data < ra_max)
-    mask2 = (dec_min < dec_data) & (dec_data < dec_max)
-    mask = mask1 & mask2
+    if store is not None:
+        data = store.query_box((ra_min, ra_max, dec_min, dec_max))
+    else:
+        data = load_columns(results_dir(name), IMAGE_COLUMNS)
+        mask1 = (ra_min < data['ra']) & (data['ra'] < ra_max)
+        mask2 = (dec_min < data['dec']) & (data['dec'] < dec_max)
+        data = {key: column[mask1 & mask2] for key, column in data.items()}
+
+    ra_data, dec_data = data['ra'], data['dec']
+    pmra_data, pmdec_data = data['pmra'], data['pmdec']
+    bp_rp_data, g_mag_data = data['bp_rp'], data['phot_g_mean_mag']
 
-    ra_data, dec_data = ra_data[mask], dec_data[mask]
-    pmra_data, pmdec_data = pmra_data[mask], pmdec_data[mask]
-    bp_rp_data, g_mag_data = bp_rp_data[mask], g_mag_data[mask]
+    data = None    # free memory
 
     is_in = dist2(ra_data, dec_data, ra, dec) <= sigma1 ** 2
     n_star_in = len(ra_data[is_in])
@@ -87,7 +170,7 @@ def plot_hips_sky_image(ra: float, dec: float, sig_p: float, sigma1: float,
         _s1 = 'skipping image for %s ' % short_name
         _s2 = 'because there are only %d stars in the kernel' % n_star_in
         print(_s1 + _s2)
-        return    # skip plotting image with fewer than NSTAR_MIN stars
+        return  True    # skip plotting image with fewer than NSTAR_MIN stars
 
     print('plotting image for %s' %short_name)
     sns.set(style="white", color_codes=True, font_scale=1)
@@ -95,28 +178,32 @@ def plot_hips_sky_image(ra: float, dec: float, sig_p: float, sigma1: float,
     if 'gaia' in short_name:
         fig, axes = plt.subplots(2, 3, figsize=(15, 10))
 
-        name_hue = ['inside' if i else 'outside' for i in is_in]
-        ms = 20
+        ms = 4
+        dpi = 300
 
         circle = plt.Circle((ra, dec), sigma1,
                             color='k', fill=False, lw=2, alpha=0.6)
         axes[0, 0].add_artist(circle)
 
-        sns.scatterplot(x=ra_data, y=dec_data, s=ms, hue=name_hue, ax=axes[0, 0])
-        sns.scatterplot(x=bp_rp_data, y=g_mag_data, s=ms, hue=name_hue, ax=axes[0, 1])
-        sns.scatterplot(x=pmra_data, y=pmdec_data, s=ms, hue=name_hue, ax=axes[0, 2])
-
-        sns.scatterplot(x=ra_data[is_in], y=dec_data[is_in], s=ms, ax=axes[0, 0])
-        sns.scatterplot(x=bp_rp_data[is_in], y=g_mag_data[is_in], s=ms, ax=axes[0, 1])
-        sns.scatterplot(x=pmra_data[is_in], y=pmdec_data[is_in], s=ms,  ax=axes[0, 2])
-
+        # stars outside and inside the kernel, as markers or as density
+        # images when there are more than NSTAR_SCATTER_MAX stars
+        panels = [(axes[0, 0], ra_data, dec_data, [ra_max, ra_min, dec_min, dec_max]),
+                  (axes[0, 1], bp_rp_data, g_mag_data, None),
+                  (axes[0, 2], pmra_data, pmdec_data, None)]
+        for ax, x, y, extent in panels:
+            if extent is None:
+                extent = data_extent([x], [y])
+            plot_points(ax, x[~is_in], y[~is_in], 'deepskyblue', NSTAR_SCATTER_MAX,
+                        dpi, extent, ms=ms, label='outside')
+            plot_points(ax, x[is_in], y[is_in], 'orange', NSTAR_SCATTER_MAX,
+                        dpi, extent, ms=ms, label='inside')
+            ax.set_xlim(extent[:2])
+            ax.set_ylim(extent[2:])
+            ax.legend(loc='upper right')
 
         axes[0, 0].set_title('stellar distribution')
         axes[0, 0].set_xlabel('ra (deg)')
         axes[0, 0].set_ylabel('dec (deg)')
-        axes[0, 0].set_xlim([ra_min, ra_max])
-        axes[0, 0].set_ylim([dec_min, dec_max])
-        axes[0, 0].invert_xaxis()
 
         axes[0, 1].set_title('color mag diagram (CMD)')
         axes[0, 1].invert_yaxis()
@@ -134,16 +221,16 @@ def plot_hips_sky_image(ra: float, dec: float, sig_p: float, sigma1: float,
                 axes[1, u].set_aspect(np.abs(_asp))
 
         cnt = 0    # counter for how many images have been plotted
+        n_failed = 0    # surveys which could not be rendered
         for hips_survey in hips_surveys:
             try:
-                result = make_sky_image(
-                            geometry=geometry, hips_survey=hips_survey,
-                            tile_format='jpg', progress_bar=False)
+                result = sky_image(geometry, hips_survey, cache)
                 axes[1, cnt].imshow(result.image, origin='lower')
                 axes[1, cnt].set_title(hips_survey)
                 cnt += 1
-            except:
-                pass
+            except Exception as e:
+                print('    no %s image for %s: %s' % (hips_survey, short_name, e))
+                n_failed += 1
 
             if cnt == 3:
                 break
@@ -156,7 +243,8 @@ def plot_hips_sky_image(ra: float, dec: float, sig_p: float, sigma1: float,
 
         # plot sources
         axes[0].set_title(short_name)
-        sns.scatterplot(ra_data, dec_data, ax=axes[0])
+        plot_points(axes[0], ra_data, dec_data, 'C0', NSTAR_SCATTER_MAX, 300,
+                    [ra_min, ra_max, dec_min, dec_max], ms=4)
         axes[0].set_xlim([ra_min, ra_max])
         axes[0].set_ylim([dec_min, dec_max])
         _asp = np.diff(axes[0].get_xlim())[0] / np.diff(axes[0].get_ylim())[0]
@@ -168,16 +256,16 @@ def plot_hips_sky_image(ra: float, dec: float, sig_p: float, sigma1: float,
         axes[0].add_artist(circle)
 
         cnt = 0    # counter for how many images have been plotted
+        n_failed = 0    # surveys which could not be rendered
         for hips_survey in hips_surveys:
             try:
-                result = make_sky_image(
-                            geometry=geometry, hips_survey=hips_survey,
-                            tile_format='jpg', progress_bar=False)
+                result = sky_image(geometry, hips_survey, cache)
                 cnt += 1
                 axes[cnt].imshow(result.image, origin='lower')
                 axes[cnt].set_title(hips_survey)
-            except:
-                pass
+            except Exception as e:
+                print('    no %s image for %s: %s' % (hips_survey, short_name, e))
+                n_failed += 1
 
             if cnt == 3:
                 break
@@ -194,3 +282,5 @@ def plot_hips_sky_image(ra: float, dec: float, sig_p: float, sigma1: float,
     _str = '{}/{}-target{}-'.format(outpath, name, label)
     _str = '{}ra%0.4f-dec%0.4f-sigp%0.2f.jpg'.format(_str) % (ra, dec, sig_p)
     plt.savefig(_str, bbox_inches='tight', dpi=300)
+    plt.close(fig)    # one process plots many candidates
+    return  n_failed == 0
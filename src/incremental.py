@@ -0,0 +1,134 @@
+import os
+import json
+import time
+import inspect
+import hashlib
+import tempfile
+import numpy as np
+
+from typing import List
+from src.tools import create_dir
+
+
+
+def to_json(obj):
+    """ json default for the numpy scalars and arrays of the parameters """
+    if isinstance(obj, np.generic):
+        return  obj.item()
+    if isinstance(obj, np.ndarray):
+        return  obj.tolist()
+    return  repr(obj)
+
+
+def code_hash(objects: List) -> str:
+    """ Hash of the source code of modules, classes or functions, i.e. the
+    version of the code a stage depends on. Editing an unrelated function
+    does not change it.
+
+    : objects : list of modules, classes or functions
+    : return : hex digest
+    """
+    sha = hashlib.sha1()
+    for obj in objects:
+        sha.update(inspect.getsource(obj).encode())
+    return  sha.hexdigest()
+
+
+def input_hash(inputs: dict) -> str:
+    """ Hash of the inputs of a stage: parameters, upstream hashes and code
+    version, independent of the order of the keys """
+    dump = json.dumps(inputs, sort_keys=True, default=to_json)
+    return  hashlib.sha1(dump.encode()).hexdigest()
+
+
+def stamp_path(dir_name: str, stage: str) -> str:
+    """ Path of the stamp of 'stage' in 'dir_name' """
+    return  "{}/stamp-{}.json".format(dir_name, stage)
+
+
+def read_stamp(dir_name: str, stage: str) -> dict:
+    """ Stamp of a completed stage, None if it has not completed """
+    try:
+        with open(stamp_path(dir_name, stage)) as f:
+            return  json.load(f)
+    except (IOError, ValueError):
+        return  None
+
+
+def is_fresh(dir_name: str, stage: str, key: str, outputs: List[str] = ()) -> bool:
+    """ True if 'stage' has completed with the inputs of hash 'key' and all
+    its outputs still exist, i.e. it does not need to be run again.
+
+    : dir_name : directory of the stamp
+    : stage : e.g. 'kde', 'peaks', 'plots'
+    : key : input_hash of the inputs of the stage
+    : outputs : paths written by the stage
+    """
+    stamp = read_stamp(dir_name, stage)
+    if stamp is None or stamp['hash'] != key:
+        return  False
+    return  all(os.path.exists(output) for output in outputs)
+
+
+def write_stamp(dir_name: str, stage: str, key: str, inputs: dict):
+    """ Record that 'stage' has completed with 'inputs'. Written last and
+    renamed into place, so an interrupted stage leaves no stamp.
+
+    : key : input_hash(inputs)
+    : inputs : the inputs, kept readable to see what changed between runs
+    """
+    create_dir(dir_name)
+    stamp = {'stage': stage, 'hash': key, 'time': time.time(), 'inputs': inputs}
+    fd, tmp = tempfile.mkstemp(dir=dir_name, suffix='.tmp')
+    with os.fdopen(fd, 'w') as f:
+        json.dump(stamp, f, sort_keys=True, indent=1, default=to_json)
+    os.replace(tmp, stamp_path(dir_name, stage))
+
+
+def changed_inputs(dir_name: str, stage: str, inputs: dict) -> List[str]:
+    """ Keys of 'inputs' differing from the stamp of the last run, e.g. to
+    report why a stage is run again, None if the stage has never completed """
+    stamp = read_stamp(dir_name, stage)
+    if stamp is None:
+        return  None
+    old = stamp['inputs']
+    new = json.loads(json.dumps(inputs, default=to_json))
+    return  sorted(key for key in set(old) | set(new) if old.get(key) != new.get(key))
+
+
+
+class Stage(object):
+    def __init__(self, dir_name: str, name: str, inputs: dict,
+                 outputs: List[str] = ()):
+        """ One stage of a patch (query and KDE, peaks, plots, images) with
+        the hash of its inputs, which is stamped in 'dir_name' once the stage
+        has completed. A later run skips the stage while the hash matches.
+
+        : dir_name : directory of the stamp, e.g. the results dir of a scale
+        : name : name of the stage
+        : inputs : parameters, upstream hashes and code version of the stage
+        : outputs : paths written by the stage
+        """
+        self.dir_name = dir_name
+        self.name = name
+        self.inputs = inputs
+        self.outputs = list(outputs)
+        self.key = input_hash(inputs)
+
+    def __str__(self):
+        s1 = "This is a Stage object: \n"
+        s2 = "    stamp = {}\n".format(stamp_path(self.dir_name, self.name))
+        s3 = "    hash = {}".format(self.key)
+        return  "{}{}{}".format(s1, s2, s3)
+
+    def is_fresh(self) -> bool:
+        """ True if the stage does not need to be run again """
+        return  is_fresh(self.dir_name, self.name, self.key, self.outputs)
+
+    def changed(self) -> List[str]:
+        """ Inputs changed since the last completed run, None if none """
+        return  changed_inputs(self.dir_name, self.name, self.inputs)
+
+    def done(self):
+        """ Stamp the stage as completed """
+        write_stamp(self.dir_name, self.name, self.key, self.inputs)
@@ -0,0 +1,235 @@
+import numpy as np
+import pandas as pd
+
+from typing import Tuple
+from src.instrument import traced
+from src.classKDE_MWSatellite import KDE_MWSatellite
+from scipy.signal import fftconvolve
+
+
+
+def plummer_offsets(n_cluster: int, n_star: int, size: float, r_max: float,
+                    rng: np.random.Generator) -> Tuple[np.ndarray, np.ndarray]:
+    """ Offsets of the stars of clusters with a projected Plummer profile,
+    whose half light radius is the Plummer radius size, truncated at r_max
+
+    : n_cluster : number of clusters
+    : n_star : number of stars of each cluster
+    : size : half light radius in deg
+    : r_max : truncation radius in deg
+    : rng : numpy random generator
+    : return : ra and dec offsets in deg, arrays of shape (n_cluster, n_star)
+    """
+    u_max = r_max ** 2 / (r_max ** 2 + size ** 2)    # N(<R) = R^2 / (R^2 + size^2)
+    u = rng.uniform(0., u_max, size=(n_cluster, n_star))
+    r = size * np.sqrt(u / (1. - u))
+    phi = rng.uniform(0., 2. * np.pi, size=(n_cluster, n_star))
+    return  r * np.cos(phi), r * np.sin(phi)
+
+
+
+class InjectionRecovery(object):
+    def __init__(self, kdepatch: KDE_MWSatellite, scale: int = 0,
+                 size: float = None, n_size: float = 5., match_fac: float = 2.,
+                 s_above: float = 5., valid_width: float = None):
+        """ Injection-recovery of fake clusters on the star field of a patch.
+        The maps of the unchanged star field are computed once. An injected
+        cluster only changes the sigma1 overdensity and the inner aperture
+        count within the footprint of the kernels around it, so both maps
+        and the significances are only recomputed in that window, for a
+        batch of clusters at once. The background maps (sigma2, sigma3 and
+        the outer apertures) are kept frozen: the few injected stars are
+        spread over much larger apertures than sigma1.
+
+        : kdepatch : KDE_MWSatellite object with hist2d and the dwarf masks
+        : scale : index of sigma1 in kdepatch.sigma1s
+        : size : half light radius of the clusters in deg, default sigma1
+        : n_size : clusters are truncated at n_size * size
+        : match_fac : a cluster is recovered by a pixel above s_above within
+                      match_fac * sigma1 of it
+        : s_above : significance threshold
+        : valid_width : width of the box around the center of the patch
+                        where clusters are injected, default the patch
+        """
+        self.kdepatch = kdepatch
+        self.scale = scale
+        self.sigma1 = kdepatch.sigma1s[scale]
+        self.size = self.sigma1 if size is None else size
+        self.r_max = n_size * self.size
+        self.match_fac = match_fac
+        self.s_above = s_above
+        self.valid_width = kdepatch.width if valid_width is None else valid_width
+
+        ps = kdepatch.pixel_size
+        s_grid = self.sigma1 / ps
+        self.key_gaussian = ('gaussian', s_grid, kdepatch.truncate)
+        self.key_disk = ('disk', int(round(s_grid)))
+        self.kernel_gaussian = kdepatch.kernel(self.key_gaussian)
+        self.kernel_disk = kdepatch.kernel(self.key_disk)
+        self.area_inner = kdepatch.aperture_area(self.key_disk)
+
+        # half widths in pixels: the stars of a cluster and the window where
+        # its inner aperture count changes
+        self.n_half_star = int(np.ceil(self.r_max / ps)) + 1
+        self.n_half = self.n_half_star + self.key_disk[1]
+        if (self.kernel_gaussian.shape[0] - 1) // 2 < self.key_disk[1]:
+            raise ValueError('Gaussian kernel smaller than the inner aperture')
+
+        # frozen background maps of the star field
+        shape = kdepatch.hist2d.shape
+        od_1 = kdepatch.overdensity(self.sigma1)
+        od_2 = kdepatch.overdensity(kdepatch.sigma2)
+        od_3 = kdepatch.overdensity(kdepatch.sigma3)
+        n_inner, _ = kdepatch.poisson_inner_number_count(self.sigma1)
+        lambda_in, lambda_out = kdepatch.poisson_expected_background(
+            self.sigma1, self.area_inner)
+        edge_gaussian = kdepatch.aperture_edge_area(shape, self.key_gaussian)
+        edge_disk = self.area_inner / kdepatch.aperture_edge_area(shape, self.key_disk)
+        self.maps = {'od_1': od_1, 'od_2': od_2, 'od_3': od_3, 'n_inner': n_inner,
+                     'lambda_in': lambda_in, 'lambda_out': lambda_out,
+                     'edge_gaussian': edge_gaussian, 'edge_disk': edge_disk,
+                     'is_inside_dwarf': kdepatch.is_inside_dwarf}
+
+    def __str__(self):
+        s1 = "This is an InjectionRecovery object: \n"
+        s2 = "    sigma1 = %0.8f deg\n" % self.sigma1
+        s3 = "    cluster size = %0.8f deg, truncated at %0.8f deg\n" % (self.size, self.r_max)
+        s4 = "    window = %d pixels" % (2 * self.n_half + 1)
+        return  "{}{}{}{}".format(s1, s2, s3, s4)
+
+    def random_centers(self, n_cluster: int,
+                       rng: np.random.Generator) -> Tuple[np.ndarray, np.ndarray]:
+        """ Random pixels of the injected clusters within valid_width of the
+        center of the patch, whose windows fit in the map """
+        kde = self.kdepatch
+        ny, nx = kde.hist2d.shape
+        centers = []
+        for mesh, center, n in [(kde.y_mesh, kde.dec_center, ny),
+                                (kde.x_mesh, kde.ra_center, nx)]:
+            pixels = 0.5 * (mesh[1:] + mesh[:-1])
+            is_valid = np.abs(pixels - center) < 0.5 * self.valid_width
+            is_valid[:self.n_half] = False
+            is_valid[n - self.n_half:] = False
+            if not np.any(is_valid):
+                raise ValueError('No room for the injection windows in the patch')
+            centers.append(rng.choice(np.flatnonzero(is_valid), size=n_cluster))
+        return  centers[0], centers[1]
+
+    def star_grids(self, iy: np.ndarray, ix: np.ndarray,
+                   d_ra: np.ndarray, d_dec: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """ Histograms of the stars of the clusters on the pixels of hist2d,
+        as stacked grids of half width n_half_star around the centers
+
+        : iy, ix : center pixels of the clusters
+        : d_ra, d_dec : offsets of the stars from the centers of the pixels
+        : return : stacked grids, number of stars of each cluster in the patch
+        """
+        kde = self.kdepatch
+        n_cluster = len(iy)
+        n = 2 * self.n_half_star + 1
+        ra = 0.5 * (kde.x_mesh[ix] + kde.x_mesh[ix + 1])[:, None] + d_ra
+        dec = 0.5 * (kde.y_mesh[iy] + kde.y_mesh[iy + 1])[:, None] + d_dec
+
+        # the bins of np.histogram2d
+        jx = np.searchsorted(kde.x_mesh, ra, side='right') - 1
+        jy = np.searchsorted(kde.y_mesh, dec, side='right') - 1
+        is_in = ((jx >= 0) & (jx < len(kde.x_mesh) - 1)
+                 & (jy >= 0) & (jy < len(kde.y_mesh) - 1))
+        jx = jx - ix[:, None] + self.n_half_star
+        jy = jy - iy[:, None] + self.n_half_star
+        is_in &= (jx >= 0) & (jx < n) & (jy >= 0) & (jy < n)
+
+        k = np.broadcast_to(np.arange(n_cluster)[:, None], jx.shape)
+        flat = (k[is_in] * n + jy[is_in]) * n + jx[is_in]
+        grids = np.bincount(flat, minlength=n_cluster * n * n).astype(float)
+        return  grids.reshape(n_cluster, n, n), np.sum(is_in, axis=1)
+
+    def window_conv(self, grids: np.ndarray, kernel: np.ndarray) -> np.ndarray:
+        """ Convolution of the stacked star grids with a kernel, on the
+        windows of half width n_half around the centers, aligned with the
+        'same' convolution of the full map """
+        conv = fftconvolve(grids, kernel[None, :, :], mode='full', axes=(1, 2))
+        start = (kernel.shape[0] - 1) // 2 - self.key_disk[1]
+        stop = start + 2 * self.n_half + 1
+        return  conv[:, start:stop, start:stop]
+
+    def windows(self, name: str, iy: np.ndarray, ix: np.ndarray) -> np.ndarray:
+        """ Stacked windows of half width n_half of a background map """
+        offsets = np.arange(-self.n_half, self.n_half + 1)
+        rows = (iy[:, None] + offsets)[:, :, None]
+        cols = (ix[:, None] + offsets)[:, None, :]
+        return  self.maps[name][rows, cols]
+
+    @traced(info=lambda self, n_star, d_ra, d_dec, iy, ix: {
+        'n_cluster': len(iy), 'n_star': n_star})
+    def recover_batch(self, n_star: int, d_ra: np.ndarray, d_dec: np.ndarray,
+                      iy: np.ndarray, ix: np.ndarray) -> pd.DataFrame:
+        """ Inject a batch of clusters, each one alone on the star field, and
+        measure their significances in the windows around them
+
+        : n_star : number of stars of each cluster
+        : d_ra, d_dec : offsets of the stars from the centers, (n_cluster, n_star)
+        : iy, ix : center pixels of the clusters
+        : return : DataFrame with one row per cluster
+        """
+        kde = self.kdepatch
+        grids, n_in = self.star_grids(iy, ix, d_ra, d_dec)
+        d_od_1 = self.window_conv(grids, self.kernel_gaussian)
+        d_n_inner = np.rint(self.window_conv(grids, self.kernel_disk))
+
+        od_1 = self.windows('od_1', iy, ix) + d_od_1 / self.windows('edge_gaussian', iy, ix)
+        n_inner = self.windows('n_inner', iy, ix) + d_n_inner * self.windows('edge_disk', iy, ix)
+        is_inside = self.windows('is_inside_dwarf', iy, ix)
+
+        s12 = kde.get_sig_gaussian(od_1, self.windows('od_2', iy, ix), self.sigma1, kde.sigma2)
+        s13 = kde.get_sig_gaussian(od_1, self.windows('od_3', iy, ix), self.sigma1, kde.sigma3)
+        sig_gaussian = np.where(is_inside, s12, s13)
+        s12 = kde.z_score_poisson(self.windows('lambda_in', iy, ix), n_inner)
+        s13 = kde.z_score_poisson(self.windows('lambda_out', iy, ix), n_inner)
+        sig_poisson = np.where(is_inside, s12, s13)
+
+        # pixels within match_fac * sigma1 of the center
+        r_match = self.match_fac * self.sigma1 / kde.pixel_size
+        offsets = np.arange(-self.n_half, self.n_half + 1)
+        is_match = offsets[:, None] ** 2 + offsets[None, :] ** 2 <= r_match ** 2
+
+        sig_gaussian = np.nan_to_num(sig_gaussian[:, is_match], nan=-np.inf)
+        sig_poisson = np.nan_to_num(sig_poisson[:, is_match], nan=-np.inf)
+        df = pd.DataFrame({'ra': 0.5 * (kde.x_mesh[ix] + kde.x_mesh[ix + 1]),
+                           'dec': 0.5 * (kde.y_mesh[iy] + kde.y_mesh[iy + 1]),
+                           'n_star': n_star, 'n_star_patch': n_in,
+                           'is_inside_dwarf': kde.is_inside_dwarf[iy, ix],
+                           'sig_gaussian': np.max(sig_gaussian, axis=1),
+                           'sig_poisson': np.max(sig_poisson, axis=1)})
+        for kernel in ['gaussian', 'poisson']:
+            df['is_recovered_%s' % kernel] = df['sig_%s' % kernel] > self.s_above
+        return  df
+
+    def run(self, n_stars, n_injection: int, batch_size: int = 256,
+            seed: int = 0) -> pd.DataFrame:
+        """ Inject n_injection clusters of each number of stars, batch by batch
+
+        : n_stars : list of numbers of stars of the clusters
+        : n_injection : number of clusters of each number of stars
+        : batch_size : number of clusters processed at once
+        : seed : seed of the random generator
+        : return : DataFrame with one row per cluster
+        """
+        rng = np.random.default_rng(seed)
+        dfs = []
+        for n_star in n_stars:
+            for i0 in range(0, n_injection, batch_size):
+                n_cluster = min(batch_size, n_injection - i0)
+                iy, ix = self.random_centers(n_cluster, rng)
+                d_ra, d_dec = plummer_offsets(n_cluster, n_star, self.size, self.r_max, rng)
+                dfs.append(self.recover_batch(n_star, d_ra, d_dec, iy, ix))
+        df = pd.concat(dfs, ignore_index=True)
+        df['sigma1'] = self.sigma1
+        df['size'] = self.size
+        return  df
+
+
+
+def completeness(df: pd.DataFrame, kernel: str = 'poisson') -> pd.Series:
+    """ Fraction of the injected clusters recovered, by number of stars """
+    return  df.groupby('n_star')['is_recovered_%s' % kernel].mean()
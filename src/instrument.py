@@ -0,0 +1,204 @@
+import os
+import sys
+import json
+import time
+import cProfile
+import resource
+import functools
+import tracemalloc
+import numpy as np
+import pandas as pd
+
+from typing import Callable, List
+from contextlib import contextmanager
+from src.tools import create_dir
+from src.lazy_datas import LazyDatas
+
+
+TRACER = None    # StageTracer of the current patch in this process, None: not traced
+
+
+
+def nbytes(obj) -> int:
+    """ Size in bytes of the arrays of an array, a dict or a list of arrays,
+    or held by a LazyDatas (e.g. Patch.datas), 0 for other objects """
+    if isinstance(obj, np.ndarray):
+        return  int(obj.nbytes)
+    if isinstance(obj, LazyDatas):    # without gathering the selection
+        return  nbytes([obj.base, obj.gathered, obj.derived, obj.index])
+    if isinstance(obj, dict):
+        return  sum(nbytes(val) for val in obj.values())
+    if isinstance(obj, (list, tuple)):
+        return  sum(nbytes(val) for val in obj)
+    return  0
+
+
+def rss_mb() -> float:
+    """ Current resident memory of the process in MB, None if unknown """
+    try:
+        with open('/proc/self/statm') as f:
+            return  int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2 ** 20
+    except (IOError, ValueError):
+        return  None
+
+
+def max_rss_mb() -> float:
+    """ Peak resident memory of the process so far in MB """
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return  max_rss / 2 ** 20 if sys.platform == 'darwin' else max_rss / 2 ** 10
+
+
+
+class StageTracer(object):
+    def __init__(self, path: str, patch: str, is_tracemalloc: bool = False,
+                 is_profile: bool = False):
+        """ Trace of the stages of a patch: one JSON line per stage with the
+        wall and cpu time, the resident memory, the peak of the python
+        allocations (tracemalloc) and the size of the arrays produced.
+        Stages may be nested, e.g. the convolutions of compound_sig_gaussian.
+
+        : path : JSON lines file of the trace, overwritten
+        : patch : name of the patch written in every record
+        : is_tracemalloc : trace the python allocations, slower
+        : is_profile : cProfile the whole patch into '{path}.prof'
+        """
+        self.path = path
+        self.patch = patch
+        self.is_tracemalloc = is_tracemalloc
+        self.stack = []    # stages being run, innermost last
+        self.totals = {}    # wall and cpu time summed by stage
+        create_dir(os.path.dirname(path) or '.')
+        self.file = open(path, 'w')
+
+        if is_tracemalloc and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        self.profile = cProfile.Profile() if is_profile else None
+        if self.profile is not None:
+            self.profile.enable()
+
+    def __str__(self):
+        s1 = "This is a StageTracer object: \n"
+        s2 = "    trace = {}".format(self.path)
+        s3 = "".join("\n    %-40s %4d calls  wall %9.4fs  cpu %9.4fs" % (
+            name, total['calls'], total['wall'], total['cpu'])
+            for name, total in self.totals.items())
+        return  "{}{}{}".format(s1, s2, s3)
+
+    def close(self):
+        """ Stop tracing and write the profile if any """
+        if self.profile is not None:
+            self.profile.disable()
+            self.profile.dump_stats("{}.prof".format(self.path))
+            self.profile = None
+        if self.is_tracemalloc and tracemalloc.is_tracing():
+            tracemalloc.stop()
+        self.file.close()
+
+    @contextmanager
+    def stage(self, name: str, **info):
+        """ Trace the block of a stage. The yielded record can be completed
+        by the block, e.g. record['nbytes'] = nbytes(result).
+
+        : name : name of the stage
+        : info : json serializable fields added to the record
+        """
+        record = {'patch': self.patch, 'stage': name, 'depth': len(self.stack),
+                  'parent': self.stack[-1]['stage'] if len(self.stack) > 0 else None}
+        record.update(info)
+        if self.is_tracemalloc:
+            peak = tracemalloc.get_traced_memory()[1]
+            if len(self.stack) > 0:    # keep the peak of the parent before the reset
+                self.stack[-1]['_peak'] = max(self.stack[-1]['_peak'], peak)
+            tracemalloc.reset_peak()
+            record['_peak'] = 0
+        self.stack.append(record)
+
+        wall0, cpu0 = time.perf_counter(), time.process_time()
+        try:
+            yield  record
+        finally:
+            record['wall'] = time.perf_counter() - wall0
+            record['cpu'] = time.process_time() - cpu0
+            record['rss_mb'] = rss_mb()
+            record['max_rss_mb'] = max_rss_mb()
+            self.stack.pop()
+            if self.is_tracemalloc:
+                peak = max(record.pop('_peak'), tracemalloc.get_traced_memory()[1])
+                record['tracemalloc_peak_mb'] = peak / 2 ** 20
+                if len(self.stack) > 0:
+                    self.stack[-1]['_peak'] = max(self.stack[-1]['_peak'], peak)
+            self.write(record)
+
+    def write(self, record: dict):
+        """ Append a record to the trace and to the totals """
+        total = self.totals.setdefault(record['stage'], {'calls': 0, 'wall': 0., 'cpu': 0.})
+        total['calls'] += 1
+        total['wall'] += record['wall']
+        total['cpu'] += record['cpu']
+        self.file.write(json.dumps(record, default=str) + "\n")
+        self.file.flush()
+
+
+def start(path: str, patch: str, is_tracemalloc: bool = False,
+          is_profile: bool = False) -> StageTracer:
+    """ Start the tracer of a patch in this process (see StageTracer) """
+    global TRACER
+    stop()
+    TRACER = StageTracer(path, patch, is_tracemalloc, is_profile)
+    return  TRACER
+
+
+def stop():
+    """ Stop the tracer of this process, if any """
+    global TRACER
+    if TRACER is not None:
+        TRACER.close()
+        TRACER = None
+
+
+@contextmanager
+def trace(name: str, **info):
+    """ Trace a block with the tracer of this process, nothing if there is
+    none. Yields the record (a dict which is dropped if not traced). """
+    if TRACER is None:
+        yield  {}
+    else:
+        with TRACER.stage(name, **info) as record:
+            yield  record
+
+
+def traced(name: str = None, info: Callable = None, attr: str = None):
+    """ Decorator tracing each call of a function (see trace). The size of
+    the arrays returned, or of the attribute 'attr' of the first argument
+    after the call (e.g. 'datas' of a patch), is recorded as 'nbytes'.
+
+    : name : name of the stage, default the name of the function
+    : info : function of the arguments giving json serializable fields, e.g.
+             lambda self, catalog, *args: {'catalog': catalog}
+    : attr : attribute of the first argument measured after the call
+    """
+    def decorator(func: Callable) -> Callable:
+        stage_name = func.__name__ if name is None else name
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if TRACER is None:
+                return  func(*args, **kwargs)
+            fields = {} if info is None else info(*args, **kwargs)
+            with TRACER.stage(stage_name, **fields) as record:
+                result = func(*args, **kwargs)
+                obj = result if attr is None else getattr(args[0], attr, None)
+                record['nbytes'] = nbytes(obj)
+            return  result
+        return  wrapper
+    return  decorator
+
+
+def read_trace(paths: List[str]) -> pd.DataFrame:
+    """ Records of JSON lines traces, e.g. of all the patches of a campaign,
+    as a pandas DataFrame """
+    records = []
+    for path in paths:
+        with open(path) as f:
+            records += [json.loads(line) for line in f if line.strip()]
+    return  pd.DataFrame(records)
@@ -0,0 +1,135 @@
+import os
+import glob
+import hashlib
+import tempfile
+import numpy as np
+
+from typing import Callable, Dict
+from collections import OrderedDict
+from src.tools import create_dir
+
+
+
+class KernelCache(object):
+    def __init__(self, cache_dir: str = None, max_mem_mb: float = 2048.,
+                 max_disk_mb: float = 20480.):
+        """ Two level cache of kernels, kernel spectra and edge normalization
+        maps: a LRU cache in memory in front of a cache on disk. All split
+        patches of a dwarf share the grid and kernel sizes, so the arrays are
+        only built once, even across jobs if they share 'cache_dir'.
+
+        : cache_dir : directory of the disk cache, None for memory only
+        : max_mem_mb : size bound of the memory cache in MB
+        : max_disk_mb : size bound of the disk cache in MB
+        """
+        self.cache_dir = cache_dir
+        self.max_mem_bytes = int(max_mem_mb * 1024**2)
+        self.max_disk_bytes = int(max_disk_mb * 1024**2)
+        self.memory = OrderedDict()
+        self.mem_bytes = 0
+        self.counts = {'memory': 0, 'disk': 0, 'build': 0}
+        if self.cache_dir is not None:
+            create_dir(self.cache_dir)
+
+    def __str__(self):
+        s1 = "This is a KernelCache object: \n"
+        s2 = "    disk cache = {}\n".format(self.cache_dir)
+        s3 = "    %d arrays, %0.1f MB in memory\n" % (len(self.memory),
+                                                      self.mem_bytes / 1024**2)
+        s4 = "    hits: %d memory, %d disk, %d built" % (
+            self.counts['memory'], self.counts['disk'], self.counts['build'])
+        return  "{}{}{}{}".format(s1, s2, s3, s4)
+
+    def get(self, key: tuple, build: Callable[[], np.ndarray]) -> np.ndarray:
+        """ Get the array of 'key', from memory, from disk, or by calling
+        'build' and storing the result in both levels.
+
+        : key : e.g. ('spectrum', grid shape, fft shape, 'gaussian', s_grid, truncate)
+        : build : function building the array if it is not cached
+        : return : the cached array (do not modify it in place)
+        """
+        if key in self.memory:
+            self.memory.move_to_end(key)
+            self.counts['memory'] += 1
+            return  self.memory[key]
+
+        array = self.disk_load(key)
+        if array is None:
+            array = build()
+            self.counts['build'] += 1
+            self.disk_save(key, array)
+        else:
+            self.counts['disk'] += 1
+
+        self.memory_put(key, array)
+        return  array
+
+    def memory_put(self, key: tuple, array: np.ndarray):
+        """ Put an array in the memory cache and evict the least recently
+        used ones beyond max_mem_bytes """
+        if array.nbytes > self.max_mem_bytes:
+            return    # never keep arrays larger than the whole cache
+        self.memory[key] = array
+        self.mem_bytes += array.nbytes
+        while self.mem_bytes > self.max_mem_bytes:
+            _, evicted = self.memory.popitem(last=False)
+            self.mem_bytes -= evicted.nbytes
+
+    def path(self, key: tuple) -> str:
+        """ File name of 'key' in the disk cache """
+        name = hashlib.sha1(repr(key).encode()).hexdigest()
+        return  "{}/{}.npy".format(self.cache_dir, name)
+
+    def disk_load(self, key: tuple) -> np.ndarray:
+        """ Load 'key' from the disk cache, None if not cached """
+        if self.cache_dir is None:
+            return  None
+        path = self.path(key)
+        try:
+            array = np.load(path)
+        except (IOError, ValueError):    # missing or partially written
+            return  None
+        os.utime(path, None)    # mark as recently used for eviction
+        return  array
+
+    def disk_save(self, key: tuple, array: np.ndarray):
+        """ Save 'key' to the disk cache. The file is written to a temporary
+        name and renamed, so concurrent jobs never read a partial file. """
+        if self.cache_dir is None or array.nbytes > self.max_disk_bytes:
+            return
+        fd, tmp = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            np.save(f, array)
+        os.replace(tmp, self.path(key))
+        self.disk_evict()
+
+    def disk_evict(self):
+        """ Remove the least recently used files beyond max_disk_bytes """
+        files = []
+        for path in glob.glob("{}/*.npy".format(self.cache_dir)):
+            try:
+                stat = os.stat(path)
+            except OSError:    # removed by another job
+                continue
+            files.append((stat.st_mtime, stat.st_size, path))
+
+        total = sum(f[1] for f in files)
+        for _, size, path in sorted(files):
+            if total <= self.max_disk_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+    def stats(self) -> Dict[str, float]:
+        """ Hit counts and sizes of the cache """
+        stats = dict(self.counts)
+        stats['n_memory'] = len(self.memory)
+        stats['mem_mb'] = self.mem_bytes / 1024**2
+        return  stats
+
+
+# cache shared by all KDE_MWSatellite objects of a process
+DEFAULT_KERNEL_CACHE = KernelCache()
@@ -0,0 +1,76 @@
+import numpy as np
+
+from typing import Dict
+from collections.abc import MutableMapping
+
+
+
+class LazyDatas(MutableMapping):
+    def __init__(self, columns: Dict[str, np.ndarray]):
+        """ Dict of columns with lazy selection. The queried columns are
+        kept untouched and a cut only composes the index of the surviving
+        rows, so k cuts on c columns no longer copy k x c arrays. A column
+        is gathered from the index when it is read, and the columns added
+        after the query (e.g. is_inside) are cut along.
+
+        : columns : dict of the queried columns
+        """
+        self.base = dict(columns)
+        self.index = None    # rows of base surviving the cuts, None for all
+        self.gathered = {}    # base columns gathered at the current index
+        self.derived = {}    # columns set on the current rows
+
+    def __getitem__(self, key: str) -> np.ndarray:
+        if key in self.derived:
+            return  self.derived[key]
+        if key not in self.gathered:
+            column = self.base[key]
+            self.gathered[key] = column if self.index is None else column[self.index]
+        return  self.gathered[key]
+
+    def __setitem__(self, key: str, column: np.ndarray):
+        self.base.pop(key, None)
+        self.gathered.pop(key, None)
+        self.derived[key] = column
+
+    def __delitem__(self, key: str):
+        if key not in self:
+            raise KeyError(key)
+        for columns in [self.base, self.gathered, self.derived]:
+            columns.pop(key, None)
+
+    def __iter__(self):
+        yield from self.base
+        yield from self.derived
+
+    def __len__(self) -> int:
+        return  len(self.base) + len(self.derived)
+
+    def __contains__(self, key) -> bool:
+        return  key in self.base or key in self.derived
+
+    def n_rows(self) -> int:
+        """ Number of rows surviving the cuts """
+        if self.index is not None:
+            return  len(self.index)
+        for columns in [self.base, self.derived]:
+            for column in columns.values():
+                return  len(column)
+        return  0
+
+    def select(self, mask: np.ndarray):
+        """ Keep the rows of 'mask', relative to the current rows. The
+        gathered columns are dropped and gathered again at the new index
+        only if they are read again.
+
+        : mask : boolean mask or indices of the current rows
+        """
+        mask = np.asarray(mask)
+        rows = np.flatnonzero(mask) if mask.dtype == bool else mask
+        self.index = rows if self.index is None else self.index[rows]
+        self.gathered = {}
+        self.derived = {key: column[rows] for key, column in self.derived.items()}
+
+    def to_dict(self) -> Dict[str, np.ndarray]:
+        """ Plain dict of all the columns at the current rows """
+        return  {key: self[key] for key in self}
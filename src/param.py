@@ -39,6 +39,8 @@ SIGMA3 = 1.00    # background scale (larger) in deg
 GC_SIZE = 10    # size of target globular clusters (pc)
 R_HALFLIGHT = 0.28    # half light radius in deg
 
+DWARF_WIDTH = WIDTH    # width of the union footprint of the dwarf's patches
+
 
 """ gaia cuts """
 if DATABASE == 'gaia_dr2.gaia_source':
@@ -58,23 +60,114 @@ if DATABASE == 'panstarrs_dr1.stackobjectthin':
     IS_PM_ERROR_CUT = False
 
 
+""" local cache of query results """
+CATALOG_CACHE_DIR = 'catalog-cache'    # None: always query the database
+CATALOG_CACHE_DISK_MB = 51200    # size bound of the cache, e.g. scratch quota
+
+
+""" one query for all the split patches of a dwarf """
+# the union footprint is queried and sorted once by batch.py --dwarf_store,
+# then each patch is sliced from the saved store
+STORE_DIR = 'stores'    # star store of each dwarf
+STORE_CELL = 0.05    # cell size of the spatial index of the dwarf in deg
+DWARF_STORE = "{}/{}".format(STORE_DIR, NAME.split("=")[0])    # store of this dwarf
+IS_DWARF_QUERY = False    # slice the patch from DWARF_STORE, True when it exists
+
+
+""" push the survey cuts down into the sql query """
+IS_PUSHDOWN = True    # the python cuts are still applied as a fallback
+IS_COUNT_PUSHDOWN = False    # report the rows of the box without the cuts
+
+
+""" streaming query: cuts and hist2d chunk by chunk, bounded memory """
+IS_STREAM = False    # bypasses the catalog cache and the dwarf query
+STREAM_CHUNK_SIZE = 1000000    # rows fetched at a time
+
+# columns kept after the cuts, as used by the plots and hips images
+if DATABASE == 'gaia_dr2.gaia_source':
+    KEEP_COLUMNS = ['ra', 'dec', 'pmra', 'pmdec', 'bp_rp', 'phot_g_mean_mag']
+elif DATABASE == 'panstarrs_dr1.stackobjectthin':
+    KEEP_COLUMNS = ['ra', 'dec', 'rpsfmag']
+
+
+""" KDE engines """
+KDE_ENGINE = 'spectrum'    # 'spectrum': share forward FFTs among kernels, 'fft': legacy
+FFT_WORKERS = -1    # threads of each FFT of 'spectrum', -1: all the cores (batch.py: shared)
+
+# cache of kernels, kernel spectra and edge normalizations shared by patches
+KERNEL_CACHE_DIR = 'kernel-cache'    # None: memory cache only
+KERNEL_CACHE_MEM_MB = 2048    # size bound of the memory cache
+KERNEL_CACHE_DISK_MB = 20480    # size bound of the disk cache
+
+# convolve wide Gaussian backgrounds (sigma2, sigma3) on a binned grid
+IS_PYRAMID = False
+PYRAMID_SIGMA_GRID = 8    # min kernel size in binned pixels: error < 0.3%
+
+# Poisson apertures up to this radius (pixels) are counted with summed-area
+# tables, larger ones with the shared FFT rounded to integer counts
+APERTURE_SAT_MAX_RADIUS = 16
+
+# Poisson z-score: 'exact', 'table' (interpolated where it matches the exact
+# z-score to 1e-3 at 3 sampled points of each table interval, exact around
+# s_above) or 'threshold' (exact for pixels which can reach s_above, nan
+# for the others)
+Z_SCORE_MODE = 'exact'
+
+# name of the Poisson maps in the results: the nan maps of 'threshold' are
+# kept apart from the full maps, e.g. sig_poisson_threshold.npy
+POISSON_MAP = 'poisson_threshold' if Z_SCORE_MODE == 'threshold' else 'poisson'
+
+
+""" scales of the multi-scale sweep: one sigma1 per GC size """
+GC_SIZES = [GC_SIZE]
+SIGMA1S = [SIGMA1]
+
+
+""" incremental runs: skip the stages of a patch whose inputs are unchanged """
+IS_INCREMENTAL = True    # False: always run every stage
+CATALOG_SNAPSHOT = None    # tag of a reload of DATABASE, None: the release named by DATABASE
+
+
+""" hand the results of main.py to plots and peaks in memory """
+IS_RELOAD_RESULTS = False    # True: read the saved results files back instead
+
+
+""" run manifest of each scale, indexed by summary.py """
+MANIFEST_THRESHOLDS = [3, 4, 5, 6, 7]    # peak pixels counted at these significances
+
+
+""" instrumentation: time and memory of each stage of a patch """
+TRACE_DIR = 'traces'    # one JSON lines trace per patch, None: no trace
+IS_TRACEMALLOC = False    # peak python allocations of each stage, slower
+IS_PROFILE = False    # cProfile of each patch into '{trace}.prof'
+
+
+""" plots """
+PLOT_N_STAR_MAX = 20000    # more stars are drawn as a density image of the figure pixels
+
+
+""" injection-recovery of fake clusters: completeness of each scale """
+IS_INJECTION = False    # Plummer clusters of half light radius sigma1
+INJECTION_N_STARS = [5, 10, 20, 40]    # numbers of stars of the clusters
+N_INJECTION = 1000    # clusters of each number of stars
+INJECTION_BATCH = 256    # clusters processed at once
+INJECTION_SEED = 0    # seed of the random positions and stars
+
+
 """ output file name """
 FILE_STAR = 'queried-data'    # output data file
 FILE_SIG_GAUSSIAN = 'sig_gaussian'    # output significance file
-FILE_SIG_POISSON = 'sig_poisson'    # output significance file
+FILE_SIG_POISSON = 'sig_{}'.format(POISSON_MAP)    # output significance file
 FILE_MESH = 'meshgrids'    # output mesh grids
+FILE_SIG_GAUSSIAN_CUBE = 'sig_gaussian_cube'    # significance of all scales
+FILE_SIG_POISSON_CUBE = 'sig_{}_cube'.format(POISSON_MAP)    # significance of all scales
+FILE_SCALES = 'scales'    # gc sizes and sigma1 of the cube slices
+FILE_INJECTION = 'injections'    # injected clusters and their significances
 
 
-""" parse arguments from the joint-split dwarf list or the joint dwarf list """
-if IS_DWARF_SPLIT_LIST or IS_DWARF_LIST:
-    import argparse
-    import numpy as np
-
-    parser = argparse.ArgumentParser(description='Set parameters for a specific dwarf')
-    parser.add_argument('--name_dwarf', type=str, help='A dwarf name from McConnachie list')
-    parser.add_argument('--gc_size_pc', type=int, help='Size of globular clusters: e.g. 1~10 pc')
-    args = parser.parse_args()
-
+""" parameters of a dwarf (patch) from the joint-split or the joint list """
+def get_path_dwarfs() -> str:
+    """ Path of the dwarf list used by IS_DWARF_SPLIT_LIST or IS_DWARF_LIST """
     if IS_DWARF_SPLIT_LIST:
         path_dwarfs = "dwarfs/dwarfs-joint-split.npy"
         if IS_PM_ERROR_CUT:
@@ -83,42 +176,95 @@ if IS_DWARF_SPLIT_LIST or IS_DWARF_LIST:
         path_dwarfs = "dwarfs/dwarfs-joint.npy"
     else:
         raise ValueError('Wrong list boolean')
+    return  path_dwarfs
+
 
-    dwarfs_dict = np.load(path_dwarfs).item()
+def dwarf_params(name_dwarf: str, gc_sizes, dwarfs_dict: dict = None) -> dict:
+    """ Derive the parameters of a dwarf (patch) from the dwarf list. The
+    returned dict updates the module level parameters, e.g. of the
+    modules running several patches in one process.
 
-    NAME = args.name_dwarf    # name of the dwarf
+    : name_dwarf : a dwarf name from the list, e.g. Fornax=3
+    : gc_sizes : list of sizes of globular clusters in pc
+    : dwarfs_dict : the loaded dwarf list, loaded from get_path_dwarfs() if None
+    : return : dict of parameter names and values
+    """
+    import os
+    import numpy as np
+
+    if dwarfs_dict is None:
+        dwarfs_dict = np.load(get_path_dwarfs(), allow_pickle=True).item()
+
+    NAME = name_dwarf    # name of the dwarf
     mask = dwarfs_dict["GalaxyName"] == NAME
 
-    for key, val in dwarfs_dict.items():
-        dwarfs_dict[key] = val[mask]
+    # all split patches of the dwarf, e.g. Fornax=1, Fornax=2, ...
+    name_base = NAME.split("=")[0]
+    names_base = np.array([name.split("=")[0] for name in dwarfs_dict["GalaxyName"]])
+    mask_dwarf = names_base == name_base
 
-    if dwarfs_dict["GalaxyName"][0] != NAME:
+    dwarf = {key: val[mask] for key, val in dwarfs_dict.items()}
+
+    if len(dwarf["GalaxyName"]) == 0 or dwarf["GalaxyName"][0] != NAME:
         raise ValueError("Cannot find %s in GalaxyName" %NAME)
 
-    RA = dwarfs_dict["RA_deg"][0]    # RA of the center of a patch
-    DEC = dwarfs_dict["Dec_deg"][0]    # Dec of the center of a patch
-    RA_DWARF = dwarfs_dict["RA_dwarf_deg"][0]      # ra of the dwarf (in deg)
-    DEC_DWARF = dwarfs_dict["Dec_dwarf_deg"][0]    # dec of the dwarf (in deg)
-    R_HALFLIGHT = dwarfs_dict["rh(arcmins)"][0] / 60.    # rh in deg
+    params = {'NAME': NAME}
+    params['RA'] = dwarf["RA_deg"][0]    # RA of the center of a patch
+    params['DEC'] = dwarf["Dec_deg"][0]    # Dec of the center of a patch
+    params['RA_DWARF'] = dwarf["RA_dwarf_deg"][0]      # ra of the dwarf (in deg)
+    params['DEC_DWARF'] = dwarf["Dec_dwarf_deg"][0]    # dec of the dwarf (in deg)
+    params['R_HALFLIGHT'] = dwarf["rh(arcmins)"][0] / 60.    # rh in deg
 
     if IS_PM_ERROR_CUT:
-        PMRA_DWARF = dwarfs_dict["pmra_dwarf"][0]
-        PMDEC_DWARF = dwarfs_dict["pmdec_dwarf"][0]
+        params['PMRA_DWARF'] = dwarf["pmra_dwarf"][0]
+        params['PMDEC_DWARF'] = dwarf["pmdec_dwarf"][0]
 
     if IS_DWARF_SPLIT_LIST:
         from src.param_patch_candidate import WIDTH
     elif IS_DWARF_LIST:
-        WIDTH = float('%0.4f' %(8. * R_HALFLIGHT))
+        WIDTH = float('%0.4f' %(8. * params['R_HALFLIGHT']))
     else:
         raise ValueError('Wrong list boolean')
+    params['WIDTH'] = WIDTH
+
+    # square box around the dwarf covering all its split patches
+    _offset = max(np.max(np.abs(dwarfs_dict["RA_deg"][mask_dwarf] - params['RA_DWARF'])),
+                  np.max(np.abs(dwarfs_dict["Dec_deg"][mask_dwarf] - params['DEC_DWARF'])))
+    params['DWARF_WIDTH'] = 2. * _offset + WIDTH
+    params['DWARF_STORE'] = "{}/{}".format(STORE_DIR, name_base)
+    params['IS_DWARF_QUERY'] = os.path.isdir(params['DWARF_STORE'])
+
+    GC_SIZES = [gc_size for gc_size in gc_sizes]
+    DISTANCE = float('%0.4f' %(dwarf["Distance_pc"][0]))
+
+    SIGMA1S = [float('%0.4f' % (gc_size / DISTANCE * 180. / np.pi))
+               for gc_size in GC_SIZES]
+    params['GC_SIZES'], params['DISTANCE'], params['SIGMA1S'] = GC_SIZES, DISTANCE, SIGMA1S
+    params['SIGMA2'] = float('%0.4f' %(0.5 * params['R_HALFLIGHT']))
+    params['SIGMA3'] = 0.5    # always use 0.5 deg as outer kernel
+    params['PIXEL_SIZE'] = 0.25 * min(SIGMA1S)    # resolve the smallest scale
+
+    params['GC_SIZE'], params['SIGMA1'] = GC_SIZES[0], SIGMA1S[0]
+    return  params
 
-    GC_SIZE = args.gc_size_pc
-    DISTANCE = float('%0.4f' %(dwarfs_dict["Distance_pc"][0]))
 
-    SIGMA1 = float('%0.4f' % (GC_SIZE / DISTANCE * 180. / np.pi))
-    SIGMA2 = float('%0.4f' %(0.5 * R_HALFLIGHT))
-    SIGMA3 = 0.5    # always use 0.5 deg as outer kernel
-    PIXEL_SIZE = 0.25 * SIGMA1
+""" parse arguments from the joint-split dwarf list or the joint dwarf list """
+if IS_DWARF_SPLIT_LIST or IS_DWARF_LIST:
+    import os
+    import sys
+    import argparse
+
+    # --help of main.py only: other scripts importing param (batch.py,
+    # benchmarks) describe their own arguments
+    parser = argparse.ArgumentParser(description='Set parameters for a specific dwarf',
+                                     add_help=os.path.basename(sys.argv[0]) == 'main.py')
+    parser.add_argument('--name_dwarf', type=str, help='A dwarf name from McConnachie list')
+    parser.add_argument('--gc_size_pc', type=int, nargs='+',
+                        help='Sizes of globular clusters: e.g. 1~10 pc, several sizes share one run')
+    args, _ = parser.parse_known_args()    # other scripts (batch.py) have their own
+
+    if args.name_dwarf is not None:
+        globals().update(dwarf_params(args.name_dwarf, args.gc_size_pc))
 
 
 if __name__ == '__main__':
@@ -10,13 +10,20 @@ WIDTH = 1.5    # width of a patch in deg = PATCH_DIST + 2 * sigma3
 """ parameters about candidates """
 # hips_image.py
 NSTAR_MIN = 5    # threshold of min stars in inner aperture
+NSTAR_SCATTER_MAX = 5000    # more stars are drawn as a density image of the figure pixels
 WIDTH_FAC = 10    # width of image = width_fac * sigma1
 valid_width = PATCH_DIST    # deal with the boundary
+CUTOUT_CELL = 0.02    # cell size of the star store of the cutouts in deg
+N_STAR_STORE = 4    # star stores kept open by each worker
 
 
 # summary.py
 s_above = 5    # significance threshold
 res_image = 1000    # image resolution of hips
+match_fac = 2.    # candidates of overlapping patches within match_fac * sigma1 are merged
+
+hips_cache_dir = 'hips-cache'    # tiles prefetched once for all candidates, None: no cache
+is_hips_fetch = True    # False: offline, only use the tiles in hips_cache_dir
 
 hips_surveys = ['CDS/P/DES-DR1/g',
                 'CDS/P/DECaLS/DR5/color',
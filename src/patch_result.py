@@ -0,0 +1,84 @@
+import numpy as np
+
+from typing import Dict, List, Tuple
+from src.columnar import load_columns, load_header
+
+
+
+class PatchResult(object):
+    def __init__(self, path: str = None):
+        """ Result of the KDE calculation of one patch at one scale, shared
+        by the plotting and peak functions. It is either filled from the
+        live KDE_MWSatellite/PatchMWSatellite objects, so nothing is read
+        back from disk, or read lazily from a results directory, one file
+        at a time and only when needed.
+
+        : path : results directory, used for anything not held in memory
+        """
+        self.path = path
+        self.x_mesh, self.y_mesh = None, None
+        self.sigs = {}    # significance maps by kernel
+        self.datas = {}    # columns of the stars
+
+    def __str__(self):
+        s1 = "This is a PatchResult object: \n"
+        s2 = "    path = {}\n".format(self.path)
+        s3 = "    in memory: {}".format(
+            ", ".join(["mesh"] * (self.x_mesh is not None)
+                      + ["sig_{}".format(k) for k in self.sigs] + list(self.datas)))
+        return  "{}{}{}".format(s1, s2, s3)
+
+    @classmethod
+    def from_dir(cls, path: str) -> 'PatchResult':
+        """ Result read lazily from a results directory """
+        return  cls(path)
+
+    @classmethod
+    def from_objects(cls, patch, kdepatch, path: str = None,
+                     poisson_name: str = 'poisson') -> 'PatchResult':
+        """ Result of the current scale of live objects, without copies
+
+        : patch : PatchMWSatellite object after append_sig_to_data
+        : kdepatch : KDE_MWSatellite object after compound_sig_*
+        : path : results directory of the scale, if it has been saved
+        : poisson_name : kernel name of the Poisson map, see append_sig_to_data
+        """
+        result = cls(path)
+        result.x_mesh, result.y_mesh = kdepatch.x_mesh, kdepatch.y_mesh
+        result.sigs = {'gaussian': kdepatch.sig_gaussian,
+                       poisson_name: kdepatch.sig_poisson}
+        for key in ['ra', 'dec', 'sig_gaussian', 'sig_{}'.format(poisson_name)]:
+            result.datas[key] = patch.datas[key]
+        return  result
+
+    @classmethod
+    def as_result(cls, path) -> 'PatchResult':
+        """ Accept either a results directory or a PatchResult """
+        if isinstance(path, cls):
+            return  path
+        return  cls.from_dir(path)
+
+    def mesh(self) -> Tuple[np.ndarray, np.ndarray]:
+        """ Meshgrids x (ra) and y (dec) of the maps """
+        if self.x_mesh is None:
+            self.x_mesh, self.y_mesh = np.load('{}/meshgrids.npy'.format(self.path))
+        return  self.x_mesh, self.y_mesh
+
+    def sig(self, kernel: str) -> np.ndarray:
+        """ Significance map of 'gaussian' or 'poisson' """
+        if kernel not in self.sigs:
+            self.sigs[kernel] = np.load('{}/sig_{}.npy'.format(self.path, kernel))
+        return  self.sigs[kernel]
+
+    def columns(self, keys: List[str]) -> Dict[str, np.ndarray]:
+        """ Columns of the stars, loaded only if not held in memory """
+        missing = [key for key in keys if key not in self.datas]
+        if len(missing) > 0:
+            self.datas.update(load_columns(self.path, missing))
+        return  {key: self.datas[key] for key in keys}
+
+    def n_star(self) -> int:
+        """ Number of stars of the patch """
+        if 'ra' in self.datas:
+            return  len(self.datas['ra'])
+        return  load_header(self.path)['n_rows']
@@ -1,21 +1,26 @@
+import os
 import numpy as np
 import pandas as pd
 
+from typing import Dict, Tuple
 from scipy.ndimage import label as snlabel
+from src.patch_result import PatchResult
+from src.instrument import traced
 from src.param_patch_candidate import valid_width
 
 
 
+@traced(info=lambda path, outfile, kernel, *args, **kwargs: {'kernel': kernel})
 def summarize_peaks_star_csv(path: str, outfile: str, kernel: str, s_above=5):
     """ Plotting star distribution (left panels) and density maps (right
     panels). (Others)
 
-    : path : path of all results files
+    : path : path of all results files or a PatchResult
     : outfile : result file of the dwarf
     : kernel : 'gaussian' or 'poisson'
     : s_above : significance threshold, default value = 5
     """
-    data = np.load('{}/queried-data.npy'.format(path)).item()
+    data = PatchResult.as_result(path).columns(["ra", "dec", "sig_{}".format(kernel)])
 
     ra, dec = data["ra"], data["dec"]
     sig = data["sig_{}".format(kernel)]
@@ -44,63 +49,143 @@ def summarize_peaks_star_csv(path: str, outfile: str, kernel: str, s_above=5):
 
 
 
-def summarize_peaks_pixel_csv(path: str, outfile: str, kernel: str,
-        sat_ra: float, sat_dec: float, width: float, s_above=5):
-    """ Plotting star distribution (left panels) and density maps (right
-    panels). (Others)
+def label_peaks(sig: np.ndarray, s_above=5) -> Tuple[np.ndarray, int]:
+    """ Label the connected pixels (8 neighbours) with sig > s_above in a
+    single pass
 
-    : path : path of all results files
-    : outfile : result file of the dwarf
+    : sig : significance map
+    : s_above : significance threshold
+    : return : labeled map (0 for pixels below s_above) and number of labels
+    """
+    return  snlabel(sig > s_above, structure=np.ones((3, 3)))
+
+
+def peak_catalog(x: np.ndarray, y: np.ndarray, sig: np.ndarray, s_above=5,
+                 valid_width: float = valid_width,
+                 is_pixels: bool = False) -> Tuple[Dict[str, np.ndarray], Dict]:
+    """ Catalog of the candidates of a significance map: one row per label
+    with its centroid, peak, area and bounding box, from per label
+    reductions of the pixels sorted by label, i.e. without scanning the
+    map once per label. Only the pixels within valid_width of the center
+    of the patch are kept, before anything is gathered per pixel; labels
+    are those of the whole map.
+
+    : x : ra of the pixel columns
+    : y : dec of the pixel rows
+    : sig : significance map
+    : s_above : significance threshold
+    : valid_width : width of the box around the center of the patch kept
+    : is_pixels : also return the table of the pixels of the candidates
+    : return : candidate table and pixel table (None if not is_pixels)
+    """
+    labeled_array, _ = label_peaks(sig, s_above)
+
+    # boundary filter on the pixel indexes of the map
+    valid_x = np.abs(x[:sig.shape[1]] - np.mean(x)) < 0.5 * valid_width
+    valid_y = np.abs(y[:sig.shape[0]] - np.mean(y)) < 0.5 * valid_width
+    labeled_array[~valid_y, :] = 0
+    labeled_array[:, ~valid_x] = 0
+
+    peak_yid, peak_xid = np.nonzero(labeled_array)    # x <-> y, row major
+    labels = labeled_array[peak_yid, peak_xid]
+    sigs = sig[peak_yid, peak_xid]
+
+    # pixels sorted by label and by decreasing sig within a label, so the
+    # first pixel of a label is its peak; ties keep the row major order
+    order = np.lexsort((-sigs, labels))
+    labels, sigs = labels[order], sigs[order]
+    peak_yid, peak_xid = peak_yid[order], peak_xid[order]
+    x_peaks, y_peaks = x[peak_xid], y[peak_yid]
+
+    is_first = np.ones(len(labels), dtype=bool)
+    is_first[1:] = labels[1:] != labels[:-1]
+    starts = np.flatnonzero(is_first)
+    areas = np.diff(np.append(starts, len(labels)))
+
+    catalog = {}
+    catalog["label"] = labels[starts]
+    catalog["n_pixel"] = areas
+    catalog["ra"] = np.add.reduceat(x_peaks, starts) / areas
+    catalog["dec"] = np.add.reduceat(y_peaks, starts) / areas
+    catalog["sig_mean"] = np.add.reduceat(sigs, starts) / areas
+    catalog["sig_peak"] = sigs[starts]
+    catalog["ra_peak"] = x_peaks[starts]
+    catalog["dec_peak"] = y_peaks[starts]
+    catalog["ra_min"] = np.minimum.reduceat(x_peaks, starts)
+    catalog["ra_max"] = np.maximum.reduceat(x_peaks, starts)
+    catalog["dec_min"] = np.minimum.reduceat(y_peaks, starts)
+    catalog["dec_max"] = np.maximum.reduceat(y_peaks, starts)
+
+    pixels = None
+    if is_pixels:
+        # pixels in the order of the legacy loop: by label, row major
+        order = np.lexsort((peak_xid, peak_yid, labels))
+        pixels = {"label": labels[order], "ra": x_peaks[order],
+                  "dec": y_peaks[order], "sig": sigs[order]}
+    return  catalog, pixels
+
+
+@traced(info=lambda path, outfile, kernel, *args, **kwargs: {'kernel': kernel})
+def summarize_peaks_candidate_csv(path: str, outfile: str, kernel: str,
+        s_above=5, pixel_outfile: str = None):
+    """ Write the candidate catalog of a significance map (see
+    peak_catalog) and optionally the pixels of the candidates. The files
+    are written even without any peak, as outputs of the peaks stage.
+
+    : path : path of all results files or a PatchResult
+    : outfile : candidate file of the dwarf
     : kernel : 'gaussian' or 'poisson'
-    : sat_ra : ra of the dwarf
-    : sat_dec : dec of the dwarf
-    : width : width of the map
     : s_above : significance threshold, default value = 5
+    : pixel_outfile : pixel file of the dwarf, None: no pixel file
     """
-    name = "{}-{}".format(outfile, kernel)
-    x, y = np.load('{}/meshgrids.npy'.format(path))
-    sig = np.load('{}/sig_{}.npy'.format(path, kernel))
+    result = PatchResult.as_result(path)
+    x, y = result.mesh()
+    sig = result.sig(kernel)
 
-    x_patch, y_patch = np.mean(x), np.mean(y)    # for boundary
-    mask = sig > s_above
-    labeled_array, num_features = snlabel(mask, structure=np.ones((3, 3)))
+    catalog, pixels = peak_catalog(x, y, sig, s_above, is_pixels=pixel_outfile is not None)
 
-    if num_features == 1:    # skip the case without any peaks
-        return  None
+    name = "{}-{}".format(outfile, kernel)
+    catalog["name"] = np.array([os.path.basename(name)] * len(catalog["label"]))
+    df = pd.DataFrame(data=catalog)
+    df = df[["name", "label", "ra", "dec", "sig_peak", "sig_mean", "n_pixel",
+             "ra_peak", "dec_peak", "ra_min", "ra_max", "dec_min", "dec_max"]]
+    df.to_csv("{}.csv".format(name), index=False)
+
+    if pixel_outfile is not None:
+        write_pixel_csv(pixels, "{}-{}".format(pixel_outfile, kernel), kernel)
 
-    label_s, x_peaks, y_peaks, sigs = [], [], [], []
-    for nf in range(1, num_features + 1):    # ignore pixels with 0
-        peak_yid, peak_xid = np.where(labeled_array == nf)    # x <-> y
-        label_ = [nf] * len(peak_xid)
-        label_s.append(label_)
-        x_peaks.append(x[peak_xid])
-        y_peaks.append(y[peak_yid])
-        sigs.append(sig[peak_yid, peak_xid])
-
-    if num_features > 1:
-        label_s = np.concatenate(label_s)
-        x_peaks = np.concatenate(x_peaks)
-        y_peaks = np.concatenate(y_peaks)
-        sigs = np.concatenate(sigs)
-    else:
-        label_s = np.array(label_s)
-        x_peaks = np.array(x_peaks)
-        y_peaks = np.array(y_peaks)
-        sigs = np.array(sigs)
-
-    mask = (np.abs(x_peaks - x_patch) < 0.5 * valid_width)
-    mask = (np.abs(y_peaks - y_patch) < 0.5 * valid_width) & mask
-
-    _name = np.array([name.replace("peaks/pixels/", "")] * len(label_s))
 
+def write_pixel_csv(pixels: Dict[str, np.ndarray], name: str, kernel: str):
+    """ Write the pixel table of peak_catalog in the format of peaks/pixels """
     pixel_peaks_table = {}
-    pixel_peaks_table["name"] = _name[mask]
-    pixel_peaks_table["label"] = label_s[mask]
-    pixel_peaks_table["ra"] = x_peaks[mask]
-    pixel_peaks_table["dec"] = y_peaks[mask]
-    pixel_peaks_table["sig_{}".format(kernel)] = sigs[mask]
+    pixel_peaks_table["name"] = np.array([os.path.basename(name)] * len(pixels["label"]))
+    pixel_peaks_table["label"] = pixels["label"]
+    pixel_peaks_table["ra"] = pixels["ra"]
+    pixel_peaks_table["dec"] = pixels["dec"]
+    pixel_peaks_table["sig_{}".format(kernel)] = pixels["sig"]
 
     df = pd.DataFrame(data=pixel_peaks_table)
     df = df[["name", "label", "ra", "dec", "sig_{}".format(kernel)]]
-
     df.to_csv("{}.csv".format(name), index=False)
+
+
+def summarize_peaks_pixel_csv(path: str, outfile: str, kernel: str,
+        sat_ra: float, sat_dec: float, width: float, s_above=5):
+    """ Write the pixels of the candidates of a significance map.
+
+    : path : path of all results files or a PatchResult
+    : outfile : result file of the dwarf
+    : kernel : 'gaussian' or 'poisson'
+    : sat_ra : ra of the dwarf
+    : sat_dec : dec of the dwarf
+    : width : width of the map
+    : s_above : significance threshold, default value = 5
+    """
+    result = PatchResult.as_result(path)
+    x, y = result.mesh()
+    sig = result.sig(kernel)
+
+    _, pixels = peak_catalog(x, y, sig, s_above, is_pixels=True)
+    if len(pixels["label"]) == 0:    # skip the case without any peaks
+        return  None
+    write_pixel_csv(pixels, "{}-{}".format(outfile, kernel), kernel)
@@ -7,30 +7,39 @@ import matplotlib.pyplot as plt
 
 from scipy import stats
 from src.param import *
+from src.patch_result import PatchResult
+from src.render import plot_points
+from src.instrument import traced
 
 
-_st1 = '{}  GC={}pc'.format(NAME, GC_SIZE)
-_st2 = 'd={}kpc  w={}$^\circ$'.format(round(DISTANCE / 1e3), WIDTH)
-_st3 = 's1={}$^\circ$  s2={}$^\circ$'.format(SIGMA1, SIGMA2)
-SUB_TITLE = "{}  {}  {}".format(_st1, _st2, _st3)
+def sub_title(gc_size: float, sigma1: float) -> str:
+    """ Title of the plots of one scale of the search """
+    _st1 = '{}  GC={}pc'.format(NAME, gc_size)
+    _st2 = 'd={}kpc  w={}$^\circ$'.format(round(DISTANCE / 1e3), WIDTH)
+    _st3 = 's1={}$^\circ$  s2={}$^\circ$'.format(sigma1, SIGMA2)
+    return  "{}  {}  {}".format(_st1, _st2, _st3)
 
 
-def visualize_2_panel(path: str, outfile: str, kernel: str, s_above=5):
+@traced(info=lambda path, outfile, kernel, *args, **kwargs: {'kernel': kernel})
+def visualize_2_panel(path: str, outfile: str, kernel: str, title: str,
+                      s_above=5):
     """ Plotting star distribution (left panels) and density maps (right
     panels). (Others)
 
-    : path : path of the result file
+    : path : path of the result file or a PatchResult
     : outfile : where to output the plot
     : kernel : 'gaussian' or 'poisson'
+    : title : title of the figure, e.g. sub_title() of the scale
     : s_above : significance threshold, default value = 5
     """
     sns.set(style="white", color_codes=True, font_scale=1)
     fig, axes = plt.subplots(1, 2, figsize=(10, 5))
-    fig.suptitle(SUB_TITLE, y=0.93)
+    fig.suptitle(title, y=0.93)
 
-    x, y = np.load('{}/meshgrids.npy'.format(path))    # coordinates
-    sig = np.load('{}/sig_{}.npy'.format(path, kernel))
-    data = np.load('{}/queried-data.npy'.format(path)).item()
+    result = PatchResult.as_result(path)
+    x, y = result.mesh()    # coordinates
+    sig = result.sig(kernel)
+    data = result.columns(["ra", "dec", "sig_{}".format(kernel)])
 
     ra, dec, n_star = data["ra"], data["dec"], len(data["ra"])
     extent = [x.min(), x.max(), y.min(), y.max()]    # arg extent for imshow
@@ -38,8 +47,11 @@ def visualize_2_panel(path: str, outfile: str, kernel: str, s_above=5):
     is_peak = sig > s_above
     mask = data["sig_{}".format(kernel)] > s_above
 
-    axes[0].plot(ra, dec, '.', c='deepskyblue', ms=0.5, alpha=0.5)
-    axes[0].plot(ra[mask], dec[mask], '.', c='orange', ms=1)
+    dpi = 300
+    plot_points(axes[0], ra, dec, 'deepskyblue', PLOT_N_STAR_MAX, dpi, extent,
+                ms=0.5, alpha=0.5)
+    plot_points(axes[0], ra[mask], dec[mask], 'orange', PLOT_N_STAR_MAX, dpi, extent,
+                ms=1)
     axes[0].set_title('%d stars' % n_star)
     axes[1].set_title('%s:  sig > %0.1f= %d pixels' % (kernel, s_above, np.sum(is_peak)))
 
@@ -51,25 +63,29 @@ def visualize_2_panel(path: str, outfile: str, kernel: str, s_above=5):
         axes[u].set_xlim(axes[u].set_xlim()[::-1])    # flipping
 
     _filename = "{}-{}.png".format(outfile, kernel)
-    plt.savefig(_filename, bbox_inches='tight', dpi=300)
+    plt.savefig(_filename, bbox_inches='tight', dpi=dpi)
+    plt.close(fig)    # many patches may be plotted by one process
 
 
 
-def hist_2_panel(path: str, outfile: str, kernel: str, s_above=5):
+@traced(info=lambda path, outfile, kernel, *args, **kwargs: {'kernel': kernel})
+def hist_2_panel(path: str, outfile: str, kernel: str, title: str,
+                 s_above=5):
     """ Plotting histograms (left panels) and normalized histograms (right
     panels). (Others)
 
-    : path : path of the result file
+    : path : path of the result file or a PatchResult
     : outfile : where to output the plot
     : kernel : 'gaussian' or 'poisson'
+    : title : title of the figure, e.g. sub_title() of the scale
     : s_above : significance threshold, default value = 5
     """
     sns.set(style="white", color_codes=True, font_scale=1)
     fig, axes = plt.subplots(1, 2, figsize=(10, 5))
-    fig.suptitle(SUB_TITLE, y=0.97)
+    fig.suptitle(title, y=0.97)
     plt.subplots_adjust(wspace=0.3)
 
-    sig = np.load('{}/sig_{}.npy'.format(path, kernel))
+    sig = PatchResult.as_result(path).sig(kernel)
     is_peak = sig > s_above
     sig_finite_flat = sig[np.isfinite(sig)].flatten()
 
@@ -98,3 +114,4 @@ def hist_2_panel(path: str, outfile: str, kernel: str, s_above=5):
 
     _filename = "{}-{}.png".format(outfile, kernel)
     plt.savefig(_filename, bbox_inches='tight', dpi=100)
+    plt.close(fig)
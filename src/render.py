@@ -0,0 +1,100 @@
+import numpy as np
+
+from typing import List, Tuple
+from matplotlib.colors import to_rgb
+
+
+
+def axes_shape(ax, dpi: float) -> Tuple[int, int]:
+    """ Number of pixels (rows, columns) of the axes in the saved figure
+
+    : ax : matplotlib axes
+    : dpi : dpi of savefig
+    """
+    bbox = ax.get_position()    # fraction of the figure
+    width, height = ax.figure.get_size_inches()
+    nx = max(int(np.ceil(bbox.width * width * dpi)), 1)
+    ny = max(int(np.ceil(bbox.height * height * dpi)), 1)
+    return  ny, nx
+
+
+def data_extent(xs: List[np.ndarray], ys: List[np.ndarray],
+                margin: float = 0.05) -> List[float]:
+    """ Extent [x_min, x_max, y_min, y_max] of the finite points of several
+    sets, with a margin in fraction of the range, as autoscale would do
+
+    : xs : list of x arrays
+    : ys : list of y arrays
+    : margin : margin on each side in fraction of the range
+    """
+    x, y = np.concatenate(xs), np.concatenate(ys)
+    is_finite = np.isfinite(x) & np.isfinite(y)
+    if np.sum(is_finite) == 0:
+        return  [0., 1., 0., 1.]
+    x, y = x[is_finite], y[is_finite]
+    extent = []
+    for v in [x, y]:
+        dv = margin * (v.max() - v.min()) or 0.5
+        extent += [v.min() - dv, v.max() + dv]
+    return  extent
+
+
+def density_rgba(x: np.ndarray, y: np.ndarray, extent: List[float],
+                 shape: Tuple[int, int], color: str, alpha: float = 1.) -> np.ndarray:
+    """ Points binned at the resolution of the image: every pixel has the
+    color of the points with the opacity of its count of points stacked,
+    1 - (1 - alpha)^count, as if they were drawn one by one.
+
+    : x : x of the points
+    : y : y of the points
+    : extent : [x_min, x_max, y_min, y_max] of the image
+    : shape : (rows, columns) of the image
+    : color : color of the points
+    : alpha : opacity of one point
+    : return : rgba image, origin lower
+    """
+    is_finite = np.isfinite(x) & np.isfinite(y)
+    counts, _, _ = np.histogram2d(
+        y[is_finite], x[is_finite], bins=shape,
+        range=[sorted(extent[2:]), sorted(extent[:2])])
+    if extent[2] > extent[3]:
+        counts = counts[::-1, :]
+    if extent[0] > extent[1]:
+        counts = counts[:, ::-1]
+
+    rgba = np.zeros(shape + (4,))
+    rgba[..., :3] = to_rgb(color)
+    rgba[..., 3] = 1. - (1. - min(alpha, 0.999)) ** counts
+    return  rgba
+
+
+def plot_points(ax, x: np.ndarray, y: np.ndarray, color: str, n_max: int,
+                dpi: float, extent: List[float] = None, ms: float = 1.,
+                alpha: float = 1., label: str = None):
+    """ Draw points as markers, or as a density image at the resolution of
+    the saved figure when there are more than n_max points, so that the
+    time to plot is bounded by the pixels of the image instead of the
+    number of points.
+
+    : ax : matplotlib axes
+    : x : x of the points
+    : y : y of the points
+    : color : color of the points
+    : n_max : max number of points drawn as markers
+    : dpi : dpi of savefig
+    : extent : [x_min, x_max, y_min, y_max] of the density image, None: limits of ax
+    : ms : marker size
+    : alpha : opacity of one point
+    : label : label of the legend
+    """
+    if len(x) <= n_max:
+        ax.plot(x, y, '.', c=color, ms=ms, alpha=alpha, label=label)
+        return
+
+    if extent is None:
+        extent = list(ax.get_xlim()) + list(ax.get_ylim())
+    rgba = density_rgba(x, y, extent, axes_shape(ax, dpi), color, alpha)
+    ax.imshow(rgba, extent=extent, origin='lower', interpolation='nearest',
+              aspect=ax.get_aspect(), zorder=2)
+    if label is not None:
+        ax.plot([], [], '.', c=color, ms=ms, label=label)    # legend entry
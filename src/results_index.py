@@ -0,0 +1,160 @@
+import os
+import json
+import sqlite3
+import tempfile
+import pandas as pd
+
+from typing import List
+from src.tools import create_dir
+from src.incremental import to_json
+
+
+FILE_MANIFEST = 'manifest.json'    # metadata of a run in its results directory
+
+
+
+def results_dir(name: str, root: str = 'results') -> str:
+    """ Results directory of a candidate name, i.e. without the kernel
+    after the last '-', e.g. gaia_Fornax=3-...-gc10s0.0041s0.14s0.5-poisson """
+    return  "{}/{}".format(root, name.rsplit("-", 1)[0])
+
+
+def write_run_manifest(dir_name: str, manifest: dict):
+    """ Write the manifest of a run (one scale of a patch): parameters, number
+    of stars, peak counts and timings. Renamed into place so the index never
+    reads a partial file.
+
+    : dir_name : results directory of the scale
+    : manifest : json serializable dict
+    """
+    fd, tmp = tempfile.mkstemp(dir=dir_name, suffix='.tmp')
+    with os.fdopen(fd, 'w') as f:
+        json.dump(manifest, f, sort_keys=True, indent=1, default=to_json)
+    os.replace(tmp, "{}/{}".format(dir_name, FILE_MANIFEST))
+
+
+def read_run_manifest(dir_name: str) -> dict:
+    """ Manifest of a run, None if there is none """
+    try:
+        with open("{}/{}".format(dir_name, FILE_MANIFEST)) as f:
+            return  json.load(f)
+    except (IOError, ValueError):
+        return  None
+
+
+
+class ResultsIndex(object):
+    def __init__(self, path: str = 'summary/results-index.sqlite'):
+        """ SQLite catalog of the run manifests of a results root, so that
+        summaries are queries instead of reading every catalog and map.
+        update() only parses the manifests changed since the last update.
+
+        : path : path of the database file
+        """
+        self.path = path
+        create_dir(os.path.dirname(path) or '.')
+        self.conn = sqlite3.connect(path)
+        self.conn.executescript("""
+            create table if not exists runs (
+                dir text primary key, mtime real, name text, database text,
+                database_short text, gc_size integer, sigma1 real, sigma2 real,
+                sigma3 real, ra real, dec real, width real, pixel_size real,
+                distance real, n_star integer, wall real, manifest text);
+            create table if not exists peaks (
+                dir text, kernel text, threshold real, n_pixel integer,
+                primary key (dir, kernel, threshold));
+            """)
+
+    def __str__(self):
+        n_run = self.conn.execute("select count(*) from runs").fetchone()[0]
+        s1 = "This is a ResultsIndex object: \n"
+        s2 = "    database = {}\n".format(self.path)
+        s3 = "    %d runs indexed" % n_run
+        return  "{}{}{}".format(s1, s2, s3)
+
+    def close(self):
+        self.conn.close()
+
+    def update(self, root: str = 'results') -> dict:
+        """ Index the manifests of the results directories of 'root'. Only
+        the manifests modified since the last update are parsed, and the
+        runs whose directory or manifest vanished are removed.
+
+        : root : root of the results directories
+        : return : counts of 'added', 'unchanged', 'removed' and 'missing' (no manifest)
+        """
+        indexed = dict(self.conn.execute("select dir, mtime from runs"))
+        counts = {'added': 0, 'unchanged': 0, 'removed': 0, 'missing': 0}
+        seen = set()
+        for entry in os.scandir(root) if os.path.isdir(root) else []:
+            if not entry.is_dir():
+                continue
+            try:
+                mtime = os.stat("{}/{}".format(entry.path, FILE_MANIFEST)).st_mtime
+            except OSError:
+                counts['missing'] += 1
+                continue
+            seen.add(entry.path)
+            if indexed.get(entry.path) == mtime:
+                counts['unchanged'] += 1
+                continue
+            manifest = read_run_manifest(entry.path)
+            if manifest is None:
+                counts['missing'] += 1
+                continue
+            self.insert(entry.path, mtime, manifest)
+            counts['added'] += 1
+
+        for dir_name in set(indexed) - seen:
+            self.remove(dir_name)
+            counts['removed'] += 1
+        self.conn.commit()
+        return  counts
+
+    def insert(self, dir_name: str, mtime: float, manifest: dict):
+        """ Insert or replace the run of a manifest """
+        self.remove(dir_name)
+        keys = ['name', 'database', 'database_short', 'gc_size', 'sigma1', 'sigma2',
+                'sigma3', 'ra', 'dec', 'width', 'pixel_size', 'distance', 'n_star']
+        row = [dir_name, mtime] + [manifest.get(key) for key in keys]
+        row += [sum(manifest.get('timings', {}).values()), json.dumps(manifest)]
+        self.conn.execute("insert into runs values ({})".format(
+            ", ".join(["?"] * len(row))), row)
+        for kernel, counts in manifest.get('peaks', {}).items():
+            self.conn.executemany(
+                "insert into peaks values (?, ?, ?, ?)",
+                [(dir_name, kernel, float(threshold), n_pixel)
+                 for threshold, n_pixel in counts.items()])
+
+    def remove(self, dir_name: str):
+        """ Remove the run of a results directory """
+        self.conn.execute("delete from runs where dir = ?", (dir_name,))
+        self.conn.execute("delete from peaks where dir = ?", (dir_name,))
+
+    def query(self, sql: str, params: tuple = ()) -> pd.DataFrame:
+        """ Run a sql query on the tables runs and peaks """
+        return  pd.read_sql_query(sql, self.conn, params=params)
+
+    def scales(self) -> pd.DataFrame:
+        """ gc size and sigma1 of every run, by results directory """
+        return  self.query("select dir, gc_size, sigma1 from runs")
+
+    def thresholds(self) -> List[float]:
+        """ Significance thresholds with indexed peak counts """
+        rows = self.conn.execute("select distinct threshold from peaks order by threshold")
+        return  [row[0] for row in rows]
+
+    def summary(self, s_above: float = 5.) -> pd.DataFrame:
+        """ Number of stars and of pixels with sig > s_above of both kernels
+        for every run, as in summary/summary.csv """
+        if len(self.thresholds()) > 0 and float(s_above) not in self.thresholds():
+            raise ValueError('No peak counts at s_above = %s, indexed thresholds: %s'
+                             % (s_above, self.thresholds()))
+        return  self.query("""
+            select r.database_short || '_' || r.name as name, r.gc_size, r.n_star,
+                   g.n_pixel as sig_g_peak, p.n_pixel as sig_p_peak
+            from runs r
+            left join peaks g on g.dir = r.dir and g.kernel = 'gaussian' and g.threshold = ?
+            left join peaks p on p.dir = r.dir and p.kernel = 'poisson' and p.threshold = ?
+            order by r.dir
+            """, (float(s_above), float(s_above)))
@@ -0,0 +1,121 @@
+import json
+import numpy as np
+
+from typing import Dict, List, Tuple
+from src.columnar import save_columns, load_columns, columnar_dir
+
+
+
+class StarStore(object):
+    def __init__(self, datas: Dict[str, np.ndarray], cell: float = 0.05):
+        """ Spatial index of the stars queried once for the union footprint
+        of all the patches of a dwarf. The rows are sorted once by their
+        cell on a ra/dec grid, so the stars of one row of cells form a
+        contiguous slice and a box is cut out by visiting only the cells it
+        touches, never the full table.
+
+        : datas : dict of columns, must include 'ra' and 'dec'
+        : cell : size of the grid cells in deg
+        """
+        self.cell = cell
+        ra, dec = datas['ra'], datas['dec']
+        self.n_star = len(ra)
+        if self.n_star > 0:
+            self.ra_min, self.dec_min = np.min(ra), np.min(dec)
+            self.nx = int(np.floor((np.max(ra) - self.ra_min) / cell)) + 1
+            self.ny = int(np.floor((np.max(dec) - self.dec_min) / cell)) + 1
+        else:
+            self.ra_min, self.dec_min, self.nx, self.ny = 0., 0., 1, 1
+
+        cells = self.cell_id(self.cell_x(ra), self.cell_y(dec))
+        order = np.argsort(cells, kind='stable')
+        self.datas = {key: np.asarray(column)[order]
+                      for key, column in datas.items()}
+        # stars of cell c are the rows start[c] ... start[c + 1] - 1
+        self.start = np.zeros(self.nx * self.ny + 1, dtype=np.int64)
+        self.start[1:] = np.cumsum(np.bincount(cells, minlength=self.nx * self.ny))
+
+    @classmethod
+    def load(cls, path: str, name: str = 'star-store',
+             columns: List[str] = None) -> 'StarStore':
+        """ Store saved by save(), memory mapped: a query only reads the
+        rows of the cells it touches, and processes reading the same store
+        share it through the page cache.
+
+        : path : results directory
+        : name : name of the store
+        : columns : names of the needed columns, None for all
+        """
+        store = cls.__new__(cls)
+        with open("{}/grid.json".format(columnar_dir(path, name))) as f:
+            grid = json.load(f)
+        store.cell, store.n_star = grid['cell'], grid['n_star']
+        store.ra_min, store.dec_min = grid['ra_min'], grid['dec_min']
+        store.nx, store.ny = grid['nx'], grid['ny']
+        store.start = np.load("{}/grid-start.npy".format(columnar_dir(path, name)))
+        store.datas = load_columns(path, columns, name)
+        return  store
+
+    def save(self, path: str, name: str = 'star-store'):
+        """ Save the sorted columns (see src.columnar) and the grid
+
+        : path : results directory
+        : name : name of the store
+        """
+        save_columns(path, self.datas, name)
+        np.save("{}/grid-start.npy".format(columnar_dir(path, name)), self.start)
+        grid = {'cell': self.cell, 'n_star': self.n_star, 'ra_min': float(self.ra_min),
+                'dec_min': float(self.dec_min), 'nx': self.nx, 'ny': self.ny}
+        with open("{}/grid.json".format(columnar_dir(path, name)), 'w') as f:
+            json.dump(grid, f)
+
+    def __str__(self):
+        s1 = "This is a StarStore object: \n"
+        s2 = "    %d stars in %d x %d cells\n" % (self.n_star, self.nx, self.ny)
+        s3 = "    cell size = %0.4f deg" % self.cell
+        return  "{}{}{}".format(s1, s2, s3)
+
+    def cell_x(self, ra: np.ndarray) -> np.ndarray:
+        """ Column of the cells, clipped to the grid """
+        ix = np.floor((np.asarray(ra) - self.ra_min) / self.cell)
+        return  np.clip(ix, 0, self.nx - 1).astype(np.int64)
+
+    def cell_y(self, dec: np.ndarray) -> np.ndarray:
+        """ Row of the cells, clipped to the grid """
+        iy = np.floor((np.asarray(dec) - self.dec_min) / self.cell)
+        return  np.clip(iy, 0, self.ny - 1).astype(np.int64)
+
+    def cell_id(self, ix: np.ndarray, iy: np.ndarray) -> np.ndarray:
+        """ Flat index of the cells, ordered by row """
+        return  iy * self.nx + ix
+
+    def box_rows(self, box: Tuple[float, float, float, float]) -> np.ndarray:
+        """ Rows of the stars with ra_min < ra < ra_max and
+        dec_min < dec < dec_max, the same box as the sql query.
+
+        : box : (ra_min, ra_max, dec_min, dec_max) in deg
+        : return : sorted row indices in the store
+        """
+        ra_min, ra_max, dec_min, dec_max = box
+        ix0, ix1 = self.cell_x([ra_min, ra_max])
+        iy0, iy1 = self.cell_y([dec_min, dec_max])
+
+        # one contiguous slice per row of cells
+        rows = np.arange(iy0, iy1 + 1)
+        lo = self.start[self.cell_id(ix0, rows)]
+        hi = self.start[self.cell_id(ix1, rows) + 1]
+        n = hi - lo
+        index = np.repeat(lo - np.cumsum(n) + n, n) + np.arange(np.sum(n))
+
+        ra, dec = self.datas['ra'][index], self.datas['dec'][index]
+        mask = (ra_min < ra) & (ra < ra_max) & (dec_min < dec) & (dec < dec_max)
+        return  index[mask]
+
+    def query_box(self, box: Tuple[float, float, float, float]) -> Dict[str, np.ndarray]:
+        """ Columns of the stars inside a box.
+
+        : box : (ra_min, ra_max, dec_min, dec_max) in deg
+        : return : dict of columns, only the stars of the box are copied
+        """
+        index = self.box_rows(box)
+        return  {key: column[index] for key, column in self.datas.items()}
@@ -49,11 +49,17 @@ def create_dir(dir_name: str):
 
 
 def df_concat(paths: List[str]) -> pd.DataFrame:
-    """ Concatenate multiple pandas dataframe.
+    """ Concatenate multiple pandas dataframe. Header-only files, e.g. of
+    patches without peaks, are left out: their columns are read as object
+    and would turn the numeric columns of the others to object. If every
+    file is header-only, the header of the first one is returned.
 
     : paths : a list of paths for csv files
     : return : concatenated dataframe
     """
     dfs = [pd.read_csv(path) for path in paths]
-    df_con = pd.concat(dfs)
+    dfs_full = [df for df in dfs if len(df) > 0]
+    if len(dfs_full) == 0:
+        return  dfs[0]
+    df_con = pd.concat(dfs_full)
     return  df_con
@@ -0,0 +1,181 @@
+import numpy as np
+
+from typing import Tuple
+from scipy.stats import poisson
+from scipy.special import erfc, erfcinv
+
+
+
+def z_score_poisson_exact(lamb: np.ndarray, x: np.ndarray) -> np.ndarray:
+    """ Calculate the z-score of the tail probability of poisson via N(0, 1)
+    according to z = sqrt(2) * erfinv(1 - 2 * sf(x, lambda)), where sf
+    (survival function) = 1 - CDF.
+
+    : lamb : expected background number count from outer aperture (lambda)
+    : x : number count of observed stars in the inner aperture
+    : return : z-score of poisson map
+    """
+    return  np.sqrt(2.) * erfcinv(2. * poisson.sf(x, lamb))
+
+
+class PoissonZScore(object):
+    def __init__(self, tol: float = 1e-3, n_per_decade: int = 64,
+                 lamb_min: float = 1e-4, n_check: int = 3):
+        """ Fast Poisson z-score for integer observed counts. For every count
+        n the z-score is tabulated on a grid uniform in log10(lambda) and
+        linearly interpolated. Each interval of the table is compared to the
+        exact z-score at n_check points evenly spaced inside it, and pixels
+        falling in an interval failing 'tol' (or outside the table) are
+        evaluated exactly. This is a check on a sample, not a bound on the
+        error between the points. The table is kept and extended across
+        calls. Below z ~ -7, sf rounds towards 1 and even the exact z-score
+        is only good to ~1e-2, which tol cannot improve.
+
+        : tol : max error of the interpolated z-score at the checked points
+        : n_per_decade : number of table nodes per decade of lambda
+        : lamb_min : smaller lambda are always evaluated exactly
+        : n_check : number of checked points inside each interval
+        """
+        self.tol = tol
+        self.h = 1. / n_per_decade
+        self.lamb_min = lamb_min
+        self.checks = np.arange(1, n_check + 1) / (n_check + 1.)
+        self.n_max = -1    # the table covers counts 0 ... n_max
+        self.k_min, self.k_max = 0, -1    # and nodes 10**(k * self.h)
+        self.table = np.zeros((0, 0))
+        self.is_accurate = np.zeros((0, 0), dtype=bool)
+
+    def __str__(self):
+        s1 = "This is a PoissonZScore object: \n"
+        s2 = "    counts 0 - %d\n" % self.n_max
+        s3 = "    lambda %0.2e - %0.2e\n" % (10**(self.k_min * self.h),
+                                             10**(self.k_max * self.h))
+        s4 = "    %d intervals exceed tol = %0.1e" % (
+            np.sum(~self.is_accurate), self.tol)
+        return  "{}{}{}{}".format(s1, s2, s3, s4)
+
+    def nodes(self, n0: int, n1: int, k0: int, k1: int) -> np.ndarray:
+        """ Exact z-score of counts n0 ... n1 at nodes k0 ... k1 """
+        n = np.arange(n0, n1 + 1)[:, None]
+        k = np.arange(k0, k1 + 1)[None, :]
+        return  z_score_poisson_exact(10**(k * self.h), n)
+
+    def accurate(self, table: np.ndarray, n0: int, k0: int) -> np.ndarray:
+        """ Intervals between the columns of a block of the table, of counts
+        n0 ... and nodes k0 ..., whose interpolation is within tol of the
+        exact z-score at the checked points """
+        n = np.arange(n0, n0 + table.shape[0])[:, None]
+        k = np.arange(k0, k0 + table.shape[1] - 1)[None, :]
+        is_accurate = np.ones((table.shape[0], table.shape[1] - 1), dtype=bool)
+        for t in self.checks:
+            z = z_score_poisson_exact(10**((k + t) * self.h), n)
+            z_lin = (1. - t) * table[:, :-1] + t * table[:, 1:]
+            with np.errstate(invalid='ignore'):
+                is_accurate &= np.abs(z_lin - z) <= self.tol
+        return  is_accurate
+
+    def extend(self, n_max: int, k_min: int, k_max: int):
+        """ Extend the table to cover counts 0 ... n_max and nodes
+        k_min ... k_max, keeping the range already built: only the new
+        columns of the counts already covered and the new counts are
+        evaluated """
+        if self.n_max < 0:    # empty table of the requested nodes
+            self.k_min, self.k_max = k_min, k_max
+            self.table = np.zeros((0, k_max - k_min + 1))
+            self.is_accurate = np.zeros((0, k_max - k_min), dtype=bool)
+        n_max = max(n_max, self.n_max)
+        k_min = min(k_min, self.k_min)
+        k_max = max(k_max, self.k_max)
+        if (n_max, k_min, k_max) == (self.n_max, self.k_min, self.k_max):
+            return
+
+        # new nodes on both sides of the counts already covered
+        n_old = self.n_max + 1
+        n_left, n_right = self.k_min - k_min, k_max - self.k_max
+        table = np.hstack([self.nodes(0, self.n_max, k_min, self.k_min - 1), self.table,
+                           self.nodes(0, self.n_max, self.k_max + 1, k_max)])
+        is_accurate = np.hstack([
+            self.accurate(table[:, :n_left + 1], 0, k_min), self.is_accurate,
+            self.accurate(table[:, table.shape[1] - n_right - 1:], 0, self.k_max)])
+
+        # new counts on all the nodes
+        bottom = self.nodes(n_old, n_max, k_min, k_max)
+        self.table = np.vstack([table, bottom])
+        self.is_accurate = np.vstack([is_accurate, self.accurate(bottom, n_old, k_min)])
+        self.n_max, self.k_min, self.k_max = n_max, k_min, k_max
+
+    def locate(self, lamb: np.ndarray,
+               x: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        """ Table coordinates of the pixels which can be interpolated.
+
+        : return : mask of such pixels, their count n, node k and weight w
+        """
+        with np.errstate(invalid='ignore', divide='ignore'):
+            is_table = np.isfinite(lamb) & (lamb > self.lamb_min) & (x >= 0)
+            n = np.floor(x[is_table]).astype(int)
+            u = np.log10(lamb[is_table]) / self.h
+        k = np.floor(u).astype(int)
+        if len(n) > 0:
+            self.extend(int(n.max()), int(k.min()), int(k.max()) + 1)
+        return  is_table, n, k - self.k_min, u - k
+
+    def __call__(self, lamb: np.ndarray, x: np.ndarray,
+                 s_exact: float = None) -> np.ndarray:
+        """ Z-score of the Poisson tail probability, within 'tol' of
+        z_score_poisson_exact.
+
+        : lamb : expected background number count (lambda)
+        : x : number count of observed stars (floored as poisson.sf does)
+        : s_exact : if given, pixels within tol of this significance are
+                    evaluated exactly so thresholding at it is unchanged
+        : return : z-score of poisson map
+        """
+        lamb, x = np.broadcast_arrays(lamb, x)
+        is_table, n, k, w = self.locate(lamb, x)
+
+        z = np.empty(lamb.shape)
+        z_table = (1. - w) * self.table[n, k] + w * self.table[n, k + 1]
+        is_exact = ~self.is_accurate[n, k]
+        if s_exact is not None:
+            is_exact |= np.abs(z_table - s_exact) <= self.tol
+        z[is_table] = z_table
+
+        exact = ~is_table
+        exact[is_table] = is_exact
+        z[exact] = z_score_poisson_exact(lamb[exact], x[exact])
+        return  z
+
+    def critical_count(self, s_above: float) -> np.ndarray:
+        """ Smallest count reaching z > s_above at each node of the table.
+        Since sf(n, lambda) grows with lambda, the value at the lower node
+        of an interval is a lower bound for the whole interval. One count
+        of margin is kept against rounding in poisson.isf. """
+        p_th = 0.5 * erfc(s_above / np.sqrt(2.))
+        lamb = 10**(np.arange(self.k_min, self.k_max + 1) * self.h)
+        return  poisson.isf(p_th, lamb) - 1
+
+    def threshold(self, lamb: np.ndarray, x: np.ndarray,
+                  s_above: float) -> np.ndarray:
+        """ Detection only mode: the exact z-score is only computed for the
+        pixels whose count can reach z > s_above, found by comparing the
+        count to the critical count of lambda. The other pixels are set to
+        nan, so every pixel with z > s_above is still exact.
+
+        : lamb : expected background number count (lambda)
+        : x : number count of observed stars
+        : s_above : significance threshold
+        : return : z-score of the candidate pixels, nan elsewhere
+        """
+        lamb, x = np.broadcast_arrays(lamb, x)
+        is_table, n, k, _ = self.locate(lamb, x)
+
+        candidate = ~is_table
+        candidate[is_table] = n >= self.critical_count(s_above)[k]
+
+        z = np.full(lamb.shape, np.nan)
+        z[candidate] = z_score_poisson_exact(lamb[candidate], x[candidate])
+        return  z
+
+
+# table shared by all KDE_MWSatellite objects of a process
+DEFAULT_POISSON_Z_SCORE = PoissonZScore()
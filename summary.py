@@ -5,8 +5,16 @@ import multiprocessing
 
 from functools import partial
 from src.tools import create_dir, df_concat
-from src.hips_image import multiprocessing_plot_hips_sky_image
-from src.param_patch_candidate import s_above, res_image, hips_surveys
+from src import hips_image, render
+from src.dedup import merge_candidates
+from src.results_index import ResultsIndex, results_dir
+from src.incremental import Stage, code_hash, read_stamp
+from src.hips_cache import HipsTileCache
+from src.hips_image import (multiprocessing_plot_hips_sky_image, candidate_geometry,
+                            build_star_store)
+from src.param import IS_INCREMENTAL
+from src.param_patch_candidate import (s_above, res_image, hips_surveys, match_fac,
+                                       hips_cache_dir, is_hips_fetch)
 
 
 num_workers = multiprocessing.cpu_count()
@@ -24,49 +32,39 @@ if __name__ == '__main__':
     # df_con.to_csv("{}/all_stars_peaks.csv".format(output_file), index=False)
     # print('Done :) \n')
 
+    print('Indexing the run manifests: \n')
+    # manifests of the runs indexed in sqlite, only the new ones are read
+    index = ResultsIndex("{}/results-index.sqlite".format(output_file))
+    counts = index.update('results')
+    print('    indexed %d new runs, %d unchanged, %d removed' % (
+        counts['added'], counts['unchanged'], counts['removed']))
+    if counts['missing'] > 0:
+        print('    skipping %d results without manifest (rerun main.py)' % counts['missing'])
+    print('Done :) \n')
+
+    print('Concatenating all peaks/candidates/csv files\n')
+    paths = glob.glob('peaks/candidates/*')
+    df_con = df_concat(paths)
+    df_con.to_csv("{}/all_candidates.csv".format(output_file), index=False)
+    print('Done :) \n')
+
+    print('Merging the candidates of overlapping patches\n')
+    # gc size and sigma1 of each candidate from the manifest of its results
+    df_unique = merge_candidates(df_con, index.scales(), match_fac)
+    df_unique.to_csv("{}/unique_candidates.csv".format(output_file), index=False)
+    print('%d unique candidates out of %d \n' % (len(df_unique), len(df_con)))
+
     print('Concatenating all peaks/pixels/csv files\n')
     paths = glob.glob('peaks/pixels/*')
     df_con = df_concat(paths)
+    df_con = df_con.merge(df_unique[['name', 'label']], on=['name', 'label'])    # no duplicates
     df_con.to_csv("{}/all_pixels_peaks.csv".format(output_file), index=False)
     print('Done :) \n')
 
 
     print('Generating summary.csv: \n')
-    paths = glob.glob('results/*')
-
-    names, gc_sizes, n_stars = [], [], []
-    sig_g_peaks, sig_p_peaks = [], []
-
-    for path in paths:
-        name = path.split("-")[0].replace("results/", "")
-        if 'gaia' in name:
-            gc_size = int(path.split("-")[5].split("s")[0].replace("gc", ""))
-        else:
-            gc_size = int(path.split("-")[3].split("s")[0].replace("gc", ""))
-
-        try:
-            n_star = len(np.load("{}/queried-data.npy".format(path)).item()['ra'])
-            sig_g = np.load("{}/sig_gaussian.npy".format(path))
-            sig_p = np.load("{}/sig_poisson.npy".format(path))
-        except:
-            print('    skipping Error csv: %s' %name)
-            continue
-
-        names.append(name)
-        gc_sizes.append(gc_size)
-        n_stars.append(n_star)
-        sig_g_peaks.append(np.sum(sig_g > s_above))
-        sig_p_peaks.append(np.sum(sig_p > s_above))
-
-    searching_table = {}
-    searching_table["name"] = names
-    searching_table["gc_size"] = gc_sizes
-    searching_table["n_star"] = n_stars
-    searching_table["sig_g_peak"] = sig_g_peaks
-    searching_table["sig_p_peak"] = sig_p_peaks
-
-    df = pd.DataFrame(data=searching_table)
-    df = df[["name", "gc_size", "n_star", "sig_g_peak", "sig_p_peak"]]
+    df = index.summary(s_above)
+    index.close()
     df.to_csv("{}/summary.csv".format(output_file), index=False)
     print('Done :) \n')
 
@@ -75,49 +73,69 @@ if __name__ == '__main__':
     path = "images"
     create_dir(path)
 
-    name_df, label_df, ra_df, dec_df, sigma1_df, sig_p_df = [], [], [], [], [], []
-    df = pd.read_csv("{}/all_pixels_peaks.csv".format(output_file))
-
-    name_set = set(df['name'])
-    for name in name_set:
-        if "gaussian" in name:
-            continue    # don't plot images of gaussian kernel
-        df_name = df.loc[df['name'] == name]
-
-        label_set = set(df_name['label'])
-        for label in label_set:
-            df_name_label = df_name.loc[df_name['label'] == label]
-            ra = np.mean(df_name_label['ra'])
-            dec = np.mean(df_name_label['dec'])
-            sig_p = np.mean(df_name_label['sig_poisson'])
-
-            if sig_p < s_above:
-                continue    # don't plot images with sig < s_above
-
-            name_list = name.split("-")
-            if 'gaia' in name:
-                sigma1 = float('%0.4f' % float(name_list[5].split('s')[1]))
-            else:
-                sigma1 = float('%0.4f' % float(name_list[3].split('s')[1]))
-
-            ra_df.append(ra)
-            dec_df.append(dec)
-            name_df.append(name)
-            label_df.append(label)
-            sig_p_df.append(sig_p)
-            sigma1_df.append(sigma1)
+    df = pd.read_csv("{}/unique_candidates.csv".format(output_file))
+    df = df.loc[df['kernel'] != "gaussian"]    # don't plot images of gaussian kernel
+    df = df.loc[df['sig_mean'] >= s_above]    # don't plot images with sig < s_above
+
+    name_df, label_df = list(df['name']), list(df['label'])
+    ra_df, dec_df, sig_p_df = list(df['ra']), list(df['dec']), list(df['sig_mean'])
+    sigma1_df = list(df['sigma1'])
 
     df = None    # free memory
 
+    # skip the images whose candidate, results and code are unchanged
+    stamp_dir = "{}/stamps".format(path)
+    code = code_hash([hips_image, render])
+    stages, todo = [], []
+    for i in range(len(name_df)):
+        kde = read_stamp(results_dir(name_df[i]), 'kde')
+        inputs = {'kde': None if kde is None else kde['hash'],
+                  'candidate': [ra_df[i], dec_df[i], sig_p_df[i], sigma1_df[i]],
+                  'surveys': hips_surveys, 'res': res_image, 'code': code}
+        stage = Stage(stamp_dir, "{}-target{}".format(name_df[i], label_df[i]), inputs)
+        if not (IS_INCREMENTAL and stage.is_fresh()):
+            stages.append(stage)
+            todo.append(i)
+    print('Skipping %d images: inputs unchanged' % (len(name_df) - len(todo)))
+
+    # candidates of the same results directory are plotted one after the
+    # other, so each worker opens few star stores
+    order = sorted(range(len(todo)), key=lambda j: name_df[todo[j]])
+    stages, todo = [stages[j] for j in order], [todo[j] for j in order]
+
     num_target = len(name_df)
-    iterable = np.arange(num_target)
+    iterable = np.array(todo, dtype=int)
     print('There are %d candidates\n' %num_target)
 
+    if hips_cache_dir is not None:
+        # download every tile needed by the candidates once, the workers
+        # only read the cache
+        print('Prefetching hips tiles: \n')
+        cache = HipsTileCache(hips_cache_dir, fetch=is_hips_fetch)
+        geometries = [candidate_geometry(ra_df[i], dec_df[i], sigma1_df[i], res_image)
+                      for i in todo]
+        cache.prefetch(hips_surveys, geometries)
+        print(cache.__str__())
+
     pool = multiprocessing.Pool(num_workers)
+
+    # stars of each results directory sorted by cell once, the workers only
+    # read the cells of their cutouts
+    print('Building the star stores of the candidates: \n')
+    pool.map(build_star_store, sorted(set(results_dir(name_df[i]) for i in todo)))
+
     func = partial(multiprocessing_plot_hips_sky_image, name_df, label_df,
-        hips_surveys, ra_df, dec_df, sigma1_df, sig_p_df, path, res_image)
-    pool.map(func, iterable)
+        hips_surveys, ra_df, dec_df, sigma1_df, sig_p_df, path, res_image,
+        hips_cache_dir)
+    is_complete = pool.map(func, iterable)
     pool.close()
     pool.join()
 
+    # images missing a hips survey are not stamped, they are retried next time
+    for stage, is_done in zip(stages, is_complete):
+        if is_done:
+            stage.done()
+    print('%d images missing a hips survey, retried by the next run' % (
+        len(stages) - sum(is_complete)))
+
     print("\nWe are finished :) \n")